@@ -5,8 +5,10 @@ import click
 from .mask_atmos_plevel.mask_atmos_plevel import mask_atmos_plevel_subtool
 from .generate_time_averages.generate_time_averages import generate
 from .generate_time_averages.wrapper import generate_wrapper
-from .regrid_xy.regrid_xy import regrid_xy
+from .regrid_xy.regrid_xy import regrid_xy, regrid_xy_batch
 from .generate_time_averages.combine import combine
+from .generate_time_averages.output_encoding import form_output_encoding
+from .generate_time_averages.benchmark import TIME_STEPS, compare_benchmarks, run_benchmarks
 from .remap_pp_components.remap_pp_components import remap_pp_components
 
 @click.group(help=click.style(" - app subcommands", fg=(250,154,90)))
@@ -99,11 +101,105 @@ def remap(input_dir, output_dir, begin_date, current_chunk,
               type = str,
               help = "`input_date` / `input_date` (env var) ISO8601 datetime format specification for" + \
                      " starting date of data, part of input target file name")
+@click.option("-gd", "--grid_spec_cache_dir",
+              type = str,
+              help = "directory the pp_grid_spec tarfile is extracted to once and shared between " + \
+                     "regridding tasks, defaults to a directory local to the node and private to the user")
+@click.option("-e", "--engine",
+              type = click.Choice(["fregrid", "sparse"]),
+              default = "fregrid",
+              help = "`sparse` generates and applies conserve_order1 remap files in-process, falling back " + \
+                     "to fregrid for other interp methods")
+@click.option("-ww", "--weight_workers",
+              type = int,
+              default = 1,
+              help = "number of processes generating conserve_order1 remap files with the sparse engine")
+@click.option("-j", "--workers",
+              type = int,
+              default = 1,
+              help = "number of regridding jobs, one per component and variable batch, run concurrently")
+@click.option("-vj", "--variables_per_job",
+              type = int,
+              help = "largest number of variables regridded by one job. more variables are split into " + \
+                     "batches regridded concurrently, then merged into one output file")
 def regrid(yamlfile, input_dir, output_dir, work_dir,
-           remap_dir, source, input_date):
+           remap_dir, source, input_date, grid_spec_cache_dir, engine, weight_workers,
+           workers, variables_per_job):
     ''' regrid target netcdf file '''
     regrid_xy(yamlfile, input_dir, output_dir, work_dir,
-              remap_dir, source, input_date)
+              remap_dir, source, input_date,
+              grid_spec_cache_dir = grid_spec_cache_dir,
+              engine = engine,
+              weight_workers = weight_workers,
+              workers = workers,
+              variables_per_job = variables_per_job)
+
+
+@app_cli.command()
+@click.option("--yamlfile",
+              type = str,
+              help = "Path to yaml configuration file",
+              required = True)
+@click.option("-i", "--input_dir",
+              type = str,
+              help = "`inputDir` / `input_dir` (env var) specifies input directory to regrid, " + \
+                     "typically an untarred history file archive" ,
+              required = True)
+@click.option("-o", "--output_dir",
+              type = str,
+              help = "`outputDir` / `output_dir` (env var) specifies target location for output" + \
+                     " regridded files",
+              required = True)
+@click.option("-w", "--work_dir",
+              type = str,
+              help = "`TMPDIR` / `workdir_dir` (env var) work directory for location of file " + \
+                     "read/writes",
+              required = True)
+@click.option("-rd", "--remap_dir",
+              type = str,
+              help = "`fregridRemapDir` / `remap_dir` (env var) directory containing remap file" + \
+                     " for regridding",
+              required = True)
+@click.option("-s", "--sources",
+              type = str,
+              help = "sources (history file types) to regrid, comma-separated",
+              required = True)
+@click.option("-id", "--input_dates",
+              type = str,
+              help = "ISO8601 starting dates of the data, comma-separated, each source being regridded " + \
+                     "for every date")
+@click.option("-gd", "--grid_spec_cache_dir",
+              type = str,
+              help = "directory the pp_grid_spec tarfile is extracted to once and shared between " + \
+                     "regridding tasks, defaults to a directory local to the node and private to the user")
+@click.option("-e", "--engine",
+              type = click.Choice(["fregrid", "sparse"]),
+              default = "fregrid",
+              help = "`sparse` generates and applies conserve_order1 remap files in-process, falling back " + \
+                     "to fregrid for other interp methods")
+@click.option("-ww", "--weight_workers",
+              type = int,
+              default = 1,
+              help = "number of processes generating conserve_order1 remap files with the sparse engine")
+@click.option("-j", "--workers",
+              type = int,
+              default = 1,
+              help = "number of regridding jobs, one per source, date, component and variable batch, " + \
+                     "run concurrently")
+@click.option("-vj", "--variables_per_job",
+              type = int,
+              help = "largest number of variables regridded by one job. more variables are split into " + \
+                     "batches regridded concurrently, then merged into one output file")
+def regrid_batch(yamlfile, input_dir, output_dir, work_dir, remap_dir, sources, input_dates,
+                 grid_spec_cache_dir, engine, weight_workers, workers, variables_per_job):
+    ''' regrid the netcdf files of many sources and dates at once, sharing the setup between them '''
+    regrid_xy_batch(yamlfile, input_dir, output_dir, work_dir, remap_dir,
+                    sources.split(','), input_dates.split(',') if input_dates else [None],
+                    grid_spec_cache_dir = grid_spec_cache_dir,
+                    engine = engine,
+                    weight_workers = weight_workers,
+                    workers = workers,
+                    variables_per_job = variables_per_job)
 
 
 @app_cli.command()
@@ -132,7 +228,8 @@ def mask_atmos_plevel(infile, psfile, outfile, warn_no_ps):
 @click.option("-i", "--inf",
               type = str,
               required = True,
-              help = "Input file name")
+              multiple = True,
+              help = "Input file name. Repeat to average over several input files")
 @click.option("-o", "--outf",
               type = str,
               required = True,
@@ -150,16 +247,89 @@ def mask_atmos_plevel(infile, psfile, outfile, warn_no_ps):
               default = False,
               help = "Request unweighted statistics")
 @click.option("-a", "--avg_type",
-              type = click.Choice(["month","seas","all"]),
-              default = "all",
+              type = click.Choice(["month","seas","all","hour","doy"]),
+              default = ["all"],
+              multiple = True,
               help = "Type of time average to generate. \n \
-                     currently, fre-nctools and fre-python-tools pkg options\n \
-                     do not support seasonal and monthly averaging.\n")
-def gen_time_averages(inf, outf, pkg, var, unwgt, avg_type):
+                     currently, the fre-nctools pkg option\n \
+                     does not support seasonal averaging.\n \
+                     hour (diurnal cycle) and doy (day of year)\n \
+                     are fre-python-tools only.\n \
+                     Repeat to generate several products, written to\n \
+                     OUTF with the avg_type inserted before the .nc suffix.\n \
+                     fre-python-tools reads the input only once for all of them.\n")
+@click.option("-s", "--stream",
+              is_flag = True,
+              default = False,
+              help = "Stream through multiple input files in time order instead of merging them " + \
+                     "with cdo first. fre-python-tools only")
+@click.option("-st", "--stats",
+              type = click.Choice(["var","std","min","max"]),
+              multiple = True,
+              help = "Statistic to compute besides the average, written as an extra variable\n \
+                     VAR_STAT in the same output file. Repeat for several statistics.\n \
+                     fre-python-tools only\n")
+@click.option("-pc", "--percentile",
+              type = click.FloatRange(0., 100.),
+              multiple = True,
+              help = "Percentile to estimate with per-cell quantile sketches, e.g. 95, written as an\n \
+                     extra variable VAR_p95 in the same output file. Repeat for several percentiles.\n \
+                     fre-python-tools only\n")
+@click.option("--sketch-size",
+              type = click.IntRange(min = 2),
+              default = None,
+              help = "Capacity of each level of the quantile sketches, larger is more accurate " + \
+                     "but uses more memory per grid cell")
+@click.option("--partials",
+              is_flag = True,
+              default = False,
+              help = "Also write the running sums behind each output to a hidden sidecar file, " + \
+                     ".<OUTF without .nc>.partials next to it. fre-python-tools only")
+@click.option("--update",
+              is_flag = True,
+              default = False,
+              help = "Merge only the input files not yet included into the sums of existing " + \
+                     "sidecar files, and rewrite the outputs. fre-python-tools only")
+@click.option("--max-memory",
+              type = str,
+              default = None,
+              help = "Memory budget of the process, e.g. 4G or 512M. Input is read in slabs sized " + \
+                     "from the variable's dtype and shape to stay within it. fre-python-tools only")
+@click.option("--yamlfile",
+              type = str,
+              default = None,
+              help = "Path to yaml configuration file, whose postprocess: settings: output_encoding: " + \
+                     "section sets the defaults of the output encoding options below")
+@click.option("--compression",
+              type = click.Choice(["zlib","zstd","none"]),
+              default = None,
+              help = "Compression of the output variables, default zlib")
+@click.option("--complevel",
+              type = click.IntRange(0, 9),
+              default = None,
+              help = "Compression level, default 4")
+@click.option("--shuffle/--no-shuffle",
+              default = None,
+              help = "Byte-shuffle before compressing, default on")
+@click.option("--chunking",
+              type = click.Choice(["slice","auto"]),
+              default = None,
+              help = "Output chunk shape: slice, one whole 2-D horizontal slice per chunk, " + \
+                     "or auto, left to the netCDF library. Default slice")
+@click.option("--significant-digits",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Quantize data variables to this many significant digits before compressing. " + \
+                     "Lossy, default off")
+def gen_time_averages(inf, outf, pkg, var, unwgt, avg_type, stream, stats, percentile, sketch_size,
+                      partials, update, max_memory, yamlfile, compression, complevel, shuffle, chunking,
+                      significant_digits):
     """
     generate time averages for specified set of netCDF files.
+    The output encoding options are fre-python-tools only.
     """
-    generate(inf, outf, pkg, var, unwgt, avg_type)
+    generate(inf, outf, pkg, var, unwgt, avg_type, stream, stats, percentile, sketch_size, partials, update,
+             max_memory, yamlfile, compression, complevel, shuffle, chunking, significant_digits)
 
 @app_cli.command()
 @click.option("--cycle-point",
@@ -190,18 +360,37 @@ def gen_time_averages(inf, outf, pkg, var, unwgt, avg_type):
 @click.option("--frequency",
               type = str,
               required = True,
-              help = "Frequency of desired climatology: 'mon' or 'yr'")
+              help = "Frequency of desired climatology: 'mon' or 'yr', or both comma-separated")
 @click.option("-p", "--pkg",
               type = click.Choice(["cdo","fre-nctools","fre-python-tools"]),
               default = "cdo",
               help = "Time average approach")
-def gen_time_averages_wrapper(cycle_point, dir_, sources, output_interval, input_interval, grid, frequency, pkg):
+@click.option("--num-windows",
+              type = click.IntRange(min = 1),
+              default = 1,
+              help = "Number of overlapping climatologies to compute, each starting one input interval " + \
+                     "after the previous, e.g. 1980-1984, 1981-1985, ... fre-python-tools reads each " + \
+                     "timeseries file once for all of them")
+@click.option("-w", "--workers",
+              type = click.IntRange(min = 1),
+              default = 1,
+              help = "Number of (source, variable) averaging jobs to run concurrently, " + \
+                     "capped to stay within open file and memory limits")
+@click.option("--combined-dir",
+              type = str,
+              default = None,
+              help = "Root output postprocess directory, up to the 'pp'. If given, every variable of a source " + \
+                     "is written straight into the combined <source>/av/annual_<N>yr (or monthly_<N>yr) " + \
+                     "files, without combine-time-averages. fre-python-tools only")
+def gen_time_averages_wrapper(cycle_point, dir_, sources, output_interval, input_interval, grid, frequency, pkg,
+                              num_windows, workers, combined_dir):
     """
     Wrapper for climatology tool.
     Time average all variables for a desired cycle point, source, and grid.
     """
     sources_list = sources.split(',')
-    generate_wrapper(cycle_point, dir_, sources_list, output_interval, input_interval, grid, frequency, pkg)
+    generate_wrapper(cycle_point, dir_, sources_list, output_interval, input_interval, grid, frequency, pkg,
+                     num_windows, workers, combined_dir)
 
 @app_cli.command()
 @click.option("--in-dir",
@@ -232,8 +421,150 @@ def gen_time_averages_wrapper(cycle_point, dir_, sources, output_interval, input
               type = str,
               required = True,
               help = "Climatology interval in ISO8601")
-def combine_time_averages(in_dir, out_dir, component, begin, end, frequency, interval):
+@click.option("--max-memory",
+              type = str,
+              default = None,
+              help = "Memory budget of the process, e.g. 4G or 512M. Variables are merged in chunks " + \
+                     "sized from their dtype and shape to stay within it")
+@click.option("--yamlfile",
+              type = str,
+              default = None,
+              help = "Path to yaml configuration file, whose postprocess: settings: output_encoding: " + \
+                     "section sets the defaults of the output encoding options below")
+@click.option("--compression",
+              type = click.Choice(["zlib","zstd","none"]),
+              default = None,
+              help = "Compression of the output variables, default zlib")
+@click.option("--complevel",
+              type = click.IntRange(0, 9),
+              default = None,
+              help = "Compression level, default 4")
+@click.option("--shuffle/--no-shuffle",
+              default = None,
+              help = "Byte-shuffle before compressing, default on")
+@click.option("--chunking",
+              type = click.Choice(["slice","auto"]),
+              default = None,
+              help = "Output chunk shape: slice, one whole 2-D horizontal slice per chunk, " + \
+                     "or auto, left to the netCDF library. Default slice")
+@click.option("--significant-digits",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Quantize data variables to this many significant digits before compressing. " + \
+                     "Lossy, default off")
+@click.option("-w", "--workers",
+              type = click.IntRange(min = 1),
+              default = 1,
+              help = "Number of monthly merges to run concurrently, sharing the memory budget")
+def combine_time_averages(in_dir, out_dir, component, begin, end, frequency, interval, max_memory,
+                          yamlfile, compression, complevel, shuffle, chunking, significant_digits, workers):
     """
     Combine per-variable climatologies into one file
     """
-    combine(in_dir, out_dir, component, begin, end, frequency, interval)
+    encoding = form_output_encoding( yamlfile, compression = compression, complevel = complevel,
+                                     shuffle = shuffle, chunking = chunking,
+                                     significant_digits = significant_digits )
+    combine(in_dir, out_dir, component, begin, end, frequency, interval, max_memory, encoding, workers)
+
+@app_cli.command()
+@click.option("--work-dir",
+              type = str,
+              required = True,
+              help = "Directory for the synthetic inputs and the outputs")
+@click.option("-o", "--output",
+              type = str,
+              required = True,
+              help = "JSON file to write the benchmark results to")
+@click.option("--backends",
+              type = str,
+              default = None,
+              help = "Backends to run, comma-separated, default every one whose executables are found")
+@click.option("-a", "--avg-types",
+              type = str,
+              default = "all,seas,month",
+              help = "avg_types to run, comma-separated. Each backend runs those it supports")
+@click.option("--nx",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Grid points along x, default 144")
+@click.option("--ny",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Grid points along y, default 90")
+@click.option("--levels",
+              type = click.IntRange(min = 0),
+              default = None,
+              help = "Vertical levels, default 0 for a surface field")
+@click.option("--tiles",
+              type = click.IntRange(min = 0),
+              default = None,
+              help = "Cubed-sphere tiles, default 0 for a single lat-lon grid")
+@click.option("--time-steps",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Time steps, default 120")
+@click.option("--time-step",
+              type = click.Choice(list(TIME_STEPS)),
+              default = None,
+              help = "Length of a time step, default mon")
+@click.option("--num-files",
+              type = click.IntRange(min = 1),
+              default = None,
+              help = "Timeseries files the time steps are split between, default 10")
+@click.option("--mask-frac",
+              type = click.FloatRange(0., 1.),
+              default = None,
+              help = "Fraction of masked data, default 0")
+@click.option("--calendar",
+              type = str,
+              default = None,
+              help = "Calendar of the time axis, default noleap")
+@click.option("--repeats",
+              type = click.IntRange(min = 1),
+              default = 1,
+              help = "Runs of each case, the smallest of each measurement is kept")
+@click.option("--baseline",
+              type = str,
+              default = None,
+              help = "JSON results of an earlier run to compare to, see compare-time-average-benchmarks")
+@click.option("--tolerance",
+              type = click.FloatRange(min = 0.),
+              default = 0.1,
+              help = "Allowed relative growth of each measurement over the baseline")
+def benchmark_time_averages(work_dir, output, backends, avg_types, nx, ny, levels, tiles, time_steps, time_step,
+                            num_files, mask_frac, calendar, repeats, baseline, tolerance):
+    """
+    Benchmark the time-averaging backends on synthetic history and timeseries files,
+    recording wall time, peak RSS and bytes read and written
+    """
+    config = { key: value for key, value in [ ('nx', nx), ('ny', ny), ('levels', levels), ('tiles', tiles),
+                                              ('time_steps', time_steps), ('time_step', time_step),
+                                              ('num_files', num_files), ('mask_frac', mask_frac),
+                                              ('calendar', calendar) ] if value is not None }
+    run_benchmarks(work_dir, output, config, backends.split(',') if backends is not None else None,
+                   avg_types.split(','), repeats)
+    if baseline is not None:
+        regressions = compare_benchmarks(output, baseline, tolerance)
+        if len(regressions) > 0:
+            raise RuntimeError(f"{len(regressions)} regression(s) against {baseline}")
+
+@app_cli.command()
+@click.option("--results",
+              type = str,
+              required = True,
+              help = "JSON results of benchmark-time-averages")
+@click.option("--baseline",
+              type = str,
+              required = True,
+              help = "JSON results of an earlier run to compare to")
+@click.option("--tolerance",
+              type = click.FloatRange(min = 0.),
+              default = 0.1,
+              help = "Allowed relative growth of each measurement over the baseline")
+def compare_time_average_benchmarks(results, baseline, tolerance):
+    """
+    Compare time-averaging benchmark results to a baseline, failing on regressions
+    """
+    regressions = compare_benchmarks(results, baseline, tolerance)
+    if len(regressions) > 0:
+        raise RuntimeError(f"{len(regressions)} regression(s) against {baseline}")
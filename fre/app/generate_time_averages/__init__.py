@@ -1,3 +1,4 @@
 '''required for generate_time_averages module import functionality'''
 __all__ = ['generate_time_averages', 'timeAverager', 'wrapper', 'combine',
-           'frenctoolsTimeAverager', 'cdoTimeAverager', 'frepytoolsTimeAverager']
+           'frenctoolsTimeAverager', 'cdoTimeAverager', 'frepytoolsTimeAverager',
+           'time_reduction', 'output_encoding', 'benchmark']
@@ -0,0 +1,358 @@
+''' benchmarks of the time-averaging backends on synthetic history and timeseries files '''
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import cftime
+import netCDF4
+import numpy
+from netCDF4 import Dataset
+
+from .generate_time_averages import generate_time_average
+from .time_reduction import iter_slabs, peak_rss_bytes
+
+fre_logger = logging.getLogger(__name__)
+
+# size and layout of the synthetic inputs, overridden by the config given to run_benchmarks.
+# levels = 0 writes a surface field, tiles = 0 a single lat-lon grid rather than cubed-sphere tiles.
+# time_step is one of TIME_STEPS, the time steps are split evenly between num_files timeseries files
+DEFAULT_BENCHMARK_CONFIG = { 'nx': 144,
+                             'ny': 90,
+                             'levels': 0,
+                             'tiles': 0,
+                             'time_steps': 120,
+                             'time_step': 'mon',
+                             'num_files': 10,
+                             'mask_frac': 0.,
+                             'calendar': 'noleap',
+                             'seed': 0 }
+
+# length of one time step in days, 'mon' follows the calendar
+TIME_STEPS = { 'mon': None, 'day': 1., '3hr': 0.125 }
+
+# executables each backend needs on PATH. fre-nctools splits months and merges inputs with cdo
+BACKEND_EXECUTABLES = { 'cdo': ['cdo'],
+                        'fre-nctools': ['timavg.csh', 'cdo'],
+                        'fre-python-tools': [] }
+
+# avg_types each backend supports
+BACKEND_AVG_TYPES = { 'cdo': ['all', 'seas', 'month'],
+                      'fre-nctools': ['all', 'month'],
+                      'fre-python-tools': ['all', 'seas', 'month', 'hour', 'doy'] }
+
+# measured per run, lower is better
+BENCHMARK_METRICS = ['wall_seconds', 'peak_rss_bytes', 'bytes_read', 'bytes_written']
+
+BENCHMARK_VAR = 'tas'
+BENCHMARK_TIME_UNITS = 'days since 1980-01-01 00:00:00'
+
+
+def form_time_edges(time_steps: int, time_step: str, calendar: str) -> numpy.ndarray:
+    """
+    edges of consecutive time steps from the start of BENCHMARK_TIME_UNITS
+
+    :param time_steps: number of time steps
+    :type time_steps: int
+    :param time_step: one of TIME_STEPS
+    :type time_step: str
+    :param calendar: calendar of the time axis
+    :type calendar: str
+    :raises ValueError: unknown time_step
+    :return: time_steps + 1 edges, in days of BENCHMARK_TIME_UNITS
+    :rtype: numpy.ndarray
+    """
+    if time_step not in TIME_STEPS:
+        raise ValueError(f'time_step = {time_step} not known, must be one of {list(TIME_STEPS)}')
+    if TIME_STEPS[time_step] is not None:
+        return numpy.arange(time_steps + 1) * TIME_STEPS[time_step]
+    dates = [ cftime.datetime(1980 + month // 12, month % 12 + 1, 1, calendar = calendar)
+              for month in range(time_steps + 1) ]
+    return numpy.asarray(cftime.date2num(dates, BENCHMARK_TIME_UNITS, calendar), dtype = numpy.float64)
+
+
+def write_synthetic_file(path: str, time_edges: numpy.ndarray, config: dict, seed: int = 0) -> None:
+    """
+    write a history-like file of BENCHMARK_VAR with time bounds, written in slabs so that files
+    larger than memory can be made
+
+    :param path: file to write
+    :type path: str
+    :param time_edges: edges of the file's time steps, in days of BENCHMARK_TIME_UNITS
+    :type time_edges: numpy.ndarray
+    :param config: size and layout, see DEFAULT_BENCHMARK_CONFIG
+    :type config: dict
+    :param seed: seed of the random data
+    :type seed: int
+    """
+    rng = numpy.random.default_rng(seed)
+    spatial_dims = ( [('pfull', config['levels'])] if config['levels'] > 0 else [] ) + \
+                   ( [('tile', config['tiles']), ('grid_yt', config['ny']), ('grid_xt', config['nx'])]
+                     if config['tiles'] > 0 else [('lat', config['ny']), ('lon', config['nx'])] )
+    shape = (len(time_edges) - 1,) + tuple(size for _, size in spatial_dims)
+    fill_value = numpy.float32(1.e20)
+
+    with Dataset(path, 'w', format = 'NETCDF4') as nc_out:
+        nc_out.title = 'synthetic benchmark data'
+        nc_out.createDimension('time', None)
+        nc_out.createDimension('bnds', 2)
+        for dim, size in spatial_dims:
+            nc_out.createDimension(dim, size)
+            nc_out.createVariable(dim, 'f8', (dim,))[:] = numpy.arange(size)
+
+        time_var = nc_out.createVariable('time', 'f8', ('time',))
+        time_var.units = BENCHMARK_TIME_UNITS
+        time_var.calendar = config['calendar']
+        time_var.axis = 'T'
+        time_var.bounds = 'time_bnds'
+        time_var[:] = 0.5 * (time_edges[:-1] + time_edges[1:])
+        time_bnds_var = nc_out.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+        time_bnds_var.units = BENCHMARK_TIME_UNITS
+        time_bnds_var[:] = numpy.stack([time_edges[:-1], time_edges[1:]], axis = 1)
+
+        data_var = nc_out.createVariable(BENCHMARK_VAR, 'f4', ('time',) + tuple(dim for dim, _ in spatial_dims),
+                                         fill_value = fill_value)
+        data_var.units = 'K'
+        data_var.cell_methods = 'time: mean'
+        for index in iter_slabs(shape, 0, 4):
+            slab_shape = tuple( len(range(*axis_index.indices(size))) for axis_index, size in zip(index, shape) )
+            data = rng.random(slab_shape, dtype = numpy.float32) * 100.
+            if config['mask_frac'] > 0.:
+                data[rng.random(slab_shape) < config['mask_frac']] = fill_value
+            data_var[index] = data
+
+
+def write_synthetic_inputs(work_dir: str, config: dict) -> dict:
+    """
+    write one history file holding every time step, and the same time steps split into
+    config['num_files'] timeseries files
+
+    :param work_dir: directory to write into
+    :type work_dir: str
+    :param config: size and layout, see DEFAULT_BENCHMARK_CONFIG
+    :type config: dict
+    :raises ValueError: fewer time steps than timeseries files
+    :return: input file(s) keyed by kind, 'history' a single path and 'timeseries' a list of them
+    :rtype: dict
+    """
+    if not 0 < config['num_files'] <= config['time_steps']:
+        raise ValueError(f"num_files = {config['num_files']} must be between 1 and "
+                         f"time_steps = {config['time_steps']}")
+    input_dir = Path(work_dir) / 'inputs'
+    input_dir.mkdir(parents = True, exist_ok = True)
+    time_edges = form_time_edges(config['time_steps'], config['time_step'], config['calendar'])
+
+    history_file = input_dir / f'bench.history.{BENCHMARK_VAR}.nc'
+    write_synthetic_file(history_file, time_edges, config, config['seed'])
+    fre_logger.info('wrote history file %s, %s bytes', history_file, os.path.getsize(history_file))
+
+    timeseries_files = []
+    splits = numpy.linspace(0, config['time_steps'], config['num_files'] + 1).astype(int)
+    for segment, (first, last) in enumerate(zip(splits[:-1], splits[1:])):
+        timeseries_file = input_dir / f'bench.{segment:04d}.{BENCHMARK_VAR}.nc'
+        write_synthetic_file(timeseries_file, time_edges[first:last + 1], config, config['seed'] + segment + 1)
+        timeseries_files.append(str(timeseries_file))
+    fre_logger.info('wrote %s timeseries files', len(timeseries_files))
+    return { 'history': str(history_file), 'timeseries': timeseries_files }
+
+
+def available_backends(backends: Optional[List[str]] = None) -> List[str]:
+    """
+    the backends whose executables are all on PATH
+
+    :param backends: backends to consider, default all of BACKEND_EXECUTABLES
+    :type backends: list
+    :raises ValueError: unknown backend
+    :return: available backends, in the order given
+    :rtype: list
+    """
+    available = []
+    for backend in backends if backends is not None else list(BACKEND_EXECUTABLES):
+        if backend not in BACKEND_EXECUTABLES:
+            raise ValueError(f'backend = {backend} not known, must be one of {list(BACKEND_EXECUTABLES)}')
+        missing = [ executable for executable in BACKEND_EXECUTABLES[backend] if shutil.which(executable) is None ]
+        if len(missing) > 0:
+            fre_logger.warning('skipping backend %s, executable(s) %s not found', backend, missing)
+        else:
+            available.append(backend)
+    return available
+
+
+def read_io_counters() -> tuple:
+    """
+    bytes this process has read and written so far, including those of its waited-for child
+    processes, from /proc/self/io
+
+    :return: bytes read and written, (None, None) where /proc/self/io does not exist
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/self/io', 'r', encoding = 'utf-8') as proc_io:
+            counters = dict( line.split(': ') for line in proc_io.read().splitlines() if ': ' in line )
+    except OSError:
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def measure_time_average(kwargs: dict) -> dict:
+    """
+    run generate_time_average once and measure it. meant to run in a fresh process, so that
+    the peak RSS is that of this run alone
+
+    :param kwargs: arguments of generate_time_average
+    :type kwargs: dict
+    :return: exit status (1 if it raised), error message if any, and BENCHMARK_METRICS
+    :rtype: dict
+    """
+    read_before, written_before = read_io_counters()
+    start_time = time.perf_counter()
+    result = { 'exitstatus': 0, 'error': None }
+    try:
+        result['exitstatus'] = generate_time_average(**kwargs) or 0
+    except Exception as exc: # pylint: disable=broad-exception-caught
+        result['exitstatus'] = 1
+        result['error'] = f'{type(exc).__name__}: {exc}'
+    result['wall_seconds'] = time.perf_counter() - start_time
+    read_after, written_after = read_io_counters()
+    # external tools run as child processes, count the largest of them too. linux reports ru_maxrss in KiB
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    result['peak_rss_bytes'] = max(peak_rss_bytes(), children_peak)
+    result['bytes_read'] = read_after - read_before if read_before is not None else None
+    result['bytes_written'] = written_after - written_before if written_before is not None else None
+    return result
+
+
+def run_benchmarks(work_dir: str,
+                   results_file: str,
+                   config: Optional[dict] = None,
+                   backends: Optional[List[str]] = None,
+                   avg_types: Optional[List[str]] = None,
+                   repeats: int = 1) -> dict:
+    """
+    time-average synthetic history and timeseries files with every available backend and each avg_type
+    it supports, each run in a fresh process, and write the measurements to a JSON file
+
+    :param work_dir: directory for the synthetic inputs and the outputs, outputs are removed after each run
+    :type work_dir: str
+    :param results_file: JSON file to write the results to
+    :type results_file: str
+    :param config: size and layout of the inputs, updating DEFAULT_BENCHMARK_CONFIG
+    :type config: dict
+    :param backends: backends to run, default all available, see available_backends
+    :type backends: list
+    :param avg_types: avg_types to run, default 'all', 'seas' and 'month'. each backend runs those it supports
+    :type avg_types: list
+    :param repeats: runs of each case, the smallest of each measurement is kept
+    :type repeats: int
+    :raises ValueError: unknown config key
+    :return: the results written
+    :rtype: dict
+    """
+    unknown_keys = [ key for key in (config or {}) if key not in DEFAULT_BENCHMARK_CONFIG ]
+    if len(unknown_keys) > 0:
+        raise ValueError(f'benchmark config key(s) {unknown_keys} not known, must be one of '
+                         f'{list(DEFAULT_BENCHMARK_CONFIG)}')
+    config = { **DEFAULT_BENCHMARK_CONFIG, **(config or {}) }
+    avg_types = avg_types if avg_types is not None else ['all', 'seas', 'month']
+    backends = available_backends(backends)
+    fre_logger.info('benchmarking backends %s with avg_types %s, config %s', backends, avg_types, config)
+
+    inputs = write_synthetic_inputs(work_dir, config)
+    output_dir = Path(work_dir) / 'outputs'
+    results = []
+    for input_kind, infile in inputs.items():
+        for backend in backends:
+            for avg_type in avg_types:
+                if avg_type not in BACKEND_AVG_TYPES[backend]:
+                    fre_logger.info('skipping avg_type %s, not supported by backend %s', avg_type, backend)
+                    continue
+                case = { 'input': input_kind, 'backend': backend, 'avg_type': avg_type }
+                kwargs = { 'infile': infile, 'outfile': str(output_dir / f'bench.{avg_type}.nc'),
+                           'pkg': backend, 'var': BENCHMARK_VAR, 'avg_type': avg_type,
+                           # fre-python-tools reads timeseries files in turn, the others merge them first
+                           'stream': backend == 'fre-python-tools' and input_kind == 'timeseries' }
+                runs = []
+                for _ in range(repeats):
+                    output_dir.mkdir(parents = True, exist_ok = True)
+                    # a fresh process per run, so that each peak RSS is that run's own
+                    with multiprocessing.Pool(processes = 1) as pool:
+                        runs.append(pool.apply(measure_time_average, (kwargs,)))
+                    shutil.rmtree(output_dir)
+                result = { **case, 'exitstatus': max( run['exitstatus'] for run in runs ),
+                           'error': next( (run['error'] for run in runs if run['error'] is not None), None ) }
+                for metric in BENCHMARK_METRICS:
+                    values = [ run[metric] for run in runs if run[metric] is not None ]
+                    result[metric] = min(values) if len(values) > 0 else None
+                fre_logger.info('%s: %.2f s, peak RSS %s MiB, exit status %s', case, result['wall_seconds'],
+                                result['peak_rss_bytes'] // 1024**2, result['exitstatus'])
+                results.append(result)
+
+    benchmark = { 'config': config,
+                  'repeats': repeats,
+                  'platform': { 'hostname': platform.node(),
+                                'python': platform.python_version(),
+                                'numpy': numpy.__version__,
+                                'netCDF4': netCDF4.__version__,
+                                'cpu_count': os.cpu_count() },
+                  'results': results }
+    with open(results_file, 'w', encoding = 'utf-8') as opened_file:
+        json.dump(benchmark, opened_file, indent = 2)
+    fre_logger.info('wrote %s benchmark results to %s', len(results), results_file)
+    return benchmark
+
+
+def compare_benchmarks(results_file: str, baseline_file: str, tolerance: float = 0.1) -> List[dict]:
+    """
+    compare benchmark results to a stored baseline, case by case. a case regresses if it now fails
+    while it succeeded in the baseline, or if any of BENCHMARK_METRICS grew by more than tolerance.
+    cases found in only one of the files are logged and not compared
+
+    :param results_file: JSON file written by run_benchmarks
+    :type results_file: str
+    :param baseline_file: JSON file written by run_benchmarks, to compare to
+    :type baseline_file: str
+    :param tolerance: allowed relative growth of each metric, e.g. 0.1 for 10%
+    :type tolerance: float
+    :return: regressions, each the case, the metric, and its baseline and current values
+    :rtype: list
+    """
+    def load_cases(path):
+        with open(path, 'r', encoding = 'utf-8') as opened_file:
+            benchmark = json.load(opened_file)
+        return { (result['input'], result['backend'], result['avg_type']): result
+                 for result in benchmark['results'] }, benchmark['config']
+
+    results, config = load_cases(results_file)
+    baseline, baseline_config = load_cases(baseline_file)
+    if config != baseline_config:
+        fre_logger.warning('benchmark configs differ, results %s, baseline %s', config, baseline_config)
+    for case in sorted(set(results) ^ set(baseline)):
+        fre_logger.warning('case %s only in %s, not compared', case,
+                           results_file if case in results else baseline_file)
+
+    regressions = []
+    for case in sorted(set(results) & set(baseline)):
+        result, base = results[case], baseline[case]
+        if result['exitstatus'] != 0 and base['exitstatus'] == 0:
+            regressions.append( { 'case': case, 'metric': 'exitstatus',
+                                  'baseline': base['exitstatus'], 'current': result['exitstatus'] } )
+            continue
+        for metric in BENCHMARK_METRICS:
+            if result[metric] is None or base[metric] is None:
+                continue
+            change = (result[metric] - base[metric]) / base[metric] if base[metric] > 0 else 0.
+            fre_logger.info('%s %s: %s -> %s (%+.1f%%)', case, metric, base[metric], result[metric], 100. * change)
+            if change > tolerance:
+                regressions.append( { 'case': case, 'metric': metric,
+                                      'baseline': base[metric], 'current': result[metric] } )
+    for regression in regressions:
+        fre_logger.error('regression in %s: %s went from %s to %s', regression['case'], regression['metric'],
+                         regression['baseline'], regression['current'])
+    return regressions
@@ -1,6 +1,7 @@
 ''' class using (mostly) cdo functions for time-averages '''
 
 import logging
+from typing import List, Sequence, Union
 
 from netCDF4 import Dataset
 import numpy as np
@@ -12,6 +13,36 @@ from .timeAverager import timeAverager
 
 fre_logger = logging.getLogger(__name__)
 
+def form_cdo_chain(infile: Union[str, List[str]], operators: Sequence[str] = (), var: str = None) -> str:
+    """
+    compose cdo operators into one chained input string, so that cdo merges, selects and reduces the
+    input(s) in a single call, without intermediate files. the string is meant as the input argument of
+    the outermost operator, e.g. _cdo.splitmon(input = form_cdo_chain(...), output = root)
+
+    :param infile: path to history file, or list of paths, merged in time if more than one
+    :type infile: str, list
+    :param operators: cdo operators with their comma-separated arguments, outermost first, e.g.
+                      ['timsum', 'muldpm']
+    :type operators: list of str
+    :param var: optional, only select this variable from the input(s)
+    :type var: str
+    :return: the chained operators and input file paths, e.g. '-timsum -muldpm -selname,tas -mergetime a.nc b.nc'
+    :rtype: str
+    """
+    if isinstance(infile, (list, tuple)):
+        infiles = [ str(item) for item in infile ]
+    else:
+        infiles = [ str(infile) ]
+    if not infiles:
+        raise ValueError('form_cdo_chain needs at least one input file')
+
+    chain = list(operators)
+    if var is not None:
+        chain.append(f'selname,{var}')
+    if len(infiles) > 1:
+        chain.append('mergetime')
+    return ' '.join( [ f'-{operator}' for operator in chain ] + infiles )
+
 class cdoTimeAverager(timeAverager):
     '''
     class inheriting from abstract base class timeAverager
@@ -35,50 +66,54 @@ class cdoTimeAverager(timeAverager):
             fre_logger.error('requested unknown avg_type %s.', self.avg_type)
             raise ValueError(f'requested unknown avg_type {self.avg_type}')
 
-        if self.var is not None:
-            fre_logger.warning('WARNING: variable specification not twr supported for cdo time averaging. ignoring!')
-
         fre_logger.info('python-cdo version is %s', cdo.__version__)
 
         _cdo = Cdo()
 
         wgts_sum = 0
-        if not self.unwgt: #weighted case, cdo ops alone don't support a weighted time-average.
-
-            nc_fin = Dataset(infile, 'r')
-
-            time_bnds = nc_fin['time_bnds'][:].copy()
-            # Ensure float64 precision for consistent results across numpy versions
-            # NumPy 2.0 changed type promotion rules (NEP 50), so explicit casting
-            # is needed to avoid precision differences
-            time_bnds = np.asarray(time_bnds, dtype=np.float64)
-            # Transpose once to avoid redundant operations
-            time_bnds_transposed = np.moveaxis(time_bnds, 0, -1)
-            wgts = time_bnds_transposed[1] - time_bnds_transposed[0]
-            # Use numpy.sum for consistent dtype handling across numpy versions
-            wgts_sum = np.sum(wgts, dtype=np.float64)
+        if not self.unwgt and self.avg_type == 'all':
+            #weighted case, cdo ops alone don't support a weighted time-average.
+            #only time_bnds are read here, the data itself never comes back into python
+            infiles = infile if isinstance(infile, (list, tuple)) else [infile]
+            for single_infile in infiles:
+                with Dataset(single_infile, 'r') as nc_fin:
+                    time_bnds = nc_fin['time_bnds'][:].copy()
+                # Ensure float64 precision for consistent results across numpy versions
+                # NumPy 2.0 changed type promotion rules (NEP 50), so explicit casting
+                # is needed to avoid precision differences
+                time_bnds = np.asarray(time_bnds, dtype=np.float64)
+                # Transpose once to avoid redundant operations
+                time_bnds_transposed = np.moveaxis(time_bnds, 0, -1)
+                wgts = time_bnds_transposed[1] - time_bnds_transposed[0]
+                # Use numpy.sum for consistent dtype handling across numpy versions
+                wgts_sum += np.sum(wgts, dtype=np.float64)
 
             fre_logger.debug('wgts_sum = %s', wgts_sum)
 
         if self.avg_type == 'all':
             fre_logger.info('time average over all time requested.')
             if self.unwgt:
-                _cdo.timmean(input = infile, output = outfile, returnCdf = True)
+                _cdo.timmean(input = form_cdo_chain(infile, var = self.var), output = str(outfile))
             else:
-                _cdo.divc( str(wgts_sum), input = "-timsum -muldpm "+infile, output = outfile)
+                _cdo.divc( str(wgts_sum), input = form_cdo_chain(infile, ['timsum', 'muldpm'], self.var),
+                           output = str(outfile) )
             fre_logger.info('done averaging over all time.')
 
         elif self.avg_type == 'seas':
             fre_logger.info('seasonal time-averages requested.')
-            _cdo.yseasmean(input = infile, output = outfile, returnCdf = True)
+            _cdo.yseasmean(input = form_cdo_chain(infile, var = self.var), output = str(outfile))
             fre_logger.info('done averaging over seasons.')
 
         elif self.avg_type == 'month':
             fre_logger.info('monthly time-averages requested.')
             outfile_str = str(outfile)
-            _cdo.ymonmean(input = infile, output = outfile_str, returnCdf = True)
+            _cdo.ymonmean(input = form_cdo_chain(infile, var = self.var), output = outfile_str)
             fre_logger.info('done averaging over months.')
 
+            # splitmon is not chained as -splitmon -ymonmean: a cdo chain only writes the files of its
+            # outermost operator, and the combined ymonmean file is an output in its own right, compared
+            # against references by the tests. splitmon only re-reads its twelve climatological months,
+            # not the input time series
             fre_logger.warning(" splitting by month")
             outfile_root = outfile_str.removesuffix(".nc") + '.'
             _cdo.splitmon(input = outfile_str, output = outfile_root)
@@ -3,14 +3,19 @@ routines centered around combining monthly climatologies written out as one-mont
 see wrapper.py for more information
 """
 import logging
+import multiprocessing
+import os
 from pathlib import Path
 import glob
+import shutil
+import tempfile
 
-import subprocess
 import metomi.isodatetime.parsers
+from netCDF4 import Dataset
 import xarray as xr
 
-from ..helpers import change_directory
+from .output_encoding import DEFAULT_OUTPUT_ENCODING, form_xarray_encoding
+from .time_reduction import budget_slab_bytes, log_peak_rss, parse_memory_size, slab_shape
 
 fre_logger = logging.getLogger(__name__)
 duration_parser = metomi.isodatetime.parsers.DurationParser()
@@ -40,15 +45,53 @@ def form_bronx_directory_name(frequency: str,
     return frequency_label + '_' + str(interval_object.years) + 'yr'
 
 
-def merge_netcdfs(input_file_glob: str, output_file: str) -> None:
+def form_merge_chunks(input_files: list[str], max_memory: int) -> dict:
+    """
+    Chunk sizes per dimension such that one chunk of any variable of the input files,
+    plus the base process, fits within a memory budget. Unlimited dimensions are chunked last.
+
+    :param input_files: NetCDF files to be merged
+    :type input_files: list[str]
+    :param max_memory: Memory budget of the process, in bytes
+    :type max_memory: int
+    :return: Chunk size of each dimension, for xarray
+    :rtype: dict
+    """
+    chunks = {}
+    for input_file in input_files:
+        with Dataset(input_file, 'r') as nc_fin:
+            for nc_var in nc_fin.variables.values():
+                if nc_var.ndim == 0:
+                    continue
+                unlimited_axes = [ axis for axis, dim in enumerate(nc_var.dimensions)
+                                   if nc_fin.dimensions[dim].isunlimited() ]
+                chunk_bytes = budget_slab_bytes(max_memory, 0, nc_var.dtype.itemsize, buffers = 1)
+                chunk_shape = slab_shape( nc_var.shape, unlimited_axes[0] if unlimited_axes else None,
+                                          nc_var.dtype.itemsize, chunk_bytes )
+                for dim, size in zip(nc_var.dimensions, chunk_shape):
+                    chunks[dim] = min(chunks.get(dim, size), size)
+    fre_logger.info("Merging in chunks of %s", chunks)
+    return chunks
+
+
+def merge_netcdfs(input_file_glob: str, output_file: str, max_memory: int = None,
+                  encoding: dict = None) -> None:
     """
     Merge a group of NetCDF files identified by a glob string
-    into one combined NetCDF file.
+    into one combined NetCDF file. Variables are read lazily and copied without
+    decoding (no masking, scaling or time conversion), and the output is written
+    under a temporary name, then renamed into place.
 
     :param input_file_glob: Glob string used to form input file list
     :type source: str
     :param output_file: Merged output NetCDF file
     :type source: str
+    :param max_memory: Memory budget of the process in bytes. If given, variables are read and
+                       written one chunk at a time, see form_merge_chunks
+    :type max_memory: int
+    :param encoding: Compression, shuffle, chunking and quantization of the merged file,
+                     see output_encoding.form_output_encoding. Default is DEFAULT_OUTPUT_ENCODING
+    :type encoding: dict
     :raises FileNotFoundError: Input files not found
     :raises FileExistsError: Output file already exists
     :rtype: None
@@ -61,8 +104,95 @@ def merge_netcdfs(input_file_glob: str, output_file: str) -> None:
     if Path(output_file).exists():
         raise FileExistsError(f"Output file '{output_file}' already exists")
 
-    ds = xr.open_mfdataset(input_files, compat='override', coords='minimal')
-    ds.to_netcdf(output_file, unlimited_dims=['time'])
+    if encoding is None:
+        encoding = DEFAULT_OUTPUT_ENCODING
+
+    temp_file = form_temp_path(output_file)
+    try:
+        if max_memory is None:
+            ds = xr.open_mfdataset(input_files, compat='override', coords='minimal', decode_cf=False)
+            ds.to_netcdf(temp_file, unlimited_dims=['time'], encoding=form_xarray_encoding(encoding, ds, ['time']))
+        else:
+            ds = xr.open_mfdataset(input_files, compat='override', coords='minimal', decode_cf=False,
+                                   chunks=form_merge_chunks(input_files, max_memory))
+            # the synchronous scheduler holds a single chunk in memory at a time
+            ds.to_netcdf(temp_file, unlimited_dims=['time'], encoding=form_xarray_encoding(encoding, ds, ['time']),
+                         compute=False).compute(scheduler='synchronous')
+        ds.close()
+        os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def form_temp_path(path: str) -> str:
+    """
+    Unused hidden path next to a file, to write it under before renaming it into place
+
+    :param path: Path of the file
+    :type path: str
+    :return: Temporary path in the same directory
+    :rtype: str
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=f".{Path(path).name}.", suffix=".tmp", dir=Path(path).parent)
+    os.close(fd)
+    os.remove(temp_path)
+    return temp_path
+
+
+def publish_file(source_file: str, outdir: str) -> Path:
+    """
+    Place a file in a directory under the same name, atomically: readers see either the
+    previous file or the complete new one. The file is hard-linked if both are on the same
+    filesystem, copied otherwise.
+
+    :param source_file: File to publish
+    :type source_file: str
+    :param outdir: Destination directory
+    :type outdir: str
+    :return: Published file
+    :rtype: Path
+    """
+    target = Path(outdir) / Path(source_file).name
+    temp_file = form_temp_path(target)
+    try:
+        try:
+            os.link(source_file, temp_file)
+            fre_logger.debug("Linked %s to %s", source_file, target)
+        except OSError:
+            # e.g. across filesystems, or where hard links are not supported
+            shutil.copy2(source_file, temp_file)
+            fre_logger.debug("Copied %s to %s", source_file, target)
+        os.replace(temp_file, target)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return target
+
+
+def merge_and_publish(input_file_glob: str, output_file: str, outdir: str, max_memory: int = None,
+                      encoding: dict = None) -> Path:
+    """
+    Merge a group of NetCDF files, see merge_netcdfs, then publish the merged file to outdir, see publish_file.
+    Logs the peak RSS of the process running the merge against its budget, in a worker process or not
+
+    :param input_file_glob: Glob string used to form input file list
+    :type input_file_glob: str
+    :param output_file: Merged output NetCDF file
+    :type output_file: str
+    :param outdir: Directory to publish the merged file to
+    :type outdir: str
+    :param max_memory: Memory budget of the process in bytes, see merge_netcdfs
+    :type max_memory: int
+    :param encoding: Output encoding of the merged file, see merge_netcdfs
+    :type encoding: dict
+    :return: Published file
+    :rtype: Path
+    """
+    merge_netcdfs(input_file_glob, output_file, max_memory, encoding)
+    fre_logger.debug("Output file created: %s", output_file)
+    log_peak_rss(max_memory)
+    return publish_file(output_file, outdir)
 
 
 def combine( root_in_dir: str,
@@ -71,9 +201,12 @@ def combine( root_in_dir: str,
              begin: int,
              end: int,
              frequency: str,
-             interval: str) -> None:
+             interval: str,
+             max_memory: str = None,
+             encoding: dict = None,
+             workers: int = 1) -> None:
     """
-    Combine per-variable climatologies into one file.
+    Combine per-variable climatologies into one file, or one per month.
 
     :param root_in_dir: Root time average shards directory, up to the "av"
     :type root_in_dir: str
@@ -89,16 +222,22 @@ def combine( root_in_dir: str,
     :type frequency: 'mon' or 'yr'
     :param interval: Length of the climatology
     :type interval: ISO8601 duration
+    :param max_memory: Memory budget of the process, in bytes or e.g. '4G'. With several workers,
+                       it is shared evenly between them
+    :type max_memory: str
+    :param encoding: Output encoding of the combined files, see merge_netcdfs
+    :type encoding: dict
+    :param workers: Number of monthly merges to run concurrently in separate processes
+    :type workers: int
     :raises ValueError: Only monthly and annual frequencies allowed
     :rtype: None
     """
     if frequency not in ["yr", "mon"]:
         raise ValueError(f"Frequency '{frequency}' not recognized or supported")
+    if max_memory is not None:
+        max_memory = parse_memory_size(max_memory)
 
-    if frequency == "yr":
-        frequency_iso = "P1Y"
-    elif frequency == "mon":
-        frequency_iso = "P1M"
+    frequency_iso = {"yr": "P1Y", "mon": "P1M"}[frequency]
 
     outdir = Path(root_out_dir) / component / "av" / form_bronx_directory_name(frequency, interval)
     fre_logger.debug("Output dir = %s", outdir)
@@ -112,17 +251,26 @@ def combine( root_in_dir: str,
     indir = Path(root_in_dir) / frequency_iso / interval
     fre_logger.debug("Input dir = %s", indir)
 
-    with change_directory(indir):
-        if frequency == 'yr':
-            source = component + '.' + date_string + '.*.nc'
-            target = component + '.' + date_string + '.nc'
-            merge_netcdfs(source, target)
-            fre_logger.debug("Output file created: %s", target)
-            fre_logger.debug("Copying to %s", outdir)
-            subprocess.run(['cp', '-v', target, outdir], check=True)
-        elif frequency == 'mon':
-            for month_int in range(1,13):
-                source = f"{component}.{date_string}.*.{month_int:02d}.nc"
-                target = f"{component}.{date_string}.{month_int:02d}.nc"
-                merge_netcdfs(source, target)
-                subprocess.run(['cp', '-v', target, outdir], check=True)
+    # the combined files are written next to their inputs, then published to outdir
+    merges = {
+        'yr': [ (str(indir / f"{component}.{date_string}.*.nc"),
+                 str(indir / f"{component}.{date_string}.nc")) ],
+        'mon': [ (str(indir / f"{component}.{date_string}.*.{month_int:02d}.nc"),
+                  str(indir / f"{component}.{date_string}.{month_int:02d}.nc")) for month_int in range(1,13) ]
+    }[frequency]
+
+    num_processes = max(1, min(workers, len(merges)))
+    if num_processes == 1:
+        for source, target in merges:
+            fre_logger.info("Published %s", merge_and_publish(source, target, outdir, max_memory, encoding))
+        return
+
+    if max_memory is not None:
+        max_memory = max_memory // num_processes
+    fre_logger.info("Running %s merges, %s at a time", len(merges), num_processes)
+    # a fresh process per merge returns its memory to the system as soon as it finishes
+    with multiprocessing.Pool(processes=num_processes, maxtasksperchild=1) as pool:
+        published = pool.starmap(merge_and_publish, [ (source, target, outdir, max_memory, encoding)
+                                                      for source, target in merges ])
+    for target in published:
+        fre_logger.info("Published %s", target)
@@ -2,6 +2,8 @@
 import os
 import logging
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 from pathlib import Path
 
@@ -10,6 +12,9 @@ from .timeAverager import timeAverager
 
 fre_logger = logging.getLogger(__name__)
 
+# most timavg.csh processes run at once, one per month
+MAX_TIMAVG_PROCESSES = 12
+
 class frenctoolsTimeAverager(timeAverager):
     '''
     class inheriting from abstract base class timeAverager
@@ -59,80 +64,88 @@ class frenctoolsTimeAverager(timeAverager):
 
         #Recursive call if month is selected for climatology. by Avery Kiihne
         if self.avg_type == 'month':
-            monthly_nc_dir = "monthly_nc_files"    #Folder that new monthly input files are put
             output_dir = Path(outfile).parent       #Save output in the user-specified location
-            os.makedirs(monthly_nc_dir, exist_ok=True)   #create directory if it does not exist
-            fre_logger.info('created monthly_nc_dir = %s', str(Path(monthly_nc_dir).resolve()))
             os.makedirs(output_dir, exist_ok=True)
-            fre_logger.info('created output_dir = %s', str(Path(monthly_nc_dir).resolve()))
-
-            #Extract unique months from the infile
-            month_indices = list(range(1, 13))   #serves to track month index and as part of the outfile name
-            #month_names = [calendar.month_name[i] for i in month_indices]
-
-            # Dictionary to store output filenames by month
-            # the keys are the month indices (ints)
-            nc_month_file_paths = {}
-            month_output_file_paths = {}
-            for month_index in month_indices:
-                nc_month_file_paths[month_index]     = os.path.join( monthly_nc_dir,
-                                                                     f"all_years.{month_index}.nc")
-                month_output_file_paths[month_index] = os.path.join( output_dir,
-                                                                     f"{Path(outfile).stem}.{month_index:02d}.nc")
-
-            cdo = Cdo()
-            #Loop through each month and select the corresponding data
-            for month_index in month_indices:
-
-                #month_name = month_names[month_index - 1]
-                nc_monthly_file = nc_month_file_paths[month_index]
-
-                #Select data for the given month
-                cdo.select(f"month={month_index}", input=infile, output=nc_monthly_file)
-
-                #Run timavg command for newly created file
-                month_output_file = month_output_file_paths[month_index]
-                #timavgcsh_command=['timavg.csh', '-mb','-o', month_output_file, nc_monthly_file]
-                timavgcsh_command=[shutil.which('timavg.csh'), '-dmb','-o', month_output_file, nc_monthly_file]
-                fre_logger.info( 'timavgcsh_command is %s', ' '.join(timavgcsh_command) )
-                exitstatus=1
-                with Popen(timavgcsh_command,
-                           stdout=PIPE, stderr=PIPE, shell=False) as subp:
-                    stdout, stderr = subp.communicate()
-                    stdoutput=stdout.decode()
-                    fre_logger.info('output= %s', stdoutput)
-                    stderror=stderr.decode()
-                    fre_logger.info('error = %s', stderror )
-
-                    if subp.returncode != 0:
-                        fre_logger.error('stderror = %s', stderror)
-                        raise ValueError(f'error: timavg.csh had a problem, subp.returncode = {subp.returncode}')
-
-                    fre_logger.info('%s climatology successfully ran',nc_monthly_file)
-                    exitstatus=0
-
-                #Delete files after being used to generate output files
-            shutil.rmtree('monthly_nc_files')
+            fre_logger.info('created output_dir = %s', str(output_dir.resolve()))
+
+            # one cdo pass splits the input by month, into a directory private to this call,
+            # so concurrent tasks sharing a working directory cannot clobber each other's files
+            with tempfile.TemporaryDirectory(prefix = 'monthly_nc_files.', dir = os.getcwd()) as monthly_nc_dir:
+                fre_logger.info('created monthly_nc_dir = %s', monthly_nc_dir)
+                cdo = Cdo()
+                cdo.splitmon(input = infile, output = os.path.join(monthly_nc_dir, 'all_years.'))
+
+                missing_months = [ month_index for month_index in range(1, 13)
+                                   if not os.path.exists(os.path.join(monthly_nc_dir,
+                                                                      f'all_years.{month_index:02d}.nc')) ]
+                if len(missing_months) > 0:
+                    raise ValueError(f'error: no data for month(s) {missing_months} in {infile}')
+
+                # Dictionary to store output filenames by month
+                # the keys are the month indices (ints)
+                nc_month_file_paths = {}
+                month_output_file_paths = {}
+                for month_index in range(1, 13):
+                    # same input file names as when each month was selected on its own
+                    nc_month_file_paths[month_index] = os.path.join(monthly_nc_dir, f'all_years.{month_index}.nc')
+                    os.rename( os.path.join(monthly_nc_dir, f'all_years.{month_index:02d}.nc'),
+                               nc_month_file_paths[month_index] )
+                    month_output_file_paths[month_index] = os.path.join( output_dir,
+                                                                         f"{Path(outfile).stem}.{month_index:02d}.nc")
+
+                # the months are independent, run their timavg.csh concurrently in a bounded pool
+                num_processes = max(1, min(MAX_TIMAVG_PROCESSES, os.cpu_count() or 1, len(nc_month_file_paths)))
+                fre_logger.info('running timavg.csh for %s months, %s at a time',
+                                len(nc_month_file_paths), num_processes)
+                with ThreadPoolExecutor(max_workers = num_processes) as pool:
+                    returncodes = dict( zip( nc_month_file_paths,
+                                             pool.map( self.run_timavgcsh,
+                                                       nc_month_file_paths.values(),
+                                                       month_output_file_paths.values(),
+                                                       [ f'month {month_index:02d}'
+                                                         for month_index in nc_month_file_paths ] ) ) )
+
+            failed_months = [ month_index for month_index, returncode in returncodes.items() if returncode != 0 ]
+            if len(failed_months) > 0:
+                raise ValueError(f'error: timavg.csh had a problem for month(s) {failed_months}, see log above')
+            exitstatus = 0
 
         if self.avg_type == 'month':   #End here if month variable used
             return exitstatus
 
         exitstatus = 1
-        fre_logger.info( 'timavgcsh_command is %s', ' '.join(timavgcsh_command) )
-        timavgcsh_command = [ shutil.which('timavg.csh'), '-dmb', '-o', outfile, infile]
+        returncode = self.run_timavgcsh(infile, outfile, 'all')
+        if returncode != 0:
+            raise ValueError(f'error: timavgcsh command not properly executed, subp.returncode = {returncode}')
+        exitstatus = 0
+
+        return exitstatus
+
+    def run_timavgcsh(self, infile = None, outfile = None, label = None):
+        """
+        run timavg.csh on one input file, logging its output under label once it finishes,
+        so that the logs of concurrent runs do not interleave
+
+        :param infile: path to the input file
+        :type infile: str
+        :param outfile: path to the output file
+        :type outfile: str
+        :param label: name of this run in the log, e.g. the month
+        :type label: str
+        :return: return code of timavg.csh
+        :rtype: int
+        """
+        timavgcsh_command = [ shutil.which('timavg.csh'), '-dmb', '-o', outfile, infile ]
+        fre_logger.info( '%s: timavgcsh_command is %s', label, ' '.join(timavgcsh_command) )
         with Popen(timavgcsh_command,
                    stdout = PIPE, stderr = PIPE, shell = False) as subp:
             stdout, stderr = subp.communicate()
-            stdoutput = stdout.decode()
-            fre_logger.info('output = %s', stdoutput)
-            stderror = stderr.decode()
-            fre_logger.info('error  = %s', stderror )
+            fre_logger.info('%s: output = %s', label, stdout.decode())
+            fre_logger.info('%s: error  = %s', label, stderr.decode())
 
             if subp.returncode != 0:
-                fre_logger.error('stderror  = %s', stderror)
-                raise ValueError(f'error: timavgcsh command not properly executed, subp.returncode = {subp.returncode}')
-
-            fre_logger.info('climatology successfully ran')
-            exitstatus = 0
-
-        return exitstatus
+                fre_logger.error('%s: timavg.csh had a problem, subp.returncode = %s, stderror = %s',
+                                 label, subp.returncode, stderr.decode())
+            else:
+                fre_logger.info('%s: climatology successfully ran for %s', label, infile)
+            return subp.returncode
@@ -1,168 +1,826 @@
 ''' class for python-native routine using netCDF4 and numpy to crunch time-averages '''
 
+import collections
 import logging
+import os
+import re
 
+import cftime
 import numpy
 from netCDF4 import Dataset
 
+from .output_encoding import DEFAULT_OUTPUT_ENCODING, form_netcdf4_encoding, form_partials_encoding
 from .timeAverager import timeAverager
+from .time_reduction import ( DEFAULT_SKETCH_SIZE, DEFAULT_SLAB_BYTES, NUM_TIME_GROUPS, SKETCH_SLAB_BUFFERS,
+                              SLAB_BUFFERS, STATS, QuantileAccumulator, TimeAccumulator, TimeExtent,
+                              budget_slab_bytes, compute_time_weights, group_time_steps, iter_slabs,
+                              percentile_stat_name, slab_shape )
 
 fre_logger = logging.getLogger(__name__)
 
+# FMS averaging-interval variables, written from each output record's time envelope:
+# the start of the first interval, the end of the last, and the summed length
+AVERAGE_INTERVAL_VARS = { 'average_T1': 'start',
+                          'average_T2': 'end',
+                          'average_DT': 'length' }
+
+# seconds per unit of time, to express interval lengths in the units of average_DT
+SECONDS_PER_TIME_UNIT = { 'seconds': 1., 'minutes': 60., 'hours': 3600., 'days': 86400. }
+
 class frepytoolsTimeAverager(timeAverager):
     '''
     class inheriting from abstract base class timeAverager
     generates time-averages using a python-native approach
     avoids using other third party statistics functions by design.
+    optionally also computes the variance, standard deviation, minimum, maximum and
+    percentiles over time, in the same pass as the average.
     '''
+    stats: tuple
+    percentiles: tuple
+    sketch_size: int
+    save_partials: bool
+    update: bool
+    max_memory: int
+    encoding: dict
+    append: bool
+
+    def __init__(self, pkg, var, unwgt, avg_type, stats = None, percentiles = None,
+                 sketch_size = DEFAULT_SKETCH_SIZE, save_partials = False, update = False, max_memory = None,
+                 encoding = None, append = False):
+        '''
+        init method
+
+        :param stats: optional statistics to write besides the average, any of 'var', 'std', 'min', 'max'.
+                      each is written as an extra variable named like the target variable with _<stat> appended
+        :type stats: list
+        :param percentiles: optional percentiles in [0, 100] to estimate with per-cell quantile sketches,
+                            written like stats, e.g. 95 as <var>_p95. unweighted, each time step counts once
+        :type percentiles: list
+        :param sketch_size: capacity of each level of the quantile sketches, trading memory for accuracy
+        :type sketch_size: int
+        :param save_partials: also write the running sums behind each output to a sidecar file, see partials_path
+        :type save_partials: bool
+        :param update: merge the inputs not yet processed into the sums of existing sidecar files,
+                       instead of averaging every input again. implies save_partials
+        :type update: bool
+        :param max_memory: optional memory budget of the process in bytes. slabs are then sized from the
+                           target variable's dtype and shape so the running sums and one slab fit within it
+        :type max_memory: int
+        :param encoding: compression, shuffle, chunking and quantization of the outputs,
+                         see output_encoding.form_output_encoding. default is DEFAULT_OUTPUT_ENCODING
+        :type encoding: dict
+        :param append: add the averaged variable to output files that already exist, sharing the dimensions,
+                       coordinates and global attributes they hold, instead of overwriting them. lets one
+                       file gather every variable of a component, one call per variable
+        :type append: bool
+        '''
+        super().__init__(pkg, var, unwgt, avg_type)
+        self.stats = tuple(stats) if stats is not None else ()
+        self.percentiles = tuple( float(pct) for pct in percentiles ) if percentiles is not None else ()
+        self.sketch_size = sketch_size
+        self.save_partials = save_partials or update
+        self.update = update
+        self.max_memory = max_memory
+        self.encoding = encoding if encoding is not None else dict(DEFAULT_OUTPUT_ENCODING)
+        self.append = append
+
+    def get_time_weights(self, nc_fin = None, time_dim = None, ref_units = None):
+        """
+        read the time bounds of time_dim and return the per-time-step weights.
+        when ref_units is given and differs from the bounds' units, the bounds are
+        converted first, so weights from different files are comparable.
+
+        :param nc_fin: open input dataset
+        :type nc_fin: netCDF4.Dataset
+        :param time_dim: name of the time dimension
+        :type time_dim: str
+        :param ref_units: units the weights should be expressed in, default is the file's own
+        :type ref_units: str
+        :return: weights of shape (time,)
+        :rtype: numpy.ndarray
+        """
+        time_bnds = self.get_time_bounds(nc_fin, time_dim, ref_units)
+        if time_bnds is None:
+            raise KeyError(f'no time bounds found for {time_dim}, cannot weight the average')
+        return compute_time_weights(time_bnds)
+
+    def get_time_bounds(self, nc_fin = None, time_dim = None, ref_units = None):
+        """
+        read the time bounds of time_dim, converted to ref_units if given and different from their own
+
+        :param nc_fin: open input dataset
+        :type nc_fin: netCDF4.Dataset
+        :param time_dim: name of the time dimension
+        :type time_dim: str
+        :param ref_units: units the bounds should be expressed in, default is the file's own
+        :type ref_units: str
+        :return: time bounds of shape (time, 2), None if the file has none
+        :rtype: numpy.ma.MaskedArray
+        """
+        time_var = nc_fin.variables.get(time_dim)
+        time_bnds_name = getattr(time_var, 'bounds', 'time_bnds')
+        if time_bnds_name not in nc_fin.variables:
+            return None
+        time_bnds = nc_fin[time_bnds_name][:]
+        units = getattr(nc_fin[time_bnds_name], 'units', getattr(time_var, 'units', None))
+        if None not in [ref_units, units] and units != ref_units:
+            calendar = getattr(time_var, 'calendar', 'standard')
+            fre_logger.debug('converting %s from %s to %s', time_bnds_name, units, ref_units)
+            time_bnds = cftime.date2num( cftime.num2date(time_bnds, units, calendar),
+                                         ref_units, calendar )
+        return time_bnds
+
+    def sort_infiles_by_time(self, infiles = None, targ_var = None):
+        """
+        order input files by the date of the first time step of targ_var in each
+
+        :param infiles: paths to the input files
+        :type infiles: list
+        :param targ_var: name of the variable being averaged
+        :type targ_var: str
+        :return: paths sorted by time, files without targ_var are left where they fall
+        :rtype: list
+        """
+        first_dates = {}
+        for path in infiles:
+            with Dataset(path, 'r') as nc_fin:
+                if targ_var not in nc_fin.variables:
+                    continue
+                time_dim = self.var_time_dim(nc_fin[targ_var])
+                if time_dim not in nc_fin.variables or nc_fin.dimensions[time_dim].size == 0:
+                    continue
+                time_var = nc_fin[time_dim]
+                first_dates[path] = cftime.num2date( time_var[0], time_var.units,
+                                                     getattr(time_var, 'calendar', 'standard') )
+        if len(first_dates) != len(infiles):
+            return list(infiles)
+        return sorted(infiles, key = lambda path: first_dates[path])
+
+    def get_avg_types(self):
+        """
+        check the requested products and statistics
+
+        :return: requested avg_types as a list, None if any request is not supported
+        :rtype: list
+        """
+        avg_types = list(self.avg_type) if isinstance(self.avg_type, (list, tuple)) else [self.avg_type]
+        for avg_type in avg_types:
+            if avg_type not in NUM_TIME_GROUPS:
+                fre_logger.error('avg_type = %s not supported at this time.', avg_type)
+                return None
+        for stat in self.stats:
+            if stat not in STATS:
+                fre_logger.error('stat = %s not supported, must be one of %s', stat, list(STATS))
+                return None
+        for pct in self.percentiles:
+            if not 0. <= pct <= 100.:
+                fre_logger.error('percentile = %s not within [0, 100]', pct)
+                return None
+        return avg_types
+
+    def get_targ_var(self, infiles = None):
+        """
+        identify the input variable, two approaches: user inputs target variable OR
+        attempt to determine target var w/ bronx convention from the first input file name
+
+        :param infiles: paths to the input files
+        :type infiles: list
+        :return: name of the variable to average
+        :rtype: str
+        """
+        if self.var is not None:
+            targ_var = self.var
+        else: # this can be replaced w/ a regex search maybe
+            targ_var = infiles[0].split('/').pop().split('.')[-2]
+        fre_logger.debug('targ_var = %s', targ_var)
+        return targ_var
 
     def generate_timavg(self, infile = None, outfile = None):
 
         """
         frepytools approach in a python-native manner.
         deliberately avoids pre-packaged routines.
+        a list of input files is streamed through in time order, keeping running sums across
+        files, without merging them into one file first.
 
         :param self: This is an instance of the class frepytoolsTimeAverager
         :param infile: path to history file, or list of paths, default is None
         :type infile: str, list
-        :param outfile: path to where output file should be stored, default is None
-        :type outfile: str
+        :param outfile: path to where output file should be stored, default is None.
+                        if self.avg_type is a list, a dict of paths keyed by avg_type
+        :type outfile: str, dict
         :return: 1 if requested variable is not found, and 0 if function has a clean exit
         :rtype: int
+
+        avg_type = 'month' writes one file per calendar month, named like outfile with the two-digit
+        month inserted before the .nc suffix. avg_type = 'seas' writes one time record per season
+        (DJF, MAM, JJA, SON) into outfile. avg_type = 'hour' writes one record per hour of the day
+        (a diurnal cycle, e.g. 8 records from 3-hourly data) and avg_type = 'doy' one per calendar day of
+        the year, see group_time_steps. all groups are accumulated in a single read of the input.
+        self.avg_type may also be a list of avg_types, each slab of input is then read once and
+        folded into every product's sums.
+        with self.update, the sums saved next to the outputs by an earlier call are read back and only
+        the input files they do not already include are read, the result matching a full recompute.
         """
-        if self.avg_type != 'all':
-            fre_logger.error('avg_type = %s not supported at this time.', self.avg_type)
+        avg_types = self.get_avg_types()
+        if avg_types is None:
+            return 1
+        if self.save_partials and len(self.percentiles) > 0:
+            fre_logger.error('quantile sketches cannot be saved as partial sums, drop percentiles or partials')
+            return 1
+        if isinstance(outfile, dict):
+            outfiles = outfile
+        elif len(avg_types) == 1:
+            outfiles = { avg_types[0]: outfile }
+        else:
+            fre_logger.error('several avg_types requested, outfile must be a dict keyed by avg_type')
             return 1
 
-        # (TODO) file I/O should be a sep function, no? make tests, extend
-        nc_fin = Dataset(infile, 'r')
-        if nc_fin.file_format != 'NETCDF4':
-            fre_logger.info('input file is not netCDF4 format, is %s', nc_fin.file_format)
+        if isinstance(infile, (list, tuple)):
+            infiles = [ str(path) for path in infile ]
+        else:
+            infiles = [ str(infile) ]
 
-        # (TODO) make this a sep function, make tests, extend
-        # identifying the input variable, two approaches
-        # user inputs target variable OR
-        # attempt to determine target var w/ bronx convention
-        if self.var is not None:
-            targ_var = self.var
-        else: # this can be replaced w/ a regex search maybe
-            targ_var = infile.split('/').pop().split('.')[-2]
+        targ_var = self.get_targ_var(infiles)
+        if len(infiles) > 1:
+            infiles = self.sort_infiles_by_time(infiles, targ_var)
+            fre_logger.info('streaming through %s input files in time order', len(infiles))
 
-        fre_logger.debug('targ_var = %s', targ_var)
+        # earlier sums to update, if any
+        saved = {}
+        if self.update:
+            saved = { avg_type: self.read_partials(self.partials_path(outfiles[avg_type]), targ_var, avg_type)
+                      for avg_type in avg_types if os.path.exists(self.partials_path(outfiles[avg_type])) }
+            if any( partials is None for partials in saved.values() ):
+                return 1
+            if len(saved) == 0:
+                fre_logger.warning('no partial sums found next to %s, averaging every input', list(outfiles.values()))
+            elif len(saved) != len(avg_types) or \
+                 len({ tuple(partials[2]) for partials in saved.values() }) != 1:
+                fre_logger.error('partial sums of avg_types %s are missing or out of step with each other. exit.',
+                                 avg_types)
+                return 1
+        processed = saved[avg_types[0]][2] if len(saved) > 0 else []
+        ref_units = saved[avg_types[0]][3] if len(saved) > 0 else None
+        new_infiles = [ path for path in infiles if os.path.abspath(path) not in processed ]
+        if len(saved) > 0:
+            fre_logger.info('updating sums of %s input files with %s new one(s)', len(processed), len(new_infiles))
 
-        # (TODO) make this a sep function, make tests, extend
-        # check for the variable we're hoping is in the file
-        time_bnds = None
-        nc_fin_vars = nc_fin.variables
-        for key in nc_fin_vars:
-            if str(key) == targ_var: # found our variable, grab bounds
-                time_bnds = nc_fin['time_bnds'][:].copy()
-                break
-        if time_bnds is None:
-            fre_logger.error('requested variable not found. exit.')
+        if len(new_infiles) > 0:
+            partials = self.accumulate(new_infiles, targ_var, avg_types, ref_units, held_sums = 1 if saved else 0)
+            if partials is None:
+                return 1
+            accumulators, sketches, first_records, extents, ref_units = partials
+        else:
+            accumulators, sketches, first_records = {}, {}, { avg_type: {} for avg_type in avg_types }
+            extents = {}
+
+        template_file = new_infiles[0] if len(new_infiles) > 0 else infiles[0]
+        if len(saved) > 0:
+            if os.path.exists(processed[0]):
+                template_file = processed[0]
+            for avg_type in avg_types:
+                saved_accumulator, saved_first_records, _, _, saved_extent = saved[avg_type]
+                if avg_type in accumulators:
+                    try:
+                        saved_accumulator.merge(accumulators[avg_type])
+                        saved_extent.merge(extents[avg_type])
+                    except ValueError as exc:
+                        fre_logger.error('new inputs do not match the partial sums: %s. exit.', exc)
+                        return 1
+                accumulators[avg_type] = saved_accumulator
+                extents[avg_type] = saved_extent
+                first_records[avg_type] = { **first_records[avg_type], **saved_first_records }
+
+        for avg_type in avg_types:
+            self.write_product( avg_type = avg_type,
+                                outfile = outfiles[avg_type],
+                                template_file = template_file,
+                                targ_var = targ_var,
+                                accumulator = accumulators[avg_type],
+                                first_records = first_records[avg_type],
+                                sketch = sketches.get(avg_type),
+                                extent = extents[avg_type],
+                                time_units = ref_units )
+            if self.save_partials:
+                self.write_partials( path = self.partials_path(outfiles[avg_type]),
+                                     template_file = template_file,
+                                     targ_var = targ_var,
+                                     avg_type = avg_type,
+                                     accumulator = accumulators[avg_type],
+                                     first_records = first_records[avg_type],
+                                     input_files = processed + [ os.path.abspath(path) for path in new_infiles ],
+                                     ref_units = ref_units,
+                                     extent = extents[avg_type] )
+        return 0
+
+    def generate_sliding_timavg(self, infile = None, outfile = None, window = None):
+        """
+        averages over sliding windows of consecutive input files, e.g. the overlapping 5-year climatologies
+        1980-1984, 1981-1985, ... from yearly timeseries files. each input file is read once into its own
+        partial sums, and each window is formed from the previous one by merging in the newest file's
+        partials and removing the oldest's, so N windows cost about one pass over the data.
+        'min', 'max' and percentiles cannot be taken out of a window, so are not supported here.
+
+        :param infile: paths to the input files, one per window step
+        :type infile: list
+        :param outfile: output path(s) of each window, in order, len(infile) - window + 1 of them.
+                        each like the outfile of generate_timavg
+        :type outfile: list
+        :param window: number of consecutive input files per window
+        :type window: int
+        :return: 1 if the request or an input cannot be averaged, and 0 if function has a clean exit
+        :rtype: int
+        """
+        avg_types = self.get_avg_types()
+        if avg_types is None:
             return 1
+        if any( stat in self.stats for stat in ['min', 'max'] ) or len(self.percentiles) > 0:
+            fre_logger.error('sliding windows support the mean, var and std only, not stats = %s, percentiles = %s',
+                             self.stats, self.percentiles)
+            return 1
+        infiles = [ str(path) for path in infile ]
+        targ_var = self.get_targ_var(infiles)
+        infiles = self.sort_infiles_by_time(infiles, targ_var)
+        if window is None or not 0 < window <= len(infiles) or len(outfile) != len(infiles) - window + 1:
+            fre_logger.error('window = %s files does not fit %s input files and %s output windows',
+                             window, len(infiles), len(outfile))
+            return 1
+        outfiles = [ outfiles_ if isinstance(outfiles_, dict) else { avg_types[0]: outfiles_ }
+                     for outfiles_ in outfile ]
+        fre_logger.info('averaging %s sliding windows of %s files each', len(outfiles), window)
 
+        # (path, accumulators, first records) of each file in the current window, oldest first
+        window_partials = collections.deque()
+        window_sums = None
+        ref_units = None
+        for file_index, path in enumerate(infiles):
+            partials = self.accumulate([path], targ_var, avg_types, ref_units, held_sums = window + 1)
+            if partials is None:
+                return 1
+            accumulators, _, first_records, extents, ref_units = partials
+            if window_sums is None:
+                window_sums = { avg_type: TimeAccumulator( accumulator.wsum.shape[1:], accumulator.wsum.shape[0],
+                                                           self.stats )
+                                for avg_type, accumulator in accumulators.items() }
+            try:
+                for avg_type in avg_types:
+                    window_sums[avg_type].merge(accumulators[avg_type])
+            except ValueError as exc:
+                fre_logger.error('cannot add %s to the window: %s. exit.', path, exc)
+                return 1
+            window_partials.append( (path, accumulators, first_records, extents) )
 
-        # (TODO) determine what we need to worry about with masks and account for it
-        # check for mask, adjust accordingly
-        # Check if there are actually masked values in the data
-        var_data = nc_fin[targ_var][:]
-        has_masked_data = numpy.ma.is_masked(var_data) and numpy.ma.count_masked(var_data) > 0
-        has_masked_time_bnds = numpy.ma.is_masked(time_bnds) and numpy.ma.count_masked(time_bnds) > 0
+            if len(window_partials) > window:
+                oldest_path, oldest_accumulators, _, _ = window_partials.popleft()
+                fre_logger.debug('dropping %s from the window', oldest_path)
+                for avg_type in avg_types:
+                    window_sums[avg_type].remove(oldest_accumulators[avg_type])
 
-        fre_logger.debug('has_masked_data = %s, has_masked_time_bnds = %s',
-                         has_masked_data, has_masked_time_bnds)
+            if len(window_partials) == window:
+                window_outfiles = outfiles[file_index - window + 1]
+                template_file = window_partials[0][0]
+                for avg_type in avg_types:
+                    # each group's first time step and time envelope within the window
+                    window_first_records = {}
+                    window_extent = TimeExtent(NUM_TIME_GROUPS[avg_type])
+                    for _, _, file_first_records, file_extents in window_partials:
+                        for group, record in file_first_records[avg_type].items():
+                            window_first_records.setdefault(group, record)
+                        window_extent.merge(file_extents[avg_type])
+                    self.write_product( avg_type = avg_type,
+                                        outfile = window_outfiles[avg_type],
+                                        template_file = template_file,
+                                        targ_var = targ_var,
+                                        accumulator = window_sums[avg_type],
+                                        first_records = window_first_records,
+                                        extent = window_extent,
+                                        time_units = ref_units )
+        return 0
 
-        # (TODO) make this a sep function, make tests, extend
-        # read in sizes of specific axes / compute weights
-        # weights can be encoded as a class member, whose existence
-        # depends on the user specifying unwgt = True, if vect_wgts = None, set the avg
-        # and stddev gen functions to the appropriate behavior (TODO)
-        fin_dims = nc_fin.dimensions
-        num_time_bnds = fin_dims['time'].size
-        if not self.unwgt: #compute sum of weights
-            # Cast to float64 for consistent results across numpy versions (NEP 50 type promotion changes)
-            time_bnds = numpy.asarray(time_bnds, dtype=numpy.float64)
-            # Transpose once to avoid redundant operations
-            time_bnds_transposed = numpy.moveaxis(time_bnds, 0, -1)
-            wgts = time_bnds_transposed[1] - time_bnds_transposed[0]
-            # Use numpy.ma.sum only if there are actually masked values in time_bnds
-            if has_masked_time_bnds:
-                wgts_sum = numpy.ma.sum(wgts, dtype=numpy.float64)
-            else:
-                wgts_sum = numpy.sum(wgts, dtype=numpy.float64)
+    def accumulate(self, infiles = None, targ_var = None, avg_types = None, ref_units = None, held_sums = 0):
+        """
+        stream targ_var from infiles, in the order given, into per-avg_type running sums
+        (and quantile sketches, if percentiles were requested)
+
+        :param infiles: paths to the input files
+        :type infiles: list
+        :param targ_var: name of the variable to average
+        :type targ_var: str
+        :param avg_types: products to accumulate, keys of NUM_TIME_GROUPS
+        :type avg_types: list
+        :param ref_units: time units weights are expressed in, default is the first file's own
+        :type ref_units: str
+        :param held_sums: number of other sets of sums like these the caller keeps, counted against max_memory
+        :type held_sums: int
+        :return: accumulators, sketches, first records and time envelopes, each keyed by avg_type, and the
+                 time units of the weights and envelopes. None if an input file cannot be averaged
+        :rtype: tuple
+        """
+        # read the target variable in bounded slabs, blocked over the non-time axes if need be,
+        # folding each one into running per-cell sums with a single reduction over the time axis.
+        # the sums carry over from one input file to the next, and each time step is
+        # scattered into the sums of its group (e.g. its calendar month), for every avg_type.
+        # the optional statistics are accumulated alongside, merging each slab's into the running ones.
+        # percentiles come from per-cell quantile sketches, fed the same slabs.
+        accumulators = {}
+        sketches = {}
+        # avg_type -> group -> (path, time index) of the group's first time step, for metadata
+        first_records = { avg_type: {} for avg_type in avg_types }
+        extents = { avg_type: TimeExtent(NUM_TIME_GROUPS[avg_type]) for avg_type in avg_types }
+        slab_bytes = DEFAULT_SLAB_BYTES
+        fre_logger.info('computing %s statistics for avg_type(s) %s',
+                        'unweighted' if self.unwgt else 'weighted', avg_types)
+        for path in infiles:
+            with Dataset(path, 'r') as nc_fin:
+                if nc_fin.file_format != 'NETCDF4':
+                    fre_logger.info('input file is not netCDF4 format, is %s', nc_fin.file_format)
+
+                # (TODO) make this a sep function, make tests, extend
+                # check for the variable we're hoping is in the file, and find its time axis
+                if targ_var not in nc_fin.variables:
+                    fre_logger.error('requested variable not found in %s. exit.', path)
+                    return None
+                targ_nc_var = nc_fin[targ_var]
+                time_dim = self.var_time_dim(targ_nc_var)
+                if time_dim is None:
+                    fre_logger.error('requested variable %s has no time dimension. exit.', targ_var)
+                    return None
+                time_axis = targ_nc_var.dimensions.index(time_dim)
+                fre_logger.debug('time_dim = %s, at axis %s of %s', time_dim, time_axis, targ_nc_var.dimensions)
+                reduced_shape = tuple( size for axis, size in enumerate(targ_nc_var.shape) if axis != time_axis )
+
+                if len(accumulators) == 0:
+                    accumulators = { avg_type: TimeAccumulator(reduced_shape, NUM_TIME_GROUPS[avg_type], self.stats)
+                                     for avg_type in avg_types }
+                    if len(self.percentiles) > 0:
+                        sketches = { avg_type: QuantileAccumulator( reduced_shape, NUM_TIME_GROUPS[avg_type],
+                                                                    self.percentiles, self.sketch_size,
+                                                                    targ_nc_var.dtype )
+                                     for avg_type in avg_types }
+                    if ref_units is None:
+                        ref_units = getattr(nc_fin.variables.get(time_dim), 'units', None)
+                    if self.max_memory is not None:
+                        try:
+                            slab_bytes = self.plan_slab_bytes(infiles, targ_var, targ_nc_var.dtype.itemsize,
+                                                              accumulators, sketches, held_sums)
+                        except ValueError as exc:
+                            fre_logger.error('%s. exit.', exc)
+                            return None
+                        fre_logger.info('reading %s of shape %s in slabs of shape %s',
+                                        targ_var, targ_nc_var.shape, slab_shape( targ_nc_var.shape, time_axis,
+                                                                                 targ_nc_var.dtype.itemsize,
+                                                                                 slab_bytes ))
+                elif reduced_shape != accumulators[avg_types[0]].wsum.shape[1:]:
+                    fre_logger.error('shape of %s in %s is %s, expected %s. exit.',
+                                     targ_var, path, reduced_shape, accumulators[avg_types[0]].wsum.shape[1:])
+                    return None
+
+                dates = self.get_time_dates(nc_fin, time_dim) if avg_types != ['all'] else None
+                groups = {}
+                for avg_type in avg_types:
+                    groups[avg_type] = group_time_steps(dates if avg_type != 'all' else
+                                                        range(targ_nc_var.shape[time_axis]), avg_type)
+                    for time_index, group in enumerate(groups[avg_type]):
+                        first_records[avg_type].setdefault(int(group), (path, time_index))
 
-            fre_logger.debug('wgts_sum = %s', wgts_sum)
+                # compute weights. if unweighted, every time step counts the same
+                time_bnds = self.get_time_bounds(nc_fin, time_dim, ref_units)
+                if not self.unwgt:
+                    if time_bnds is None:
+                        fre_logger.error('no time bounds for %s in %s, cannot weight the average. exit.',
+                                         time_dim, path)
+                        return None
+                    wgts = compute_time_weights(time_bnds)
+                    fre_logger.debug('wgts_sum = %s', numpy.sum(wgts, dtype = numpy.float64))
+                else:
+                    wgts = numpy.ones(targ_nc_var.shape[time_axis], dtype = numpy.float64)
+                if time_bnds is not None:
+                    for avg_type in avg_types:
+                        extents[avg_type].update(time_bnds, groups[avg_type])
+
+                for index in iter_slabs(targ_nc_var.shape, time_axis, targ_nc_var.dtype.itemsize, slab_bytes):
+                    region = index[:time_axis] + index[time_axis + 1:]
+                    slab = numpy.moveaxis(targ_nc_var[index], time_axis, 0)
+                    for avg_type in avg_types:
+                        accumulators[avg_type].update( slab, wgts[index[time_axis]], region,
+                                                       groups[avg_type][index[time_axis]] )
+                        if avg_type in sketches:
+                            sketches[avg_type].update( slab, region, groups[avg_type][index[time_axis]] )
+
+        return accumulators, sketches, first_records, extents, ref_units
+
+    def plan_slab_bytes(self, infiles = None, targ_var = None, itemsize = None, accumulators = None,
+                        sketches = None, held_sums = 0):
+        """
+        size slabs of targ_var so that the base process, the running sums, the quantile sketches once
+        every input is folded in, and the buffers of one slab all fit within self.max_memory
 
+        :param infiles: paths to the input files, read for their number of time steps if sketching
+        :type infiles: list
+        :param targ_var: name of the variable to average
+        :type targ_var: str
+        :param itemsize: size in bytes of one element of targ_var
+        :type itemsize: int
+        :param accumulators: freshly created accumulators, keyed by avg_type
+        :type accumulators: dict
+        :param sketches: freshly created quantile accumulators, keyed by avg_type
+        :type sketches: dict
+        :param held_sums: number of other sets of sums like accumulators the caller keeps
+        :type held_sums: int
+        :raises ValueError: max_memory does not cover the base process and the running sums
+        :return: slab size in bytes
+        :rtype: int
+        """
+        resident_bytes = (1 + held_sums) * sum( accumulator.nbytes for accumulator in accumulators.values() )
+        buffers = SLAB_BUFFERS
+        if len(sketches) > 0:
+            count = 0
+            for path in infiles:
+                with Dataset(path, 'r') as nc_fin:
+                    targ_nc_var = nc_fin[targ_var]
+                    count += nc_fin.dimensions[self.var_time_dim(targ_nc_var)].size
+            resident_bytes += sum( sketch.estimate_nbytes(count) for sketch in sketches.values() )
+            buffers += SKETCH_SLAB_BUFFERS
+        slab_bytes = budget_slab_bytes(self.max_memory, resident_bytes, itemsize, buffers)
+        fre_logger.info('max_memory = %s bytes: %s bytes of sums held, slabs of at most %s bytes',
+                        self.max_memory, resident_bytes, slab_bytes)
+        return slab_bytes
+
+    def partials_path(self, outfile = None):
+        """
+        path of the sidecar file holding the running sums behind an output, next to it. the sidecar is
+        hidden and has no .nc suffix, so globs over the outputs, like combine's, never pick it up
 
-        # initialize arrays, is there better practice for reserving the memory necessary
-        # for holding the day? is something that does more write-on-demand possible like
-        # reading data on-demand? (TODO)
-        num_lat_bnds = fin_dims['lat'].size
-        fre_logger.debug('num_lat_bnds = %s', num_lat_bnds)
-        num_lon_bnds = fin_dims['lon'].size
-        fre_logger.debug('num_lon_bnds = %s', num_lon_bnds)
-        # Use masked array only if there's actually masked data
-        if has_masked_data:
-            avgvals = numpy.ma.zeros((1, num_lat_bnds, num_lon_bnds), dtype = float)
+        :param outfile: path of the output, for avg_type 'month' the root of the per-month paths
+        :type outfile: str
+        :return: outfile's directory and .<outfile name without .nc>.partials
+        :rtype: str
+        """
+        outdir, outname = os.path.split(str(outfile))
+        return os.path.join(outdir, f".{outname.removesuffix('.nc')}.partials")
+
+    def write_partials(self, path = None, template_file = None, targ_var = None, avg_type = None,
+                       accumulator = None, first_records = None, input_files = None, ref_units = None,
+                       extent = None):
+        """
+        save the running sums of one avg_type, so a later call with update can extend them.
+        holds, per group and cell: the weighted sum, the sum of weights, the count of valid values and,
+        if accumulated, M2 and the extremes. the request and the time units the weights are in are kept as
+        attributes, the input files already included and each group's first input time step as variables.
+
+        :param path: path of the sidecar file
+        :type path: str
+        :param template_file: input file providing the names of the non-time dimensions
+        :type template_file: str
+        :param targ_var: name of the averaged variable
+        :type targ_var: str
+        :param avg_type: which product the sums are of
+        :type avg_type: str
+        :param accumulator: the running sums
+        :type accumulator: TimeAccumulator
+        :param first_records: group -> (path, time index) of the group's first time step
+        :type first_records: dict
+        :param input_files: absolute paths of the input files the sums include, in time order
+        :type input_files: list
+        :param ref_units: time units the weights and the time envelope are expressed in
+        :type ref_units: str
+        :param extent: per-group time envelope of the sums
+        :type extent: TimeExtent
+        """
+        with Dataset(template_file, 'r') as nc_fin:
+            time_dim = self.var_time_dim(nc_fin[targ_var])
+            dims = [ dim for dim in nc_fin[targ_var].dimensions if dim != time_dim ]
+
+        fre_logger.info('writing partial sums to %s', path)
+        with Dataset(path, 'w', format = 'NETCDF4') as nc_fout:
+            nc_fout.setncatts( { 'var': targ_var,
+                                 'avg_type': avg_type,
+                                 'unwgt': int(bool(self.unwgt)),
+                                 'stats': ','.join(accumulator.stats),
+                                 'weight_units': ref_units if ref_units is not None else '' } )
+            nc_fout.createDimension('input_file', len(input_files))
+            nc_fout.createVariable('input_file', str, ['input_file'])[:] = numpy.array(input_files, dtype = object)
+            nc_fout.createDimension('group', accumulator.wsum.shape[0])
+            for dim, size in zip(dims, accumulator.wsum.shape[1:]):
+                nc_fout.createDimension(dim, size)
+            for name in ['wsum_data', 'wsum', 'count', 'm2', 'minimum', 'maximum']:
+                values = getattr(accumulator, name)
+                if values is not None:
+                    nc_fout.createVariable( name, values.dtype, ['group'] + dims,
+                                            **form_netcdf4_encoding( form_partials_encoding(self.encoding),
+                                                                     values.shape, [0], values.dtype ) )[:] = values
+
+            groups = sorted(first_records)
+            nc_fout.createVariable('first_record_group', 'i4', ['group'])[:len(groups)] = groups
+            nc_fout.createVariable('first_record_file', 'i4', ['group'])[:len(groups)] = \
+                [ input_files.index(os.path.abspath(first_records[group][0])) for group in groups ]
+            nc_fout.createVariable('first_record_time_index', 'i8', ['group'])[:len(groups)] = \
+                [ first_records[group][1] for group in groups ]
+            nc_fout['first_record_group'].num_groups_with_data = len(groups)
+            if extent is not None:
+                for name in ['start', 'end', 'length']:
+                    nc_fout.createVariable(f'time_extent_{name}', 'f8', ['group'])[:] = getattr(extent, name)
+
+    def read_partials(self, path = None, targ_var = None, avg_type = None):
+        """
+        read back running sums saved by write_partials, checking they were made for the same request
+
+        :param path: path of the sidecar file
+        :type path: str
+        :param targ_var: name of the averaged variable
+        :type targ_var: str
+        :param avg_type: which product the sums should be of
+        :type avg_type: str
+        :return: the sums, group -> (path, time index) of each group's first time step, the absolute paths
+                 of the input files included, the time units of the weights and the per-group time envelope.
+                 None if they do not match
+        :rtype: tuple
+        """
+        fre_logger.info('reading partial sums from %s', path)
+        with Dataset(path, 'r') as nc_fin:
+            saved_stats = tuple( stat for stat in nc_fin.stats.split(',') if stat != '' )
+            request = (targ_var, avg_type, int(bool(self.unwgt)), set(self.stats))
+            saved_request = (nc_fin.var, nc_fin.avg_type, int(nc_fin.unwgt), set(saved_stats))
+            if request != saved_request:
+                fre_logger.error('partial sums in %s are of (var, avg_type, unwgt, stats) = %s, not %s. exit.',
+                                 path, saved_request, request)
+                return None
+            accumulator = TimeAccumulator(nc_fin['wsum'].shape[1:], nc_fin['wsum'].shape[0], saved_stats)
+            for name in ['wsum_data', 'wsum', 'count', 'm2', 'minimum', 'maximum']:
+                if getattr(accumulator, name) is not None:
+                    getattr(accumulator, name)[:] = nc_fin[name][:]
+
+            input_files = [ str(path) for path in nc_fin['input_file'][:] ]
+            num_groups_with_data = nc_fin['first_record_group'].num_groups_with_data
+            first_records = { int(group): (input_files[file_index], int(time_index))
+                              for group, file_index, time_index in
+                              zip( nc_fin['first_record_group'][:num_groups_with_data],
+                                   nc_fin['first_record_file'][:num_groups_with_data],
+                                   nc_fin['first_record_time_index'][:num_groups_with_data] ) }
+            ref_units = nc_fin.weight_units if nc_fin.weight_units != '' else None
+            extent = TimeExtent(accumulator.wsum.shape[0])
+            if 'time_extent_start' in nc_fin.variables:
+                for name in ['start', 'end', 'length']:
+                    setattr(extent, name, numpy.ma.getdata(nc_fin[f'time_extent_{name}'][:]).astype(numpy.float64))
+        return accumulator, first_records, input_files, ref_units, extent
+
+    def write_product(self, avg_type = None, outfile = None, template_file = None, targ_var = None,
+                      accumulator = None, first_records = None, sketch = None, extent = None, time_units = None):
+        """
+        write the output file(s) of one avg_type, one output time record per group that had time steps.
+        for 'all', always one.
+
+        :param avg_type: which product to write
+        :type avg_type: str
+        :param outfile: path to the output file, for 'month' the root of the per-month paths
+        :type outfile: str
+        :param template_file: input file providing the output file's metadata
+        :type template_file: str
+        :param targ_var: name of the averaged variable
+        :type targ_var: str
+        :param accumulator: accumulated sums for avg_type
+        :type accumulator: TimeAccumulator
+        :param first_records: group -> (path, time index) of the group's first time step
+        :type first_records: dict
+        :param sketch: quantile sketches for avg_type, if percentiles were requested
+        :type sketch: QuantileAccumulator
+        :param extent: per-group time envelope of the time steps averaged, if known
+        :type extent: TimeExtent
+        :param time_units: time units of extent
+        :type time_units: str
+        """
+        avgvals = accumulator.mean()
+        statvals = { stat: accumulator.statistic(stat) for stat in self.stats }
+        if sketch is not None:
+            rank_error = sketch.rank_error_bound()
+            fre_logger.info('percentiles for avg_type %s have a normalized rank error of at most %s',
+                            avg_type, rank_error)
+            for pct, vals in sketch.percentile().items():
+                statvals[percentile_stat_name(pct)] = vals
+        out_groups = sorted(first_records) if len(first_records) > 0 else [0]
+        fre_logger.debug('avg_type %s groups with time steps: %s', avg_type, out_groups)
+        if avg_type == 'month':
+            outfile_root = str(outfile).removesuffix('.nc')
+            missing_months = [ month for month in range(1, 13) if month - 1 not in out_groups ]
+            if len(missing_months) > 0:
+                fre_logger.warning('no time steps found for month(s) %s, not writing them', missing_months)
+            for group in out_groups:
+                self.write_timavg( outfile = f'{outfile_root}.{group + 1:02d}.nc',
+                                   template_file = template_file,
+                                   targ_var = targ_var,
+                                   avgvals = avgvals[group:group + 1],
+                                   statvals = { stat: vals[group:group + 1] for stat, vals in statvals.items() },
+                                   records = [ first_records.get(group, (template_file, 0)) ],
+                                   extent = self.select_extent(extent, [group]),
+                                   time_units = time_units )
         else:
-            avgvals = numpy.zeros((1, num_lat_bnds, num_lon_bnds), dtype = float)
-
-        # this loop behavior 100% should be re-factored into generator functions.
-        # they should be slightly faster, and much more readable. (TODO)
-        # the average/stddev cpu settings should also be genfunctions, their behavior
-        # (e.g. stddev_pop v stddev_samp) should be set given user inputs. (TODO)
-        # the computations can lean on numpy.stat more- i imagine it's faster (TODO)
-        # parallelism via multiprocessing shouldn't be too bad- explore an alt [dask] too (TODO)
-        # compute average, for each lat/lon coordinate over time record in file
-        if not self.unwgt: #weighted case
-            fre_logger.info('computing weighted statistics')
-            for lat in range(num_lat_bnds):
-                lon_val_array = numpy.moveaxis( nc_fin[targ_var][:], 0, -1)[lat].copy()
-
-                for lon in range(num_lon_bnds):
-                    tim_val_array = lon_val_array[lon].copy()
-                    # Use numpy.ma.sum only if there are actually masked values
-                    if has_masked_data:
-                        avgvals[0][lat][lon] = numpy.ma.sum(tim_val_array * wgts) / wgts_sum
-                    else:
-                        # Use numpy.sum for consistent dtype handling across numpy versions
-                        avgvals[0][lat][lon] = numpy.sum(tim_val_array * wgts, dtype=numpy.float64) / wgts_sum
-
-                    del tim_val_array
-                del lon_val_array
-        else: #unweighted case
-            fre_logger.info('computing unweighted statistics')
-            for lat in range(num_lat_bnds):
-                lon_val_array = numpy.moveaxis( nc_fin[targ_var][:], 0, -1)[lat].copy()
-
-                for lon in range(num_lon_bnds):
-                    tim_val_array = lon_val_array[lon].copy()
-                    # Use numpy.ma.sum only if there are actually masked values
-                    if has_masked_data:
-                        avgvals[0][lat][lon] = numpy.ma.sum(tim_val_array) / num_time_bnds
-                    else:
-                        # Use numpy.sum for consistent dtype handling across numpy versions
-                        avgvals[0][lat][lon] = numpy.sum(tim_val_array, dtype=numpy.float64) / num_time_bnds
-
-                    del tim_val_array
-                del lon_val_array
+            self.write_timavg( outfile = outfile,
+                               template_file = template_file,
+                               targ_var = targ_var,
+                               avgvals = avgvals[out_groups],
+                               statvals = { stat: vals[out_groups] for stat, vals in statvals.items() },
+                               records = [ first_records.get(group, (template_file, 0)) for group in out_groups ],
+                               extent = self.select_extent(extent, out_groups),
+                               time_units = time_units )
 
+    def select_extent(self, extent = None, groups = None):
+        """
+        the time envelopes of the groups written as output records, if every one of them has time steps
 
+        :param extent: per-group time envelope
+        :type extent: TimeExtent
+        :param groups: groups written, in output record order
+        :type groups: list
+        :return: start, end and length of each output record, each of shape (records,). None if not known
+        :rtype: dict
+        """
+        if extent is None or not extent.has_time_steps()[groups].all():
+            return None
+        return { name: getattr(extent, name)[groups] for name in ['start', 'end', 'length'] }
+
+    def get_time_dates(self, nc_fin = None, time_dim = None):
+        """
+        decode the date of each time step of time_dim with cftime, from the midpoints of the
+        time bounds, or from the time values themselves if there are no bounds.
+
+        :param nc_fin: open input dataset
+        :type nc_fin: netCDF4.Dataset
+        :param time_dim: name of the time dimension
+        :type time_dim: str
+        :return: date of each time step
+        :rtype: numpy.ndarray of cftime.datetime
+        """
+        time_var = nc_fin[time_dim]
+        time_bnds_name = getattr(time_var, 'bounds', 'time_bnds')
+        if time_bnds_name in nc_fin.variables:
+            times = numpy.ma.mean( numpy.ma.asarray(nc_fin[time_bnds_name][:], dtype = numpy.float64), axis = 1 )
+        else:
+            times = time_var[:]
+        return cftime.num2date( times, time_var.units, getattr(time_var, 'calendar', 'standard') )
+
+    def write_timavg(self, outfile = None, template_file = None, targ_var = None,
+                     avgvals = None, records = None, statvals = None, extent = None, time_units = None):
+        """
+        write averaged data to a new file, copying dimensions, attributes and the other
+        variables from a template input file, or with self.append to an existing file, adding only what
+        it does not hold yet. the time coordinate, its bounds and the FMS
+        averaging-interval variables are reduced over each record's time steps, static variables
+        are copied in slabs, and time-dependent data variables other than targ_var are left out.
+
+        :param outfile: path to the output file
+        :type outfile: str
+        :param template_file: input file providing the output file's metadata
+        :type template_file: str
+        :param targ_var: name of the averaged variable
+        :type targ_var: str
+        :param avgvals: averaged data, one entry per output time record along the leading axis
+        :type avgvals: numpy.ndarray
+        :param records: (path, time index) of the input time step providing each output record's
+                        values of the other time-dependent variables
+        :type records: list
+        :param statvals: optional statistics keyed by stat, laid out like avgvals, each written to
+                         targ_var with _<stat> appended
+        :type statvals: dict
+        :param extent: start, end and length of the time steps averaged into each output record,
+                       see select_extent. without it, time takes the values of records too
+        :type extent: dict
+        :param time_units: time units of extent
+        :type time_units: str
+        """
+        nc_fin = Dataset(template_file, 'r')
+        nc_fin_vars = nc_fin.variables
+        fin_dims = nc_fin.dimensions
+        time_dim = self.var_time_dim(nc_fin[targ_var])
+        time_axis = nc_fin[targ_var].dimensions.index(time_dim)
+        avgvals = numpy.moveaxis(avgvals, 0, time_axis)
+        statvals = statvals if statvals is not None else {}
+        stat_vars = { f'{targ_var}_{stat}': stat for stat in statvals }
 
         # write output file
         # (TODO) make this a sep function, make tests, extend,
-        # (TODO) consider compression particular;y for NETCDF file writing
+        # compression, chunking and quantization follow self.encoding, see form_variable_encoding
         # consider this approach instead:
         #     with Dataset( outfile, 'w', format = 'NETCDF4', persist = True ) as nc_fout:
-        nc_fout = Dataset( outfile, 'w', format = nc_fin.file_format, persist = True )
+        append = self.append and os.path.exists(outfile)
+        if append:
+            fre_logger.info('appending %s to existing output file %s', targ_var, outfile)
+            nc_fout = Dataset( outfile, 'a' )
+            clashing_vars = [ var for var in [targ_var] + list(stat_vars) if var in nc_fout.variables ]
+            if len(clashing_vars) > 0:
+                nc_fout.close()
+                nc_fin.close()
+                raise ValueError(f'variable(s) {clashing_vars} already in output file {outfile}')
+        else:
+            nc_fout = Dataset( outfile, 'w', format = nc_fin.file_format, persist = True )
 
         # (TODO) make this a sep function, make tests, extend
         # write file global attributes
         fre_logger.info('------- writing output attributes. --------')
         unwritten_ncattr_list = []
         try:
-            nc_fout.setncatts(nc_fin.__dict__) #this copies the global attributes exactly.
+            # when appending, those of the file's first writer are kept, like a merge of per-variable files
+            nc_fout.setncatts({} if append else nc_fin.__dict__) #this copies the global attributes exactly.
         except Exception as exc1: # if the first way doesn't work...
             fre_logger.warning('could not copy ncatts from input file. trying to copy one-by-one')
             fre_logger.warning('exception is = %s', exc1)
@@ -185,15 +843,23 @@ class frepytoolsTimeAverager(timeAverager):
         fre_logger.info('writing output dimensions.')
         unwritten_dims_list = []
         for key in fin_dims:
+            size = len(records) if key == time_dim else fin_dims[key].size
+            if key in nc_fout.dimensions:
+                if len(nc_fout.dimensions[key]) != size:
+                    nc_fout.close()
+                    nc_fin.close()
+                    raise ValueError(f'dimension {key} of size {size} does not match the size '
+                                     f'{len(nc_fout.dimensions[key])} it has in output file {outfile}')
+                continue
             try:
-                if key == 'time':
+                if key == time_dim:
                     # this strongly influences the final data structure shape of the averages.
                     # if set to None, and lets say you try to write
                     # e.g. the original 'time_bnds' (which has 60 time steps)
                     # the array holding the avg. value will suddenly have 60 time steps
                     # even though only 1 is needed, 59 time steps will have no data
                     #nc_fout.createDimension( dimname = key, size = None )
-                    nc_fout.createDimension( dimname = key, size = 1)
+                    nc_fout.createDimension( dimname = key, size = len(records) )
                 else:
                     nc_fout.createDimension( dimname = key, size = fin_dims[key].size )
             except Exception as exc:
@@ -210,34 +876,91 @@ class frepytoolsTimeAverager(timeAverager):
         # but not far from wrong according to CF
         # cell_methods must be changed TO DO
         fre_logger.info('writing data for data %s', targ_var)
-        nc_fout.createVariable(targ_var, nc_fin[targ_var].dtype, nc_fin[targ_var].dimensions)
+        nc_fout.createVariable(targ_var, nc_fin[targ_var].dtype, nc_fin[targ_var].dimensions,
+                               **self.form_variable_encoding(nc_fout, nc_fin[targ_var], time_dim))
         nc_fout.variables[targ_var].setncatts(nc_fin[targ_var].__dict__)
 
         nc_fout.variables[targ_var][:] = avgvals
+
+        # then the other statistics, same layout and metadata but for cell_methods and units
+        for stat_var, stat in stat_vars.items():
+            fre_logger.info('writing data for statistic %s as %s', stat, stat_var)
+            nc_fout.createVariable(stat_var, nc_fin[targ_var].dtype, nc_fin[targ_var].dimensions,
+                                   **self.form_variable_encoding(nc_fout, nc_fin[targ_var], time_dim))
+            nc_fout.variables[stat_var].setncatts(nc_fin[targ_var].__dict__)
+            if stat in STATS:
+                method, description = STATS[stat], STATS[stat].replace('_', ' ')
+            else:
+                # percentiles have no CF cell method of their own, but for the median
+                pct = self.percentiles[ [ percentile_stat_name(pct) for pct in self.percentiles ].index(stat) ]
+                method, description = ('median' if pct == 50. else 'percentile'), f'{pct:g}th percentile'
+                nc_fout.variables[stat_var].percentile = pct
+                nc_fout.variables[stat_var].percentile_sketch_size = self.sketch_size
+            nc_fout.variables[stat_var].cell_methods = \
+                self.form_stat_cell_methods(getattr(nc_fin[targ_var], 'cell_methods', ''), time_dim, method)
+            if stat == 'var' and 'units' in nc_fin[targ_var].ncattrs():
+                nc_fout.variables[stat_var].units = self.form_squared_units(nc_fin[targ_var].units)
+            if 'long_name' in nc_fin[targ_var].ncattrs():
+                nc_fout.variables[stat_var].long_name = f'{description} of {nc_fin[targ_var].long_name}'
+            nc_fout.variables[stat_var][:] = numpy.moveaxis(statvals[stat], 0, time_axis)
         fre_logger.info('DONE writing output variables.')
 
         # (TODO) make this a sep function, make tests, extend
         # write OTHER output variables (aka data) #prev code.
         fre_logger.info('now writing other output variables. ')
+        time_bnds_name = getattr(nc_fin_vars[time_dim], 'bounds', 'time_bnds') if time_dim in nc_fin_vars \
+                         else 'time_bnds'
+        auxiliary_vars = self.get_auxiliary_vars(nc_fin[targ_var])
+        calendar = getattr(nc_fin_vars[time_dim], 'calendar', 'standard') if time_dim in nc_fin_vars \
+                   else 'standard'
+        record_datasets = { template_file: nc_fin }
         unwritten_var_list = []
+        skipped_var_list = []
         unwritten_var_ncattr_dict = {}
         for var in nc_fin_vars:
             if var == targ_var:
                 continue
+            if var in stat_vars:
+                fre_logger.warning('input variable %s clashes with an output statistic, not copying it', var)
+                continue
+            if var in nc_fout.variables:
+                # written along with an earlier variable of the same file
+                continue
+            time_dependent = time_dim in nc_fin[var].dimensions
+            if time_dependent and var not in [time_dim, time_bnds_name] + list(AVERAGE_INTERVAL_VARS) and \
+               var not in auxiliary_vars:
+                # another data variable of a multi-variable input, averaging it is another call's job
+                skipped_var_list.append(var)
+                continue
             fre_logger.info('attempting to create output variable: %s', var)
-            nc_fout.createVariable(var, nc_fin[var].dtype, nc_fin[var].dimensions)
+            nc_fout.createVariable(var, nc_fin[var].dtype, nc_fin[var].dimensions,
+                                   **self.form_variable_encoding(nc_fout, nc_fin[var], time_dim,
+                                                                 data_variable = False))
             nc_fout.variables[var].setncatts(nc_fin[var].__dict__)
             try:
-                nc_fout.variables[var][:] = nc_fin[var][:]
+                if not time_dependent:
+                    self.copy_static_var(nc_fin[var], nc_fout.variables[var])
+                    continue
+                values = self.reduce_time_var( nc_fin[var], time_dim, time_bnds_name, extent,
+                                               time_units, calendar )
+                if values is None:
+                    # take the values at each output record's representative time step
+                    var_time_axis = nc_fin[var].dimensions.index(time_dim)
+                    for path, _ in records:
+                        if path not in record_datasets:
+                            record_datasets[path] = Dataset(path, 'r')
+                    values = numpy.ma.concatenate(
+                        [ self.read_time_record(record_datasets[path], var, var_time_axis, time_index)
+                          for path, time_index in records ], axis = var_time_axis )
+                nc_fout.variables[var][:] = values
             except Exception as exc:
                 fre_logger.warning('shape problem? could not write var = %s', var)
                 fre_logger.warning('exception is = %s', exc)
                 fre_logger.warning('nc_fin[var].shape = %s', nc_fin[var].shape)
+                unwritten_var_list.append(var)
 
-                nc_fout.variables[var][:] = [ nc_fin[var][0] ]
-                fre_logger.warning('time variable? %s',
-                                   self.var_has_time_units( nc_fin.variables[var] ) )
-
+        if len(skipped_var_list)>0:
+            fre_logger.info('time-dependent variables other than %s not copied: %s', targ_var, skipped_var_list)
         if len(unwritten_var_list)>0:
             fre_logger.warning('some variables\' data (%s) was not written.', unwritten_var_list)
 
@@ -251,8 +974,183 @@ class frepytoolsTimeAverager(timeAverager):
         nc_fout.close()
         fre_logger.debug('output file closed')
 
-        fre_logger.debug('closing input file: %s', infile)
+        fre_logger.debug('closing input file(s): %s', list(record_datasets))
+        for path, nc_record in record_datasets.items():
+            if path != template_file:
+                nc_record.close()
         nc_fin.close()
-        fre_logger.debug('input file closed')
+        fre_logger.debug('input file(s) closed')
 
-        return 0
+    def form_variable_encoding(self, nc_fout = None, nc_var = None, time_dim = None, data_variable = True):
+        """
+        createVariable keyword arguments applying self.encoding to an output variable laid out like nc_var.
+        netCDF3 outputs are written without any
+
+        :param nc_fout: output file, with its dimensions already created
+        :type nc_fout: netCDF4.Dataset
+        :param nc_var: input variable the output variable copies the type and dimensions of
+        :type nc_var: netCDF4.Variable
+        :param time_dim: name of the time dimension, chunked one record at a time
+        :type time_dim: str
+        :param data_variable: whether the variable holds averaged data that may be quantized
+        :type data_variable: bool
+        :return: keyword arguments for createVariable
+        :rtype: dict
+        """
+        if not nc_fout.file_format.startswith('NETCDF4'):
+            return {}
+        shape = tuple( nc_fout.dimensions[dim].size for dim in nc_var.dimensions )
+        record_axes = [ axis for axis, dim in enumerate(nc_var.dimensions) if dim == time_dim ]
+        return form_netcdf4_encoding(self.encoding, shape, record_axes, nc_var.dtype, data_variable)
+
+    def get_auxiliary_vars(self, nc_var = None):
+        """
+        names of the variables a data variable refers to through its coordinates, cell_measures and
+        ancillary_variables attributes, and of their bounds
+
+        :param nc_var: data variable
+        :type nc_var: netCDF4.Variable
+        :return: variable names
+        :rtype: set
+        """
+        names = getattr(nc_var, 'coordinates', '').split() + getattr(nc_var, 'ancillary_variables', '').split()
+        # cell_measures is made of 'measure: variable' pairs
+        names += getattr(nc_var, 'cell_measures', '').split()[1::2]
+        variables = nc_var.group().variables
+        return set(names) | { variables[name].bounds for name in names
+                              if name in variables and 'bounds' in variables[name].ncattrs() }
+
+    def copy_static_var(self, nc_var_in = None, nc_var_out = None):
+        """
+        copy a variable without a time dimension, in slabs of at most DEFAULT_SLAB_BYTES
+
+        :param nc_var_in: input variable
+        :type nc_var_in: netCDF4.Variable
+        :param nc_var_out: output variable of the same shape
+        :type nc_var_out: netCDF4.Variable
+        """
+        if nc_var_in.ndim == 0:
+            nc_var_out[:] = nc_var_in[:]
+            return
+        try:
+            itemsize = numpy.dtype(nc_var_in.dtype).itemsize
+        except TypeError:
+            # variable-length types, sized as a pointer
+            itemsize = 8
+        for index in iter_slabs(nc_var_in.shape, 0, itemsize):
+            nc_var_out[index] = nc_var_in[index]
+
+    def reduce_time_var(self, nc_var = None, time_dim = None, time_bnds_name = None, extent = None,
+                        time_units = None, calendar = None):
+        """
+        values of a time-dependent auxiliary variable over each output record's time envelope:
+        time is the midpoint, its bounds the envelope, and average_T1, average_T2 and average_DT
+        the start, end and length of the averaged time steps
+
+        :param nc_var: input variable
+        :type nc_var: netCDF4.Variable
+        :param time_dim: name of the time dimension
+        :type time_dim: str
+        :param time_bnds_name: name of the time bounds variable
+        :type time_bnds_name: str
+        :param extent: start, end and length of each output record, see select_extent
+        :type extent: dict
+        :param time_units: time units of extent
+        :type time_units: str
+        :param calendar: calendar of the time axis
+        :type calendar: str
+        :return: values of each output record, None if nc_var is not one of these or extent is unknown
+        :rtype: numpy.ndarray
+        """
+        if extent is None or nc_var.dimensions[0] != time_dim:
+            return None
+        var_units = getattr(nc_var, 'units', time_units)
+        if nc_var.name == time_dim and nc_var.ndim == 1:
+            midpoint = 0.5 * (extent['start'] + extent['end'])
+            return self.convert_time_values(midpoint, time_units, var_units, calendar)
+        if nc_var.name == time_bnds_name and nc_var.shape[1:] == (2,):
+            envelope = numpy.stack([extent['start'], extent['end']], axis = 1)
+            return self.convert_time_values(envelope, time_units, var_units, calendar)
+        if nc_var.name in AVERAGE_INTERVAL_VARS and nc_var.ndim == 1:
+            values = extent[AVERAGE_INTERVAL_VARS[nc_var.name]]
+            if AVERAGE_INTERVAL_VARS[nc_var.name] != 'length':
+                return self.convert_time_values(values, time_units, var_units, calendar)
+            # a duration, in the unit of time_units, e.g. 'days' of 'days since 0001-01-01'
+            from_unit = str(time_units).split(' ', maxsplit = 1)[0]
+            to_unit = str(var_units).split(' ', maxsplit = 1)[0]
+            if from_unit in SECONDS_PER_TIME_UNIT and to_unit in SECONDS_PER_TIME_UNIT:
+                values = values * SECONDS_PER_TIME_UNIT[from_unit] / SECONDS_PER_TIME_UNIT[to_unit]
+            return values
+        return None
+
+    def convert_time_values(self, values = None, from_units = None, to_units = None, calendar = None):
+        """
+        convert times from one set of units to another, e.g. between two 'days since' reference dates
+
+        :param values: times in from_units
+        :type values: numpy.ndarray
+        :param from_units: units of values
+        :type from_units: str
+        :param to_units: units to convert to
+        :type to_units: str
+        :param calendar: calendar of the times
+        :type calendar: str
+        :return: times in to_units
+        :rtype: numpy.ndarray
+        """
+        if None in [from_units, to_units] or from_units == to_units:
+            return values
+        return cftime.date2num( cftime.num2date(values, from_units, calendar), to_units, calendar )
+
+    def read_time_record(self, nc_fin = None, var = None, time_axis = None, time_index = None):
+        """
+        read one time step of a variable, keeping its time axis
+
+        :param nc_fin: open input dataset
+        :type nc_fin: netCDF4.Dataset
+        :param var: variable name
+        :type var: str
+        :param time_axis: index of the time axis of var
+        :type time_axis: int
+        :param time_index: time step to read
+        :type time_index: int
+        :return: data of shape var.shape, with a time axis of length 1
+        :rtype: numpy.ma.MaskedArray
+        """
+        index = [ slice(None) ] * nc_fin[var].ndim
+        index[time_axis] = slice(time_index, time_index + 1)
+        return nc_fin[var][tuple(index)]
+
+    def form_stat_cell_methods(self, cell_methods = None, time_dim = None, method = None):
+        """
+        cell_methods of a statistic over time: the input's method for time_dim is replaced by method,
+        or method is appended if the input has none for time_dim
+
+        :param cell_methods: cell_methods of the input variable, possibly empty
+        :type cell_methods: str
+        :param time_dim: name of the time dimension
+        :type time_dim: str
+        :param method: CF cell method of the statistic, e.g. 'variance'
+        :type method: str
+        :return: cell_methods of the output statistic
+        :rtype: str
+        """
+        time_method = re.compile(rf'(^|\s){re.escape(time_dim)}:\s*\w+')
+        if time_method.search(cell_methods):
+            return time_method.sub(rf'\g<1>{time_dim}: {method}', cell_methods, count = 1)
+        return f'{cell_methods} {time_dim}: {method}'.strip()
+
+    def form_squared_units(self, units = None):
+        """
+        units of the square of a quantity, e.g. for its variance
+
+        :param units: udunits string of the quantity
+        :type units: str
+        :return: udunits string of its square
+        :rtype: str
+        """
+        if units in ['', '1']:
+            return units
+        if re.fullmatch(r'[A-Za-z_]+', units):
+            return f'{units}2'
+        return f'({units})^2'
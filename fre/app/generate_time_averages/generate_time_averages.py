@@ -2,38 +2,100 @@
 
 import os
 import logging
+import shutil
+import tempfile
 import time
-from typing import Optional, List, Union
+from typing import Dict, Optional, List, Union
 
 from cdo import Cdo
 
 from .cdoTimeAverager import cdoTimeAverager
 from .frenctoolsTimeAverager import frenctoolsTimeAverager
 from .frepytoolsTimeAverager import frepytoolsTimeAverager
+from .output_encoding import form_output_encoding
+from .time_reduction import DEFAULT_SKETCH_SIZE, log_peak_rss, parse_memory_size
 
 fre_logger = logging.getLogger(__name__)
 
+def form_product_outfiles(outfile: str, avg_types: List[str]) -> Dict[str, str]:
+    """
+    form one output path per avg_type from a single output path,
+    e.g. 'out.nc' becomes 'out.all.nc', 'out.seas.nc' and 'out.month.nc'
+
+    :param outfile: path to where output would be stored for a single avg_type
+    :type outfile: str
+    :param avg_types: time scales for averaging
+    :type avg_types: list[str]
+    :return: output path for each avg_type
+    :rtype: dict
+    """
+    outfile_root = str(outfile).removesuffix('.nc')
+    return { avg_type: f'{outfile_root}.{avg_type}.nc' for avg_type in avg_types }
+
 def generate_time_average(infile: Union[str, List[str]] = None,
-                          outfile: str = None,
+                          outfile: Union[str, Dict[str, str]] = None,
                           pkg: str = None,
                           var: Optional[str] = None,
                           unwgt: Optional[bool] = False,
-                          avg_type: Optional[str] = None   ):
+                          avg_type: Optional[Union[str, List[str]]] = None,
+                          stream: Optional[bool] = False,
+                          stats: Optional[List[str]] = None,
+                          percentiles: Optional[List[float]] = None,
+                          sketch_size: Optional[int] = None,
+                          partials: Optional[bool] = False,
+                          update: Optional[bool] = False,
+                          max_memory: Optional[Union[int, str]] = None,
+                          encoding: Optional[dict] = None,
+                          append: Optional[bool] = False ):
     """
     steering function to various averaging functions above
     
     :param infile: path to history file, or list of paths
     :type infile: str, list
-    :param outfile: path to where output file should be stored
-    :type outfile: str
+    :param outfile: path to where output file should be stored. with several avg_types, either a dict of
+                    paths keyed by avg_type, or a single path that form_product_outfiles derives them from
+    :type outfile: str, dict
     :param pkg: which package to use to calculate climatology (cdo, fre-nctools, fre-python-tools)
     :type pkg: str
     :param var: optional, not currently supported and defaults to None
     :type var: str
     :param unwgt: optional, whether or not to weight the data, default False
     :type unwgt: bool
-    :param avg_type: optional, time scale for averaging, accepts ('all','seas','month'). defaults to 'all'
-    :type avg_type: str
+    :param avg_type: optional, time scale for averaging, accepts ('all','seas','month','hour','doy'). defaults to 'all'.
+                     'hour' (diurnal cycle) and 'doy' (day of year) are fre-python-tools only.
+                     a list, or comma-separated string, requests several products at once. fre-python-tools
+                     computes them all from one read of the input, other packages run once per product
+    :type avg_type: str, list
+    :param stream: optional, average a list of input files by streaming through them in time order,
+                   instead of merging them into one file with cdo first. fre-python-tools only, default False
+    :type stream: bool
+    :param stats: optional, statistics to compute besides the average, any of ('var','std','min','max'),
+                  each written as an extra variable <var>_<stat> in the same file. fre-python-tools only
+    :type stats: list
+    :param percentiles: optional, percentiles in [0, 100] to estimate with per-cell quantile sketches in one pass,
+                        written like stats, e.g. 95 as <var>_p95. fre-python-tools only
+    :type percentiles: list
+    :param sketch_size: optional, capacity of each level of the quantile sketches. larger is more accurate,
+                        the worst-case rank error is about 2 * log2(time steps / sketch_size) / sketch_size
+    :type sketch_size: int
+    :param partials: optional, also write the running sums behind each output to a hidden sidecar file next to it,
+                     .<outfile root>.partials, recording the input files they include. fre-python-tools only
+    :type partials: bool
+    :param update: optional, read the sidecar files of an earlier call with partials and merge in only the
+                   input files they do not include yet, e.g. after a run is extended, then rewrite outputs and
+                   sidecars. matches averaging every input again. fre-python-tools only
+    :type update: bool
+    :param max_memory: optional, memory budget of the process, in bytes or e.g. '4G'. slabs of input are
+                       sized from the variable's dtype and shape to stay within it. fre-python-tools only
+    :type max_memory: int, str
+    :param encoding: optional, compression, shuffle, chunking and quantization of the outputs,
+                     see output_encoding.form_output_encoding. fre-python-tools only, which otherwise
+                     writes with DEFAULT_OUTPUT_ENCODING
+    :type encoding: dict
+    :param append: optional, add the averaged variable to output files that already exist instead of
+                   overwriting them, e.g. to gather every variable of a component into one file.
+                   fre-python-tools only, and not with partials
+    :type append: bool
     :return: error message if requested package unknown, otherwise returns climatology
     :rtype: int
     """
@@ -43,19 +105,67 @@ def generate_time_average(infile: Union[str, List[str]] = None,
         raise ValueError('infile, outfile, and pkg are required inputs')
     if pkg not in ['cdo', 'fre-nctools', 'fre-python-tools']:
         raise ValueError(f'argument pkg = {pkg} not known, must be one of: cdo, fre-nctools, fre-python-tools')
+    if stream and pkg != 'fre-python-tools':
+        raise ValueError(f'stream = True is only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if stats and pkg != 'fre-python-tools':
+        raise ValueError(f'stats = {stats} are only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if percentiles and pkg != 'fre-python-tools':
+        raise ValueError(f'percentiles = {percentiles} are only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if (partials or update) and pkg != 'fre-python-tools':
+        raise ValueError(f'partials and update are only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if max_memory is not None and pkg != 'fre-python-tools':
+        raise ValueError(f'max_memory is only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if max_memory is not None:
+        max_memory = parse_memory_size(max_memory)
+    if encoding is not None and pkg != 'fre-python-tools':
+        raise ValueError(f'encoding is only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if append and pkg != 'fre-python-tools':
+        raise ValueError(f'append is only supported by pkg = fre-python-tools, not pkg = {pkg}')
+    if append and (partials or update):
+        raise ValueError('append cannot be combined with partials or update, variables would share a sidecar file')
+    if partials or update:
+        # the sums record which input files they include, so these are streamed rather than merged
+        stream = True
+
+    # several products requested at once
+    if isinstance(avg_type, str) and ',' in avg_type:
+        avg_type = avg_type.split(',')
+    if isinstance(avg_type, (list, tuple)):
+        avg_type = list(avg_type)
+        if not isinstance(outfile, dict):
+            outfile = form_product_outfiles(outfile, avg_type)
+        fre_logger.info('products requested: %s', outfile)
+        if len(avg_type) == 1:
+            outfile = outfile[avg_type[0]]
+            avg_type = avg_type[0]
+        elif pkg != 'fre-python-tools':
+            fre_logger.warning('pkg = %s cannot fuse products, reading input once per avg_type', pkg)
+            exitstatus = 0
+            for single_avg_type in avg_type:
+                exitstatus = max( exitstatus,
+                                  generate_time_average( infile = infile, outfile = outfile[single_avg_type],
+                                                         pkg = pkg, var = var, unwgt = unwgt,
+                                                         avg_type = single_avg_type, stream = stream ) )
+            return exitstatus
+
     exitstatus = 1
     myavger = None
 
     # multiple files case Use cdo to merge multiple files if present
+    # the merged file goes in a private directory, so concurrent calls cannot clobber each other's
+    # pkg = cdo chains the merge into its averaging call instead, without an intermediate file
     merged = False
     orig_infile_list = None
     if all ( [ type(infile).__name__ == 'list',
-               len(infile) > 1 ] ) :
+               len(infile) > 1,
+               not stream,
+               pkg != 'cdo' ] ) :
         fre_logger.info('list input argument detected')
         infile_str = [str(item) for item in infile]
 
         _cdo = Cdo()
-        merged_file = "merged_output.nc"
+        merged_dir = tempfile.mkdtemp(prefix = 'merged_output.', dir = os.getcwd())
+        merged_file = os.path.join(merged_dir, "merged_output.nc")
 
         fre_logger.info('calling cdo mergetime')
         fre_logger.debug('output: %s', merged_file)
@@ -82,7 +192,10 @@ def generate_time_average(infile: Union[str, List[str]] = None,
                                           avg_type = avg_type )
     elif pkg == 'fre-python-tools':
         #fre-python-tools addresses var in a unique way, which is addressed here
-        if merged and var is None:
+        if stream and var is None and type(infile).__name__ == 'list':
+            var = str(infile[0]).split('/').pop().split('.')[-2]
+            fre_logger.info('extracted var = %s from infile[0] = %s', var, infile[0])
+        elif merged and var is None:
             fre_logger.warning('special variable id logic underway...')
             var = orig_infile_list[0].split('/').pop().split('.')[-2]
             fre_logger.warning('extracted var = %s from orig_infile_list[0] = %s', var, orig_infile_list[0] )
@@ -91,7 +204,16 @@ def generate_time_average(infile: Union[str, List[str]] = None,
         myavger = frepytoolsTimeAverager( pkg = pkg,
                                           var = var,
                                           unwgt = unwgt,
-                                          avg_type = avg_type )
+                                          avg_type = avg_type,
+                                          stats = stats,
+                                          percentiles = percentiles,
+                                          sketch_size = sketch_size if sketch_size is not None else
+                                                        DEFAULT_SKETCH_SIZE,
+                                          save_partials = partials,
+                                          update = update,
+                                          max_memory = max_memory,
+                                          encoding = encoding,
+                                          append = append )
 
     # workload
     if myavger is not None:
@@ -104,9 +226,95 @@ def generate_time_average(infile: Union[str, List[str]] = None,
     # remove the new merged file if we created it.
     if merged:
         fre_logger.warning('removing merged_file = %s', merged_file)
-        os.remove(merged_file)
+        shutil.rmtree(merged_dir)
 
     fre_logger.debug('generate_time_average call finished')
+    log_peak_rss(max_memory)
+    fre_logger.info('Finished in total time %s second(s)', round(time.perf_counter() - start_time , 2))
+    return exitstatus
+
+def generate_sliding_time_averages(infile: List[str] = None,
+                                   outfile: List[Union[str, Dict[str, str]]] = None,
+                                   window: int = None,
+                                   pkg: str = None,
+                                   var: Optional[str] = None,
+                                   unwgt: Optional[bool] = False,
+                                   avg_type: Optional[Union[str, List[str]]] = None,
+                                   stats: Optional[List[str]] = None,
+                                   max_memory: Optional[Union[int, str]] = None,
+                                   encoding: Optional[dict] = None,
+                                   append: Optional[bool] = False ) -> int:
+    """
+    time averages over sliding windows of consecutive input files, e.g. overlapping 5-year
+    climatologies from yearly timeseries, window i averaging infile[i:i + window] into outfile[i].
+    fre-python-tools reads each input file once, building each window from the last by adding the newest
+    file's partial sums and dropping the oldest's. other packages average each window from scratch.
+
+    :param infile: paths to the input files in time order, one per window step
+    :type infile: list
+    :param outfile: output path(s) of each window, len(infile) - window + 1 of them. with several avg_types,
+                    each a dict of paths keyed by avg_type
+    :type outfile: list
+    :param window: number of consecutive input files per window
+    :type window: int
+    :param pkg: which package to use to calculate climatology (cdo, fre-nctools, fre-python-tools)
+    :type pkg: str
+    :param var: optional, variable to average, default from the bronx file name
+    :type var: str
+    :param unwgt: optional, whether or not to weight the data, default False
+    :type unwgt: bool
+    :param avg_type: optional, time scale(s) for averaging, see generate_time_average
+    :type avg_type: str, list
+    :param stats: optional, 'var' and/or 'std' to compute besides the average. fre-python-tools only
+    :type stats: list
+    :param max_memory: optional, memory budget of the process, see generate_time_average. fre-python-tools only
+    :type max_memory: int, str
+    :param encoding: optional, output encoding, see generate_time_average. fre-python-tools only
+    :type encoding: dict
+    :param append: optional, add to existing output files, see generate_time_average. fre-python-tools only
+    :type append: bool
+    :raises ValueError: window does not fit the inputs and outputs
+    :return: 0 if every window was averaged, non-zero otherwise
+    :rtype: int
+    """
+    if window is None or not 0 < window <= len(infile) or len(outfile) != len(infile) - window + 1:
+        raise ValueError(f'window = {window} files does not fit {len(infile)} input files '
+                         f'and {len(outfile)} output windows')
+    if isinstance(avg_type, str) and ',' in avg_type:
+        avg_type = avg_type.split(',')
+
+    if pkg != 'fre-python-tools' or len(outfile) == 1:
+        exitstatus = 0
+        for window_start, window_outfile in enumerate(outfile):
+            exitstatus = max( exitstatus,
+                              generate_time_average( infile = infile[window_start:window_start + window],
+                                                     outfile = window_outfile, pkg = pkg, var = var,
+                                                     unwgt = unwgt, avg_type = avg_type,
+                                                     stream = pkg == 'fre-python-tools', stats = stats,
+                                                     max_memory = max_memory, encoding = encoding,
+                                                     append = append ) )
+        return exitstatus
+
+    start_time = time.perf_counter()
+    if var is None:
+        var = str(infile[0]).split('/').pop().split('.')[-2]
+        fre_logger.info('extracted var = %s from infile[0] = %s', var, infile[0])
+    if isinstance(avg_type, (list, tuple)) and len(avg_type) > 1:
+        outfile = [ window_outfile if isinstance(window_outfile, dict) else
+                    form_product_outfiles(window_outfile, avg_type) for window_outfile in outfile ]
+    fre_logger.info('creating a frepytoolsTimeAverager')
+    myavger = frepytoolsTimeAverager( pkg = pkg,
+                                      var = var,
+                                      unwgt = unwgt,
+                                      avg_type = avg_type,
+                                      stats = stats,
+                                      max_memory = parse_memory_size(max_memory) if max_memory is not None else None,
+                                      encoding = encoding,
+                                      append = append )
+    exitstatus = myavger.generate_sliding_timavg( infile = infile,
+                                                  outfile = outfile,
+                                                  window = window )
+    log_peak_rss(myavger.max_memory)
     fre_logger.info('Finished in total time %s second(s)', round(time.perf_counter() - start_time , 2))
     return exitstatus
 
@@ -115,12 +323,45 @@ def generate(inf = None,
              pkg = None,
              var = None,
              unwgt= False,
-             avg_type = None  ):
+             avg_type = None,
+             stream = False,
+             stats = None,
+             percentiles = None,
+             sketch_size = None,
+             partials = False,
+             update = False,
+             max_memory = None,
+             yamlfile = None,
+             compression = None,
+             complevel = None,
+             shuffle = None,
+             chunking = None,
+             significant_digits = None ):
     ''' click entrypoint to time averaging routine '''
+    # the output encoding is only resolved if asked for, so that other packages are not handed one
+    encoding = None
+    if any( option is not None for option in [yamlfile, compression, complevel, shuffle,
+                                                chunking, significant_digits] ):
+        encoding = form_output_encoding( yamlfile, compression = compression, complevel = complevel,
+                                         shuffle = shuffle, chunking = chunking,
+                                         significant_digits = significant_digits )
+    # click hands over a tuple of one or more input files, and of one or more avg_types
+    if isinstance(inf, tuple):
+        inf = inf[0] if len(inf) == 1 else list(inf)
+    if isinstance(avg_type, tuple):
+        avg_type = avg_type[0] if len(avg_type) == 1 else list(avg_type)
     exitstatus = generate_time_average( inf, outf,
                                         pkg, var,
                                         unwgt,
-                                        avg_type)
+                                        avg_type,
+                                        stream,
+                                        list(stats) if stats else None,
+                                        list(percentiles) if percentiles else None,
+                                        sketch_size,
+                                        partials,
+                                        update,
+                                        max_memory,
+                                        encoding )
     if exitstatus!=0:
         fre_logger.warning('time averaging exited non-zero, exitstatus == %s', exitstatus)
     else:
@@ -0,0 +1,172 @@
+''' netCDF output encoding (compression, shuffle, chunking, quantization) of time-average outputs '''
+
+import logging
+from typing import Optional
+
+import numpy
+import yaml
+
+fre_logger = logging.getLogger(__name__)
+
+# default encoding, overridden by yaml['postprocess']['settings']['output_encoding'], then by arguments.
+# 'slice' chunking fits readers pulling whole 2-D (horizontal) slices: one time step and one level per chunk.
+# significant_digits, if set, quantizes data variables (not coordinates) before compression, and is lossy
+DEFAULT_OUTPUT_ENCODING = { 'compression': 'zlib',
+                            'complevel': 4,
+                            'shuffle': True,
+                            'chunking': 'slice',
+                            'significant_digits': None }
+
+# compressors netCDF4 can write, None writes uncompressed. netCDF4 only shuffles ahead of zlib
+COMPRESSIONS = [None, 'zlib', 'zstd']
+
+# 'auto' leaves chunking to the netCDF library
+CHUNKINGS = ['slice', 'auto']
+
+# upper bound on one 'slice' chunk, larger horizontal slices are split along their slowest axis
+MAX_CHUNK_BYTES = 16 * 1024 * 1024
+
+# encoding keys of variables read by xarray that form_xarray_encoding replaces or that cannot be written back
+XARRAY_DROPPED_ENCODING = [ 'zlib', 'szip', 'zstd', 'bzip2', 'blosc', 'complevel', 'compression', 'shuffle',
+                            'chunksizes', 'contiguous', 'significant_digits', 'quantize_mode', 'preferred_chunks',
+                            'source', 'original_shape', 'szip_coding', 'szip_pixels_per_block', 'blosc_shuffle' ]
+
+def form_output_encoding(yamlfile: Optional[str] = None, **overrides) -> dict:
+    """
+    resolve the output encoding: DEFAULT_OUTPUT_ENCODING, updated with the output_encoding section of
+    yaml['postprocess']['settings'] if a yaml file is given, updated with any overrides that are not None.
+    compression may also be given as 'none'.
+
+    :param yamlfile: optional, path to the (combined) post-processing yaml
+    :type yamlfile: str
+    :param overrides: compression, complevel, shuffle, chunking or significant_digits
+    :type overrides: dict
+    :raises ValueError: unknown encoding key or value
+    :return: encoding with every key of DEFAULT_OUTPUT_ENCODING
+    :rtype: dict
+    """
+    encoding = dict(DEFAULT_OUTPUT_ENCODING)
+    if yamlfile is not None:
+        with open(yamlfile, 'r', encoding = 'utf-8') as openedfile:
+            yamldict = yaml.safe_load(openedfile)
+        settings = ( (yamldict or {}).get('postprocess') or {} ).get('settings') or {}
+        yaml_encoding = settings.get('output_encoding') or {}
+        fre_logger.debug('output_encoding from %s: %s', yamlfile, yaml_encoding)
+        encoding.update(yaml_encoding)
+    encoding.update({ key: value for key, value in overrides.items() if value is not None })
+
+    unknown_keys = [ key for key in encoding if key not in DEFAULT_OUTPUT_ENCODING ]
+    if len(unknown_keys) > 0:
+        raise ValueError(f'output encoding key(s) {unknown_keys} not known, must be one of '
+                         f'{list(DEFAULT_OUTPUT_ENCODING)}')
+    if str(encoding['compression']).lower() == 'none':
+        encoding['compression'] = None
+    if encoding['compression'] not in COMPRESSIONS:
+        raise ValueError(f'compression = {encoding["compression"]} not known, must be one of {COMPRESSIONS}')
+    if encoding['chunking'] not in CHUNKINGS:
+        raise ValueError(f'chunking = {encoding["chunking"]} not known, must be one of {CHUNKINGS}')
+    fre_logger.info('output encoding: %s', encoding)
+    return encoding
+
+
+def form_chunk_shape(shape: tuple, record_axes: list, itemsize: int) -> tuple:
+    """
+    'slice' chunk shape of a variable: the last two (horizontal) axes whole, every other axis 1,
+    split along the slower horizontal axis if one slice exceeds MAX_CHUNK_BYTES.
+    1-D variables are a single chunk. record axes, e.g. time, are always chunked one record at a time
+
+    :param shape: shape of the variable
+    :type shape: tuple
+    :param record_axes: indices of the record (e.g. time) axes
+    :type record_axes: list
+    :param itemsize: size in bytes of one element of the variable
+    :type itemsize: int
+    :return: chunk shape, at least 1 along every axis
+    :rtype: tuple
+    """
+    num_slice_axes = 2 if len(shape) > 1 else 1
+    chunks = [ 1 if axis < len(shape) - num_slice_axes or axis in record_axes else max(1, size)
+               for axis, size in enumerate(shape) ]
+    if num_slice_axes == 2 and len(shape) - 2 not in record_axes:
+        row_bytes = max(1, chunks[-1] * itemsize)
+        chunks[-2] = max(1, min(chunks[-2], MAX_CHUNK_BYTES // row_bytes))
+    return tuple(chunks)
+
+
+def form_netcdf4_encoding(encoding: dict, shape: tuple, record_axes: list, dtype,
+                          data_variable: bool = True) -> dict:
+    """
+    keyword arguments of netCDF4.Dataset.createVariable for one variable
+
+    :param encoding: output encoding, see form_output_encoding
+    :type encoding: dict
+    :param shape: shape of the variable as it will be written
+    :type shape: tuple
+    :param record_axes: indices of the record (e.g. time) axes
+    :type record_axes: list
+    :param dtype: type of the variable
+    :type dtype: numpy.dtype
+    :param data_variable: whether the variable holds data, rather than coordinates or bounds,
+                          only data is quantized
+    :type data_variable: bool
+    :return: createVariable keyword arguments, empty for scalars and strings
+    :rtype: dict
+    """
+    try:
+        dtype = numpy.dtype(dtype)
+    except TypeError:
+        # variable-length and compound netCDF types
+        return {}
+    if encoding is None or len(shape) == 0 or dtype.kind not in 'biuf':
+        return {}
+    kwargs = {}
+    if encoding['compression'] is not None:
+        kwargs['compression'] = encoding['compression']
+        kwargs['complevel'] = encoding['complevel']
+        kwargs['shuffle'] = encoding['shuffle']
+    if encoding['chunking'] == 'slice':
+        kwargs['chunksizes'] = form_chunk_shape(shape, record_axes, dtype.itemsize)
+    if data_variable and encoding['significant_digits'] is not None and dtype.kind == 'f':
+        kwargs['significant_digits'] = encoding['significant_digits']
+    return kwargs
+
+
+def form_xarray_encoding(encoding: dict, dataset, unlimited_dims: list) -> dict:
+    """
+    to_netcdf encoding of every variable of an xarray Dataset, keeping what each variable's own
+    encoding says about its type, fill value and time units
+
+    :param encoding: output encoding, see form_output_encoding
+    :type encoding: dict
+    :param dataset: dataset to be written
+    :type dataset: xarray.Dataset
+    :param unlimited_dims: names of the dimensions to be written as unlimited
+    :type unlimited_dims: list
+    :return: per-variable encoding, for to_netcdf
+    :rtype: dict
+    """
+    bounds = { variable.attrs.get('bounds', variable.encoding.get('bounds'))
+               for variable in dataset.variables.values() }
+    xarray_encoding = {}
+    for name, variable in dataset.variables.items():
+        var_encoding = { key: value for key, value in variable.encoding.items()
+                         if key not in XARRAY_DROPPED_ENCODING }
+        record_axes = [ axis for axis, dim in enumerate(variable.dims) if dim in unlimited_dims ]
+        dtype = var_encoding.get('dtype', variable.dtype)
+        var_encoding.update( form_netcdf4_encoding( encoding, variable.shape, record_axes, dtype,
+                                                    data_variable = name in dataset.data_vars and
+                                                                    name not in bounds ) )
+        xarray_encoding[name] = var_encoding
+    return xarray_encoding
+
+
+def form_partials_encoding(encoding: dict) -> dict:
+    """
+    lossless version of an output encoding, for sums that must be read back exactly
+
+    :param encoding: output encoding, see form_output_encoding
+    :type encoding: dict
+    :return: the same encoding without quantization
+    :rtype: dict
+    """
+    return { **encoding, 'significant_digits': None } if encoding is not None else None
@@ -0,0 +1,59 @@
+''' tests for the time-averaging benchmarks '''
+
+import json
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from .. import benchmark
+
+SMALL_CONFIG = { 'nx': 4, 'ny': 3, 'levels': 2, 'time_steps': 24, 'num_files': 2, 'mask_frac': 0.1 }
+
+
+def test_synthetic_inputs(tmp_path):
+    ''' the timeseries files split the history file's time steps between them '''
+    config = { **benchmark.DEFAULT_BENCHMARK_CONFIG, **SMALL_CONFIG, 'tiles': 6 }
+    inputs = benchmark.write_synthetic_inputs(tmp_path, config)
+    assert len(inputs['timeseries']) == 2
+
+    with Dataset(inputs['history']) as nc_history:
+        assert nc_history['tas'].dimensions == ('time', 'pfull', 'tile', 'grid_yt', 'grid_xt')
+        assert nc_history['tas'].shape == (24, 2, 6, 3, 4)
+        assert 0. < np.ma.count_masked(nc_history['tas'][:]) / nc_history['tas'].size < 0.2
+        time_bnds = nc_history['time_bnds'][:]
+    # calendar months of a noleap year
+    assert np.allclose(np.diff(time_bnds[:12], axis = 1)[:, 0], [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    with Dataset(inputs['timeseries'][1]) as nc_timeseries:
+        assert np.allclose(nc_timeseries['time_bnds'][:], time_bnds[12:])
+
+
+def test_run_and_compare_benchmarks(tmp_path):
+    ''' every supported avg_type of the python backend is measured, and slowdowns are caught against a baseline '''
+    results = benchmark.run_benchmarks(tmp_path / 'work', tmp_path / 'results.json', SMALL_CONFIG,
+                                       backends = ['fre-python-tools'], avg_types = ['all', 'month'])
+    cases = { (result['input'], result['avg_type']): result for result in results['results'] }
+    assert set(cases) == { (input_kind, avg_type) for input_kind in ['history', 'timeseries']
+                           for avg_type in ['all', 'month'] }
+    for result in cases.values():
+        assert result['exitstatus'] == 0
+        assert result['wall_seconds'] > 0 and result['peak_rss_bytes'] > 0
+        if result['bytes_read'] is not None:
+            assert result['bytes_read'] > 0 and result['bytes_written'] > 0
+    assert not (tmp_path / 'work' / 'outputs').exists()
+
+    assert benchmark.compare_benchmarks(tmp_path / 'results.json', tmp_path / 'results.json') == []
+    for result in results['results']:
+        result['wall_seconds'] /= 2.
+    with open(tmp_path / 'baseline.json', 'w', encoding = 'utf-8') as baseline_file:
+        json.dump(results, baseline_file)
+    regressions = benchmark.compare_benchmarks(tmp_path / 'results.json', tmp_path / 'baseline.json')
+    assert len(regressions) == 4
+    assert all( regression['metric'] == 'wall_seconds' for regression in regressions )
+
+
+def test_unknown_backend():
+    ''' asking for a backend that does not exist is an error, missing executables only skip it '''
+    with pytest.raises(ValueError):
+        benchmark.available_backends(['FOO'])
+    assert 'fre-python-tools' in benchmark.available_backends()
@@ -10,3 +10,17 @@ def test_cdotimavg_init_error():
         test_avgr = cdo_timavg.cdoTimeAverager(pkg = 'cdo', var = None, unwgt = False, avg_type = 'FOO')
         test_avgr.generate_timavg(infile = None,
                                   outfile = None)
+
+@pytest.mark.parametrize("infile,operators,var,expected",
+                         [ pytest.param( 'a.nc', (), None, 'a.nc' ),
+                           pytest.param( ['a.nc'], ('timsum', 'muldpm'), None, '-timsum -muldpm a.nc' ),
+                           pytest.param( ['a.nc', 'b.nc'], ('timsum', 'muldpm'), 'tas',
+                                         '-timsum -muldpm -selname,tas -mergetime a.nc b.nc' ) ])
+def test_form_cdo_chain(infile, operators, var, expected):
+    ''' merge, select and averaging operators are chained into one cdo input, outermost first '''
+    assert cdo_timavg.form_cdo_chain(infile, operators, var) == expected
+
+def test_form_cdo_chain_no_input():
+    ''' an empty input list is an error rather than a chain without inputs '''
+    with pytest.raises(ValueError):
+        cdo_timavg.form_cdo_chain([])
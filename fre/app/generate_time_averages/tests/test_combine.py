@@ -3,9 +3,15 @@
 import subprocess
 from pathlib import Path
 
+import numpy as np
 import pytest
+from netCDF4 import Dataset
 
 from fre.app.generate_time_averages import combine
+from fre.app.generate_time_averages import generate_time_averages as gtas
+from fre.app.generate_time_averages.time_reduction import BASE_PROCESS_BYTES
+
+from .test_frepytoolsTimeAverager import write_history_file
 
 @pytest.fixture()
 def create_annual_per_variable_climatologies(tmp_path):
@@ -142,3 +148,58 @@ def test_freq_not_valid_valueerror():
             begin = 0, end = 1,
             interval = 'P999Y',
             frequency = 'FOO' )
+
+def test_form_merge_chunks(tmp_path):
+    """
+    Chunks fit the budget for every variable, shared dimensions take the smallest chunk,
+    and unlimited dimensions are chunked first
+    """
+    input_file = tmp_path / 'atmos.1980-1981.tas.nc'
+    with Dataset(input_file, 'w') as nc_out:
+        nc_out.createDimension('time', None)
+        nc_out.createDimension('lat', 100)
+        nc_out.createDimension('lon', 200)
+        nc_out.createVariable('tas', 'f8', ('time', 'lat', 'lon'))[:] = np.zeros((4, 100, 200))
+        nc_out.createVariable('lon', 'f4', ('lon',))[:] = np.arange(200)
+    chunks = combine.form_merge_chunks([str(input_file)], BASE_PROCESS_BYTES + 2 * 8 * 1000)
+    assert chunks == {'time': 1, 'lat': 5, 'lon': 200}
+
+def test_publish_file(tmp_path):
+    """
+    Publishing replaces any earlier file of the same name, hard-linked on the same filesystem,
+    and leaves no temporary file behind
+    """
+    source_file = tmp_path / 'atmos.1980-1981.nc'
+    source_file.write_text('new')
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    (outdir / 'atmos.1980-1981.nc').write_text('old')
+
+    target = combine.publish_file(str(source_file), str(outdir))
+    assert target == outdir / 'atmos.1980-1981.nc'
+    assert target.read_text() == 'new'
+    assert target.samefile(source_file)
+    assert list(outdir.iterdir()) == [target]
+
+def test_combine_skips_partials_sidecar(tmp_path):
+    """
+    The partial sums sidecar saved next to a per-variable climatology is not merged into the component file
+    """
+    in_dir = tmp_path / 'in' / 'atmos'
+    av_dir = in_dir / 'P1Y' / 'P2Y'
+    av_dir.mkdir(parents=True)
+    month_lengths = [31., 28., 31., 30., 31., 30., 31., 31., 30., 31., 30., 31.]
+    for var in ['tas', 'pr']:
+        write_history_file(tmp_path / f'atmos.198001-198112.{var}.nc', var = var,
+                           time_edges = np.cumsum([0.] + month_lengths * 2))
+        assert gtas.generate_time_average( infile = str(tmp_path / f'atmos.198001-198112.{var}.nc'),
+                                           outfile = str(av_dir / f'atmos.1980-1981.{var}.nc'),
+                                           pkg = 'fre-python-tools', var = var, avg_type = 'all',
+                                           partials = True ) == 0
+    assert len(list(av_dir.glob('.*.partials'))) == 2
+
+    combine.combine(in_dir, tmp_path / 'out', 'atmos', 1980, 1981, 'yr', 'P2Y')
+
+    with Dataset(tmp_path / 'out' / 'atmos' / 'av' / 'annual_2yr' / 'atmos.1980-1981.nc') as nc_out:
+        assert {'tas', 'pr'} <= set(nc_out.variables)
+        assert not {'wsum_data', 'wsum', 'count', 'input_file'} & set(nc_out.variables)
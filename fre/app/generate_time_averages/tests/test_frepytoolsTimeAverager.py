@@ -0,0 +1,420 @@
+''' tests for the frepytoolsTimeAverager class specifically '''
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from .. import frepytoolsTimeAverager as frepy_timavg
+from .. import generate_time_averages as gtas
+from ..output_encoding import form_output_encoding
+from ..time_reduction import BASE_PROCESS_BYTES
+
+
+def write_history_file(path: Path,
+                       var: str = 'tas',
+                       spatial_dims: tuple = (('lat', 3), ('lon', 4)),
+                       time_dim: str = 'time',
+                       time_edges: np.ndarray = None,
+                       calendar: str = 'noleap',
+                       time_units: str = 'days since 0001-01-01 00:00:00',
+                       mask_frac: float = 0.,
+                       seed: int = 0) -> np.ma.MaskedArray:
+    '''
+    write a small history-like netCDF file with a time-dimensioned variable and its time bounds.
+    time_edges are in time_units, consecutive pairs forming each time step's bounds.
+    returns the data written to var.
+    '''
+    if time_edges is None:
+        time_edges = np.cumsum([0.] + [31., 28., 31., 30., 31., 30., 31., 31., 30., 31., 30., 31.])
+    num_times = len(time_edges) - 1
+    rng = np.random.default_rng(seed)
+    shape = (num_times,) + tuple(size for _, size in spatial_dims)
+    data = np.ma.masked_array(rng.random(shape).astype(np.float32) * 100.,
+                              mask = rng.random(shape) < mask_frac)
+
+    with Dataset(path, 'w', format = 'NETCDF4') as nc_out:
+        nc_out.title = 'synthetic test data'
+        nc_out.createDimension(time_dim, None)
+        nc_out.createDimension('bnds', 2)
+        for dim, size in spatial_dims:
+            nc_out.createDimension(dim, size)
+            nc_out.createVariable(dim, 'f8', (dim,))[:] = np.arange(size)
+
+        time_var = nc_out.createVariable(time_dim, 'f8', (time_dim,))
+        time_var.units = time_units
+        time_var.calendar = calendar
+        time_var.axis = 'T'
+        time_var.bounds = f'{time_dim}_bnds'
+        time_var[:] = 0.5 * (time_edges[:-1] + time_edges[1:])
+        time_bnds_var = nc_out.createVariable(f'{time_dim}_bnds', 'f8', (time_dim, 'bnds'))
+        time_bnds_var.units = time_var.units
+        time_bnds_var[:] = np.stack([time_edges[:-1], time_edges[1:]], axis = 1)
+
+        data_var = nc_out.createVariable(var, 'f4', (time_dim,) + tuple(dim for dim, _ in spatial_dims),
+                                         fill_value = np.float32(1.e20))
+        data_var.units = 'K'
+        data_var.cell_methods = 'time: mean'
+        data_var[:] = data
+    return data
+
+
+def run_averager(infile, outfile, unwgt = False, avg_type = 'all', var = 'tas'):
+    ''' run the python-native averager, asserting a clean exit '''
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = var,
+                                                   unwgt = unwgt, avg_type = avg_type)
+    infile = [ str(path) for path in infile ] if isinstance(infile, list) else str(infile)
+    assert averager.generate_timavg(infile = infile, outfile = str(outfile)) == 0
+
+
+@pytest.mark.parametrize("spatial_dims,time_dim",
+                         [ pytest.param( (('lat', 3), ('lon', 4)), 'time' ),
+                           pytest.param( (('pfull', 5), ('lat', 3), ('lon', 4)), 'time' ),
+                           pytest.param( (('tile', 2), ('grid_yt', 3), ('grid_xt', 3)), 'time' ),
+                           pytest.param( (('z_l', 4), ('yh', 2), ('xh', 3)), 'Time' ) ])
+@pytest.mark.parametrize("unwgt", [False, True])
+def test_nd_weighted_average(tmp_path, spatial_dims, time_dim, unwgt):
+    ''' any N-D variable is reduced along its time dimension, whatever the dimension names '''
+    infile = tmp_path / 'in.nc'
+    data = write_history_file(infile, spatial_dims = spatial_dims, time_dim = time_dim, mask_frac = 0.2)
+    outfile = tmp_path / 'out.nc'
+    run_averager(infile, outfile, unwgt = unwgt)
+
+    with Dataset(infile) as nc_in:
+        time_bnds = nc_in[f'{time_dim}_bnds'][:]
+    wgts = np.ones(len(time_bnds)) if unwgt else time_bnds[:, 1] - time_bnds[:, 0]
+    expected = np.ma.average(data.astype(np.float64), axis = 0, weights = wgts)
+
+    with Dataset(outfile) as nc_out:
+        assert nc_out.dimensions[time_dim].size == 1
+        result = nc_out['tas'][:]
+    assert result.shape == (1,) + data.shape[1:]
+    assert np.ma.allclose(result[0], expected, rtol = 1.e-6)
+
+
+def test_missing_variable_exits_nonzero(tmp_path):
+    ''' asking for a variable not in the file is an error '''
+    infile = tmp_path / 'in.nc'
+    write_history_file(infile)
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'DNE',
+                                                   unwgt = False, avg_type = 'all')
+    assert averager.generate_timavg(infile = str(infile), outfile = str(tmp_path / 'out.nc')) == 1
+
+
+def test_multi_file_stream_matches_single_file(tmp_path):
+    ''' streaming over files given out of order, in differing time units, matches one concatenated file '''
+    month_lengths = [31., 28., 31., 30., 31., 30., 31., 31., 30., 31., 30., 31.]
+    edges = np.cumsum([0.] + month_lengths * 3)
+    first = write_history_file(tmp_path / 'atmos.000101-000112.tas.nc', time_edges = edges[:13],
+                               mask_frac = 0.1, seed = 1)
+    second = write_history_file(tmp_path / 'atmos.000201-000212.tas.nc', time_edges = edges[12:25] * 24.,
+                                time_units = 'hours since 0001-01-01 00:00:00', mask_frac = 0.1, seed = 2)
+    third = write_history_file(tmp_path / 'atmos.000301-000312.tas.nc', time_edges = edges[24:],
+                               mask_frac = 0.1, seed = 3)
+    write_history_file(tmp_path / 'atmos.000101-000312.tas.nc', time_edges = edges)
+    with Dataset(tmp_path / 'atmos.000101-000312.tas.nc', 'a') as nc_all:
+        nc_all['tas'][:] = np.ma.concatenate([first, second, third])
+
+    run_averager(tmp_path / 'atmos.000101-000312.tas.nc', tmp_path / 'single.nc')
+    run_averager([ tmp_path / 'atmos.000301-000312.tas.nc',
+                   tmp_path / 'atmos.000101-000112.tas.nc',
+                   tmp_path / 'atmos.000201-000212.tas.nc' ], tmp_path / 'stream.nc')
+
+    with Dataset(tmp_path / 'single.nc') as nc_single, Dataset(tmp_path / 'stream.nc') as nc_stream:
+        assert np.ma.allclose(nc_single['tas'][:], nc_stream['tas'][:], rtol = 1.e-6)
+        assert nc_stream['time'][:] == nc_single['time'][:]
+
+
+MONTH_LENGTHS = [31., 28., 31., 30., 31., 30., 31., 31., 30., 31., 30., 31.]
+
+@pytest.mark.parametrize("unwgt", [False, True])
+def test_monthly_climatology(tmp_path, unwgt):
+    ''' avg_type = month writes one file per calendar month, averaging that month across years '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 3)
+    data = write_history_file(tmp_path / 'atmos.000101-000312.tas.nc', time_edges = edges, mask_frac = 0.1)
+    run_averager(tmp_path / 'atmos.000101-000312.tas.nc', tmp_path / 'clim.nc', unwgt = unwgt, avg_type = 'month')
+
+    wgts = np.ones(36) if unwgt else np.diff(edges)
+    for month in range(1, 13):
+        members = np.arange(month - 1, 36, 12)
+        expected = np.ma.average(data[members].astype(np.float64), axis = 0, weights = wgts[members])
+        with Dataset(tmp_path / f'clim.{month:02d}.nc') as nc_out:
+            assert nc_out.dimensions['time'].size == 1
+            assert np.ma.allclose(nc_out['tas'][0], expected, rtol = 1.e-6)
+    assert not (tmp_path / 'clim.nc').exists()
+
+
+def test_seasonal_climatology(tmp_path):
+    ''' avg_type = seas writes DJF, MAM, JJA, SON records into one file '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 2)
+    data = write_history_file(tmp_path / 'atmos.000101-000212.tas.nc', time_edges = edges)
+    run_averager(tmp_path / 'atmos.000101-000212.tas.nc', tmp_path / 'clim.nc', avg_type = 'seas')
+
+    wgts = np.diff(edges)
+    seasons = (np.arange(24) % 12 + 1) % 12 // 3
+    with Dataset(tmp_path / 'clim.nc') as nc_out:
+        assert nc_out.dimensions['time'].size == 4
+        for season in range(4):
+            expected = np.average(data[seasons == season].astype(np.float64), axis = 0,
+                                  weights = wgts[seasons == season])
+            assert np.allclose(nc_out['tas'][season], expected, rtol = 1.e-6)
+
+
+def test_fused_products_match_separate_runs(tmp_path):
+    ''' several avg_types from one read give the same answers as one run per avg_type '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 2)
+    write_history_file(tmp_path / 'atmos.000101-000212.tas.nc', time_edges = edges, mask_frac = 0.1)
+    infile = str(tmp_path / 'atmos.000101-000212.tas.nc')
+
+    assert gtas.generate_time_average( infile = infile, outfile = str(tmp_path / 'fused.nc'),
+                                       pkg = 'fre-python-tools', avg_type = ['all', 'seas', 'month'] ) == 0
+    for avg_type in ['all', 'seas', 'month']:
+        run_averager(infile, tmp_path / f'{avg_type}.nc', avg_type = avg_type)
+
+    for fused, separate in [ ('fused.all.nc', 'all.nc'), ('fused.seas.nc', 'seas.nc'),
+                             ('fused.month.01.nc', 'month.01.nc'), ('fused.month.12.nc', 'month.12.nc') ]:
+        with Dataset(tmp_path / fused) as nc_fused, Dataset(tmp_path / separate) as nc_separate:
+            assert np.ma.allclose(nc_fused['tas'][:], nc_separate['tas'][:])
+
+
+def test_stats_stream_across_files(tmp_path):
+    ''' variance, std, min and max written next to the average, merged across input files '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 2)
+    first = write_history_file(tmp_path / 'atmos.000101-000112.tas.nc', time_edges = edges[:13],
+                               mask_frac = 0.1, seed = 4)
+    second = write_history_file(tmp_path / 'atmos.000201-000212.tas.nc', time_edges = edges[12:],
+                                mask_frac = 0.1, seed = 5)
+    data = np.ma.concatenate([first, second]).astype(np.float64)
+    wgts = np.diff(edges)
+
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'tas', unwgt = False,
+                                                   avg_type = 'all', stats = ['var', 'std', 'min', 'max'])
+    assert averager.generate_timavg(infile = [ str(tmp_path / 'atmos.000201-000212.tas.nc'),
+                                               str(tmp_path / 'atmos.000101-000112.tas.nc') ],
+                                    outfile = str(tmp_path / 'out.nc')) == 0
+
+    mean = np.ma.average(data, axis = 0, weights = wgts)
+    cell_wgts = wgts[:, None, None] * ~np.ma.getmaskarray(data)
+    variance = np.ma.sum(cell_wgts * (data - mean)**2, axis = 0) / np.sum(cell_wgts, axis = 0)
+    with Dataset(tmp_path / 'out.nc') as nc_out:
+        assert np.ma.allclose(nc_out['tas'][0], mean, rtol = 1.e-6)
+        assert np.ma.allclose(nc_out['tas_var'][0], variance, rtol = 1.e-5)
+        assert np.ma.allclose(nc_out['tas_std'][0], np.ma.sqrt(variance), rtol = 1.e-5)
+        assert np.ma.allclose(nc_out['tas_min'][0], data.min(axis = 0))
+        assert np.ma.allclose(nc_out['tas_max'][0], data.max(axis = 0))
+        assert nc_out['tas_var'].cell_methods == 'time: variance'
+        assert nc_out['tas_var'].units == 'K2'
+        assert nc_out['tas_std'].cell_methods == 'time: standard_deviation'
+        assert nc_out['tas_std'].units == 'K'
+
+
+def test_stats_require_fre_python_tools(tmp_path):
+    ''' only the python-native averager computes the extra statistics '''
+    with pytest.raises(ValueError):
+        gtas.generate_time_average(infile = str(tmp_path / 'in.nc'), outfile = str(tmp_path / 'out.nc'),
+                                   pkg = 'cdo', stats = ['var'])
+
+
+def test_percentiles_monthly(tmp_path):
+    ''' percentiles of each calendar month, written next to the monthly climatology '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 5)
+    data = write_history_file(tmp_path / 'atmos.000101-000512.tas.nc', time_edges = edges, mask_frac = 0.1)
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'tas', unwgt = False,
+                                                   avg_type = 'month', percentiles = [5, 50, 95])
+    assert averager.generate_timavg(infile = str(tmp_path / 'atmos.000101-000512.tas.nc'),
+                                    outfile = str(tmp_path / 'clim.nc')) == 0
+
+    with Dataset(tmp_path / 'clim.07.nc') as nc_out:
+        for pct in [5, 50, 95]:
+            expected = np.ma.masked_invalid(np.nanquantile(np.ma.filled(data[6::12].astype(np.float64), np.nan),
+                                                           pct / 100., axis = 0, method = 'inverted_cdf'))
+            assert np.ma.allclose(nc_out[f'tas_p{pct}'][0], expected)
+            assert nc_out[f'tas_p{pct}'].percentile == pct
+        assert nc_out['tas_p50'].cell_methods == 'time: median'
+        assert nc_out['tas_p95'].cell_methods == 'time: percentile'
+
+
+def test_sliding_windows_match_separate_runs(tmp_path):
+    ''' overlapping windows from per-file partial sums match averaging each window from scratch '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 5)
+    infiles = []
+    for year in range(5):
+        infiles.append(str(tmp_path / f'atmos.{year + 1:04d}01-{year + 1:04d}12.tas.nc'))
+        write_history_file(infiles[-1], time_edges = edges[12 * year:12 * year + 13], mask_frac = 0.1, seed = year)
+    outfiles = [ { 'all': str(tmp_path / f'sliding.{start}.nc'), 'month': str(tmp_path / f'sliding_mon.{start}.nc') }
+                 for start in range(3) ]
+
+    assert gtas.generate_sliding_time_averages( infile = infiles, outfile = outfiles, window = 3,
+                                                pkg = 'fre-python-tools', avg_type = ['all', 'month'],
+                                                stats = ['std'] ) == 0
+    for start in range(3):
+        assert gtas.generate_time_average( infile = infiles[start:start + 3], outfile = str(tmp_path / 'full.nc'),
+                                           pkg = 'fre-python-tools', avg_type = ['all', 'month'],
+                                           stream = True, stats = ['std'] ) == 0
+        for sliding, full in [ (f'sliding.{start}.nc', 'full.all.nc'),
+                               (f'sliding_mon.{start}.03.nc', 'full.month.03.nc') ]:
+            with Dataset(tmp_path / sliding) as nc_sliding, Dataset(tmp_path / full) as nc_full:
+                assert np.ma.allclose(nc_sliding['tas'][:], nc_full['tas'][:], rtol = 1.e-6)
+                assert np.ma.allclose(nc_sliding['tas_std'][:], nc_full['tas_std'][:], rtol = 1.e-5)
+                assert nc_sliding['time'][:] == nc_full['time'][:]
+
+
+@pytest.mark.parametrize("avg_type", ['all', 'month'])
+def test_update_from_partials_matches_full_recompute(tmp_path, avg_type):
+    ''' extending saved partial sums with new files gives the same answer as averaging everything again '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 4)
+    infiles = []
+    num_valid = 0
+    for year in range(4):
+        infiles.append(str(tmp_path / f'atmos.{year + 1:04d}01-{year + 1:04d}12.tas.nc'))
+        num_valid += np.ma.count(write_history_file(infiles[-1], time_edges = edges[12 * year:12 * year + 13],
+                                                    mask_frac = 0.1, seed = year))
+
+    assert gtas.generate_time_average( infile = infiles[:2], outfile = str(tmp_path / 'inc.nc'),
+                                       pkg = 'fre-python-tools', avg_type = avg_type, stats = ['var', 'max'],
+                                       partials = True ) == 0
+    assert (tmp_path / '.inc.partials').exists()
+    assert gtas.generate_time_average( infile = infiles, outfile = str(tmp_path / 'inc.nc'),
+                                       pkg = 'fre-python-tools', avg_type = avg_type, stats = ['var', 'max'],
+                                       update = True ) == 0
+    assert gtas.generate_time_average( infile = infiles, outfile = str(tmp_path / 'full.nc'),
+                                       pkg = 'fre-python-tools', avg_type = avg_type, stats = ['var', 'max'],
+                                       stream = True ) == 0
+
+    suffix = '.07.nc' if avg_type == 'month' else '.nc'
+    with Dataset(tmp_path / f'inc{suffix}') as nc_inc, Dataset(tmp_path / f'full{suffix}') as nc_full:
+        for var in ['tas', 'tas_var', 'tas_max', 'time', 'time_bnds']:
+            assert np.ma.allclose(nc_inc[var][:], nc_full[var][:], rtol = 1.e-6)
+    with Dataset(tmp_path / '.inc.partials') as nc_partials:
+        assert [ Path(path).name for path in nc_partials['input_file'][:] ] == [ Path(path).name for path in infiles ]
+        assert nc_partials['count'][:].sum() == num_valid
+
+
+def test_update_rejects_other_request(tmp_path):
+    ''' partial sums of another variable or weighting are not merged '''
+    write_history_file(tmp_path / 'atmos.000101-000112.tas.nc')
+    infile = str(tmp_path / 'atmos.000101-000112.tas.nc')
+    assert gtas.generate_time_average( infile = infile, outfile = str(tmp_path / 'out.nc'),
+                                       pkg = 'fre-python-tools', avg_type = 'all', partials = True ) == 0
+    assert gtas.generate_time_average( infile = infile, outfile = str(tmp_path / 'out.nc'),
+                                       pkg = 'fre-python-tools', avg_type = 'all', unwgt = True,
+                                       update = True ) == 1
+
+
+def test_diurnal_cycle(tmp_path):
+    ''' avg_type = hour composites 3-hourly data into one record per 3-hour slot of the day '''
+    edges = np.arange(0., 10.01, 0.125)
+    data = write_history_file(tmp_path / 'atmos_3hr.tas.nc', time_edges = edges, mask_frac = 0.1,
+                              calendar = 'julian')
+    run_averager(tmp_path / 'atmos_3hr.tas.nc', tmp_path / 'diurnal.nc', avg_type = 'hour')
+
+    with Dataset(tmp_path / 'diurnal.nc') as nc_out:
+        assert nc_out.dimensions['time'].size == 8
+        for slot in range(8):
+            expected = np.ma.mean(data[slot::8].astype(np.float64), axis = 0)
+            assert np.ma.allclose(nc_out['tas'][slot], expected, rtol = 1.e-6)
+        # each slot spans its first to its last time step, 73 steps later
+        assert np.allclose(nc_out['time'][:], 0.5 * (edges[:8] + edges[73:81]))
+
+
+def test_day_of_year_climatology(tmp_path):
+    ''' avg_type = doy averages each calendar day across years, in calendar order '''
+    edges = np.arange(0., 2 * 365 + 0.5, 1.)
+    data = write_history_file(tmp_path / 'atmos_daily.tas.nc', time_edges = edges, spatial_dims = (('lat', 2),))
+    run_averager(tmp_path / 'atmos_daily.tas.nc', tmp_path / 'doy.nc', avg_type = 'doy')
+
+    with Dataset(tmp_path / 'doy.nc') as nc_out:
+        assert nc_out.dimensions['time'].size == 365
+        assert np.allclose(nc_out['tas'][:], 0.5 * (data[:365].astype(np.float64) + data[365:]), rtol = 1.e-6)
+
+
+def test_other_variables_reduced_over_records(tmp_path):
+    ''' time and its bounds span each record's time steps, average_T1/T2/DT are reduced over them,
+    static variables are copied and other time-dependent data variables are left out '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 2)
+    write_history_file(tmp_path / 'in.nc', time_edges = edges)
+    with Dataset(tmp_path / 'in.nc', 'a') as nc_in:
+        nc_in.createVariable('area', 'f8', ('lat', 'lon'))[:] = np.arange(12.).reshape(3, 4)
+        nc_in['tas'].cell_measures = 'area: area'
+        nc_in.createVariable('pr', 'f4', ('time', 'lat', 'lon'))[:] = 1.
+        for var, values in [ ('average_T1', edges[:-1]), ('average_T2', edges[1:]),
+                             ('average_DT', np.diff(edges)) ]:
+            nc_in.createVariable(var, 'f8', ('time',))[:] = values
+            nc_in[var].units = 'days' if var == 'average_DT' else 'days since 0001-01-01 00:00:00'
+    run_averager(tmp_path / 'in.nc', tmp_path / 'out.nc', avg_type = 'seas')
+
+    with Dataset(tmp_path / 'out.nc') as nc_out:
+        assert 'pr' not in nc_out.variables
+        assert np.allclose(nc_out['area'][:], np.arange(12.).reshape(3, 4))
+        # DJF gathers both Januaries, Februaries and Decembers
+        starts, ends = nc_out['time_bnds'][:, 0], nc_out['time_bnds'][:, 1]
+        assert np.allclose(starts, [0., edges[2], edges[5], edges[8]])
+        assert np.allclose(ends, [edges[24], edges[17], edges[20], edges[23]])
+        assert np.allclose(nc_out['time'][:], 0.5 * (starts + ends))
+        assert np.allclose(nc_out['average_T1'][:], starts)
+        assert np.allclose(nc_out['average_T2'][:], ends)
+        assert np.allclose(nc_out['average_DT'][0], 2. * (31. + 28. + 31.))
+
+
+def test_append_gathers_variables_in_one_file(tmp_path):
+    ''' with append, each variable's monthly averages are added to the same per-month files '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 2)
+    data = { var: write_history_file(tmp_path / f'atmos.{var}.nc', var = var, time_edges = edges, seed = seed)
+             for seed, var in enumerate(['tas', 'pr']) }
+    for append, var in [(False, 'tas'), (True, 'pr')]:
+        averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = var, unwgt = True,
+                                                       avg_type = 'month', append = append)
+        assert averager.generate_timavg(infile = str(tmp_path / f'atmos.{var}.nc'),
+                                        outfile = str(tmp_path / 'atmos.0001-0002.nc')) == 0
+
+    for month in range(1, 13):
+        with Dataset(tmp_path / f'atmos.0001-0002.{month:02d}.nc') as nc_out:
+            assert nc_out.title == 'synthetic test data'
+            assert nc_out.dimensions['time'].size == 1
+            for var, values in data.items():
+                expected = 0.5 * (values[month - 1].astype(np.float64) + values[month + 11])
+                assert np.allclose(nc_out[var][0], expected, rtol = 1.e-6)
+
+    # a variable is only ever added once
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'pr', unwgt = True,
+                                                   avg_type = 'month', append = True)
+    with pytest.raises(ValueError, match = 'already in output file'):
+        averager.generate_timavg(infile = str(tmp_path / 'atmos.pr.nc'), outfile = str(tmp_path / 'atmos.0001-0002.nc'))
+
+
+def test_max_memory_slabs_match_default(tmp_path):
+    ''' a tight memory budget reads many small slabs, with the same result. too small a budget is an error '''
+    edges = np.cumsum([0.] + MONTH_LENGTHS * 3)
+    write_history_file(tmp_path / 'atmos.000101-000312.tas.nc', time_edges = edges, mask_frac = 0.1)
+    outputs = {}
+    for max_memory in [None, BASE_PROCESS_BYTES + 2000]:
+        averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'tas', unwgt = False,
+                                                       avg_type = 'seas', stats = ['std'], max_memory = max_memory)
+        assert averager.generate_timavg(infile = str(tmp_path / 'atmos.000101-000312.tas.nc'),
+                                        outfile = str(tmp_path / f'out.{max_memory}.nc')) == 0
+        with Dataset(tmp_path / f'out.{max_memory}.nc') as nc_out:
+            outputs[max_memory] = (nc_out['tas'][:], nc_out['tas_std'][:])
+    assert np.ma.allclose(outputs[None][0], outputs[BASE_PROCESS_BYTES + 2000][0], rtol = 1.e-12)
+    assert np.ma.allclose(outputs[None][1], outputs[BASE_PROCESS_BYTES + 2000][1], rtol = 1.e-10)
+
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'tas', unwgt = False,
+                                                   avg_type = 'all', max_memory = BASE_PROCESS_BYTES)
+    assert averager.generate_timavg(infile = str(tmp_path / 'atmos.000101-000312.tas.nc'),
+                                    outfile = str(tmp_path / 'out.nc')) == 1
+
+
+def test_output_encoding(tmp_path):
+    ''' averages and statistics are compressed, chunked by horizontal slice and quantized as requested '''
+    write_history_file(tmp_path / 'in.nc', spatial_dims = (('pfull', 2), ('lat', 3), ('lon', 4)))
+    encoding = form_output_encoding(compression = 'zlib', complevel = 5, significant_digits = 3)
+    averager = frepy_timavg.frepytoolsTimeAverager(pkg = 'fre-python-tools', var = 'tas', unwgt = False,
+                                                   avg_type = 'all', stats = ['std'], encoding = encoding)
+    assert averager.generate_timavg(infile = str(tmp_path / 'in.nc'), outfile = str(tmp_path / 'out.nc')) == 0
+    with Dataset(tmp_path / 'out.nc') as nc_out:
+        for var in ['tas', 'tas_std']:
+            assert nc_out[var].filters()['zlib'] and nc_out[var].filters()['complevel'] == 5
+            assert nc_out[var].chunking() == [1, 1, 3, 4]
+            assert nc_out[var].getncattr('_QuantizeBitGroomNumberOfSignificantDigits') == 3
+        assert nc_out['lat'].filters()['zlib']
+        assert '_QuantizeBitGroomNumberOfSignificantDigits' not in nc_out['lat'].ncattrs()
@@ -357,3 +357,29 @@ def test_no_req_arg_inputfile( infile, outfile, pkg):
         gtas.generate_time_average( infile = infile,
                                     outfile = outfile,
                                     pkg = pkg )
+
+@pytest.mark.parametrize( "pkg", ['cdo', 'fre-nctools'] )
+def test_stream_requires_fre_python_tools(pkg):
+    '''
+    test that streaming over multiple files is refused by packages that cannot do it
+    '''
+    with pytest.raises(ValueError):
+        gtas.generate_time_average( infile = ['foo_input_file', 'bar_input_file'],
+                                    outfile = 'foo_output_file',
+                                    pkg = pkg,
+                                    stream = True )
+
+def test_frenctools_month_split_private(tmp_path):
+    '''
+    test that fre-nctools monthly climatologies write one file per month and leave no split files behind
+    '''
+    if shutil.which('timavg.csh') is None:
+        pytest.xfail(reason = 'no timavg.csh!')
+    setup_test_files()
+    assert gtas.generate_time_average( infile = NCGEN_OUTPUT,
+                                       outfile = str(tmp_path / TEST_FILE_NAME),
+                                       pkg = 'fre-nctools',
+                                       avg_type = 'month' ) == 0
+    for month in range(1, 13):
+        assert (tmp_path / f'{ATMOS_FILE_NAME}.{month:02d}.nc').exists()
+    assert not list(Path.cwd().glob('monthly_nc_files*'))
@@ -0,0 +1,50 @@
+''' tests for the output encoding settings in fre/app/generate_time_averages/output_encoding.py '''
+
+import pytest
+
+from fre.app.generate_time_averages import output_encoding
+
+
+def test_form_output_encoding_layers(tmp_path):
+    ''' defaults, then the yaml postprocess settings, then explicit overrides '''
+    yamlfile = tmp_path / 'pp.yaml'
+    yamlfile.write_text('postprocess:\n'
+                        '  settings:\n'
+                        '    history_segment: P1Y\n'
+                        '    output_encoding:\n'
+                        '      compression: zstd\n'
+                        '      complevel: 7\n')
+    assert output_encoding.form_output_encoding() == output_encoding.DEFAULT_OUTPUT_ENCODING
+    encoding = output_encoding.form_output_encoding(str(yamlfile), complevel = 2, significant_digits = None)
+    assert encoding == { **output_encoding.DEFAULT_OUTPUT_ENCODING, 'compression': 'zstd', 'complevel': 2 }
+    assert output_encoding.form_output_encoding(compression = 'none')['compression'] is None
+
+
+@pytest.mark.parametrize("overrides",
+                         [ pytest.param( {'compression': 'lz4'} ),
+                           pytest.param( {'chunking': 'columns'} ) ])
+def test_form_output_encoding_rejects_unknown(overrides):
+    ''' unknown compressors and chunkings are errors '''
+    with pytest.raises(ValueError):
+        output_encoding.form_output_encoding(**overrides)
+
+
+@pytest.mark.parametrize("shape,record_axes,itemsize,expected",
+                         [ pytest.param( (12, 5, 90, 144), [0], 4, (1, 1, 90, 144) ),
+                           pytest.param( (12, 180), [0], 8, (1, 180) ),
+                           pytest.param( (144,), [], 8, (144,) ),
+                           pytest.param( (1, 8192, 4096), [0], 8, (1, 512, 4096) ) ])
+def test_form_chunk_shape(shape, record_axes, itemsize, expected):
+    ''' one whole horizontal slice per chunk, split if it is too large '''
+    assert output_encoding.form_chunk_shape(shape, record_axes, itemsize) == expected
+
+
+def test_form_netcdf4_encoding_quantizes_data_only():
+    ''' significant_digits applies to floating point data, never to coordinates or integers '''
+    encoding = output_encoding.form_output_encoding(significant_digits = 3)
+    assert output_encoding.form_netcdf4_encoding(encoding, (1, 4, 5), [0], 'f4')['significant_digits'] == 3
+    assert 'significant_digits' not in output_encoding.form_netcdf4_encoding(encoding, (4,), [], 'f8',
+                                                                             data_variable = False)
+    assert 'significant_digits' not in output_encoding.form_netcdf4_encoding(encoding, (1, 4, 5), [0], 'i4')
+    assert output_encoding.form_netcdf4_encoding(encoding, (), [], 'f8') == {}
+    assert output_encoding.form_partials_encoding(encoding)['significant_digits'] is None
@@ -0,0 +1,229 @@
+''' tests for the chunked reduction routines in fre/app/generate_time_averages/time_reduction.py '''
+
+import cftime
+import numpy as np
+import pytest
+
+from fre.app.generate_time_averages import time_reduction
+
+
+def test_compute_time_weights():
+    ''' weights are the widths of the time bounds, masked bounds weigh nothing '''
+    time_bnds = np.ma.masked_array([[0., 31.], [31., 59.], [59., 90.]],
+                                   mask = [[False, False], [False, False], [True, False]])
+    wgts = time_reduction.compute_time_weights(time_bnds)
+    assert wgts.dtype == np.float64
+    assert np.array_equal(wgts, [31., 28., 0.])
+
+
+@pytest.mark.parametrize("shape,time_axis,max_bytes,expected_slabs",
+                         [ pytest.param( (10, 4, 5), 0, 8 * 200, 1 ),
+                           pytest.param( (10, 4, 5), 0, 8 * 60, 4 ),
+                           pytest.param( (10, 4, 5), 0, 8 * 5, 40 ),
+                           pytest.param( (3, 10, 2, 5), 1, 8 * 7, 60 ),
+                           pytest.param( (10, 4, 5), 0, 1, 200 ) ])
+def test_iter_slabs_covers_variable(shape, time_axis, max_bytes, expected_slabs):
+    ''' slabs stay within budget and tile the variable exactly once, in time order per block '''
+    covered = np.zeros(shape, dtype = int)
+    slabs = list(time_reduction.iter_slabs(shape, time_axis, 8, max_bytes))
+    for index in slabs:
+        assert covered[index].size * 8 <= max(max_bytes, 8)
+        covered[index] += 1
+    assert len(slabs) == expected_slabs
+    assert (covered == 1).all()
+
+
+def test_accumulator_slabs_match_single_pass():
+    ''' accumulating slab by slab gives the same weighted mean as one numpy call '''
+    rng = np.random.default_rng(42)
+    data = rng.random((24, 5, 7)).astype(np.float32)
+    wgts = rng.random(24) + 0.5
+
+    accumulator = time_reduction.TimeAccumulator(data.shape[1:])
+    for index in time_reduction.iter_slabs(data.shape, 0, data.itemsize, 8 * data.itemsize):
+        accumulator.update(data[index], wgts[index[0]], index[1:])
+
+    expected = np.average(data.astype(np.float64), axis = 0, weights = wgts)
+    assert not np.ma.isMaskedArray(accumulator.mean())
+    assert np.allclose(accumulator.mean()[0], expected, rtol = 1.e-12)
+
+
+def test_accumulator_masked_per_cell_weights():
+    ''' masked values are excluded per cell, fully masked cells stay masked '''
+    data = np.ma.masked_array([[1., 5.], [3., 7.], [5., 9.]],
+                              mask = [[False, True], [True, True], [False, True]])
+    accumulator = time_reduction.TimeAccumulator((2,))
+    accumulator.update(data, np.array([1., 2., 3.]))
+    result = accumulator.mean()[0]
+    assert result[0] == pytest.approx((1. * 1. + 5. * 3.) / 4.)
+    assert result.mask[1]
+
+
+def test_group_time_steps():
+    ''' months map to 0-11, seasons to DJF, MAM, JJA, SON '''
+    dates = cftime.num2date(np.arange(15., 365., 30.), 'days since 0001-01-01', 'noleap')
+    months = np.array([ date.month for date in dates ])
+    assert np.array_equal(time_reduction.group_time_steps(dates, 'all'), np.zeros(len(dates)))
+    assert np.array_equal(time_reduction.group_time_steps(dates, 'month'), months - 1)
+    assert np.array_equal(time_reduction.group_time_steps(dates, 'seas'),
+                          [ {12: 0, 1: 0, 2: 0, 3: 1, 4: 1, 5: 1, 6: 2, 7: 2, 8: 2}.get(month, 3) for month in months ])
+    with pytest.raises(ValueError):
+        time_reduction.group_time_steps(dates, 'FOO')
+
+
+def test_accumulator_groups_scatter_add():
+    ''' grouped sums match a loop over the groups, in one pass '''
+    rng = np.random.default_rng(7)
+    data = rng.random((36, 3, 2))
+    wgts = rng.random(36) + 0.5
+    groups = np.arange(36) % 12
+
+    accumulator = time_reduction.TimeAccumulator(data.shape[1:], num_groups = 12)
+    for index in time_reduction.iter_slabs(data.shape, 0, data.itemsize, 5 * data.itemsize):
+        accumulator.update(data[index], wgts[index[0]], index[1:], groups[index[0]])
+
+    for group in range(12):
+        expected = np.average(data[groups == group], axis = 0, weights = wgts[groups == group])
+        assert np.allclose(accumulator.mean()[group], expected, rtol = 1.e-12)
+
+
+@pytest.mark.parametrize("num_groups", [1, 4])
+def test_accumulator_stats_match_numpy(num_groups):
+    ''' slab-by-slab variance, std, min and max match a single numpy pass, masked cells excluded '''
+    rng = np.random.default_rng(3)
+    data = np.ma.masked_array(rng.normal(250., 10., (48, 3, 5)), mask = rng.random((48, 3, 5)) < 0.2)
+    data.mask[:, 0, 0] = True
+    wgts = rng.random(48) + 0.5
+    groups = np.arange(48) % num_groups
+
+    accumulator = time_reduction.TimeAccumulator(data.shape[1:], num_groups = num_groups,
+                                                 stats = ('var', 'std', 'min', 'max'))
+    for index in time_reduction.iter_slabs(data.shape, 0, data.itemsize, 7 * data.itemsize):
+        accumulator.update(data[index], wgts[index[0]], index[1:], groups[index[0]])
+
+    for group in range(num_groups):
+        members = data[groups == group]
+        mean = np.ma.average(members, axis = 0, weights = wgts[groups == group])
+        cell_wgts = wgts[groups == group][:, None, None] * ~np.ma.getmaskarray(members)
+        variance = np.ma.sum(cell_wgts * (members - mean)**2, axis = 0) / np.sum(cell_wgts, axis = 0)
+        assert np.ma.allclose(accumulator.statistic('var')[group], variance, rtol = 1.e-10)
+        assert np.ma.allclose(accumulator.statistic('std')[group], np.ma.sqrt(variance), rtol = 1.e-10)
+        assert np.ma.allclose(accumulator.statistic('min')[group], members.min(axis = 0))
+        assert np.ma.allclose(accumulator.statistic('max')[group], members.max(axis = 0))
+        assert accumulator.statistic('var').mask[group, 0, 0]
+
+
+def test_accumulator_stats_must_be_requested():
+    ''' unknown statistics, or ones not accumulated, are errors '''
+    with pytest.raises(ValueError):
+        time_reduction.TimeAccumulator((2,), stats = ('median',))
+    with pytest.raises(ValueError):
+        time_reduction.TimeAccumulator((2,)).statistic('var')
+
+
+def test_quantile_sketch_exact_when_small():
+    ''' without compaction, merged sketches give the exact inverted-CDF quantiles, masked values ignored '''
+    rng = np.random.default_rng(11)
+    data = np.ma.masked_array(rng.normal(size = (60, 3)), mask = rng.random((60, 3)) < 0.3)
+    accumulator = time_reduction.QuantileAccumulator((3,), percentiles = (5, 50, 95))
+    other = time_reduction.QuantileAccumulator((3,), percentiles = (5, 50, 95))
+    accumulator.update(data[:25])
+    other.update(data[25:])
+    accumulator.merge(other)
+
+    assert accumulator.rank_error_bound() == 0.
+    for pct, result in accumulator.percentile().items():
+        for cell in range(3):
+            assert result[0, cell] == np.quantile(data[:, cell].compressed(), pct / 100., method = 'inverted_cdf')
+
+
+def test_quantile_sketch_error_bound():
+    ''' with compaction, memory stays bounded and the rank error within the documented bound '''
+    rng = np.random.default_rng(12)
+    data = np.ma.masked_array(rng.normal(size = (20000, 2, 3)), mask = rng.random((20000, 2, 3)) < 0.2)
+    data.mask[:, 1, 2] = True
+    accumulator = time_reduction.QuantileAccumulator((2, 3), percentiles = (5, 50, 95), sketch_size = 64)
+    for index in time_reduction.iter_slabs(data.shape, 0, data.itemsize, 1000 * data.itemsize):
+        accumulator.update(data[index], index[1:])
+
+    bound = accumulator.rank_error_bound()
+    assert 0. < bound < 0.5
+    sketch, = accumulator.sketches.values()
+    assert all( items.shape[0] <= 64 for items in sketch.levels )
+    assert np.array_equal(sketch.count(), np.ma.count(data, axis = 0))
+    for pct, result in accumulator.percentile().items():
+        assert result.mask[0, 1, 2]
+        ranks = np.ma.sum(data <= result[0], axis = 0) / np.ma.count(data, axis = 0)
+        assert np.ma.max(np.abs(ranks - pct / 100.)) <= bound
+
+
+def test_accumulator_merge_and_remove():
+    ''' merging partial sums matches accumulating everything, removing one gives back the rest '''
+    rng = np.random.default_rng(13)
+    chunks = [ np.ma.masked_array(rng.normal(size = (12, 4)), mask = rng.random((12, 4)) < 0.2) for _ in range(3) ]
+    wgts = rng.random(12) + 0.5
+    partials = []
+    for chunk in chunks:
+        partials.append(time_reduction.TimeAccumulator((4,), stats = ('var',)))
+        partials[-1].update(chunk, wgts)
+
+    merged = time_reduction.TimeAccumulator((4,), stats = ('var',))
+    for partial in partials:
+        merged.merge(partial)
+    merged.remove(partials[0])
+
+    expected = time_reduction.TimeAccumulator((4,), stats = ('var',))
+    for chunk in chunks[1:]:
+        expected.update(chunk, wgts)
+    assert np.allclose(merged.mean(), expected.mean(), rtol = 1.e-12)
+    assert np.allclose(merged.statistic('var'), expected.statistic('var'), rtol = 1.e-10)
+
+    with pytest.raises(ValueError):
+        time_reduction.TimeAccumulator((4,), stats = ('min',)).remove(partials[0])
+
+
+def test_group_time_steps_hour():
+    ''' hour of the day of each time step, e.g. of 3-hourly interval midpoints '''
+    dates = cftime.num2date(np.arange(1.5, 48., 3.), 'hours since 2000-01-01', 'standard')
+    assert np.array_equal(time_reduction.group_time_steps(dates, 'hour'), [1, 4, 7, 10, 13, 16, 19, 22] * 2)
+
+
+@pytest.mark.parametrize("calendar,year_lengths,num_groups",
+                         [ pytest.param('noleap', [365, 365], 365),
+                           pytest.param('julian', [366, 365], 366),
+                           pytest.param('proleptic_gregorian', [366, 365], 366),
+                           pytest.param('360_day', [360, 360], 360) ])
+def test_group_time_steps_doy(calendar, year_lengths, num_groups):
+    ''' each calendar day maps to one group, the same in every year, Mar 1 after Feb 29 '''
+    dates = cftime.num2date(np.arange(sum(year_lengths)) + 0.5, 'days since 2000-01-01', calendar)
+    groups = time_reduction.group_time_steps(dates, 'doy')
+    assert len(np.unique(groups)) == num_groups
+    assert groups.max() < time_reduction.NUM_TIME_GROUPS['doy']
+    month_day_groups = {}
+    for date, group in zip(dates, groups):
+        assert month_day_groups.setdefault((date.month, date.day), group) == group
+    assert month_day_groups[(3, 1)] == 60
+    assert sorted(month_day_groups, key = month_day_groups.get) == sorted(month_day_groups)
+
+
+@pytest.mark.parametrize("size,expected",
+                         [ pytest.param( 1048576, 1048576 ),
+                           pytest.param( '1048576', 1048576 ),
+                           pytest.param( '4G', 4 * 1024**3 ),
+                           pytest.param( '512MiB', 512 * 1024**2 ),
+                           pytest.param( '1.5k', 1536 ) ])
+def test_parse_memory_size(size, expected):
+    ''' plain bytes or binary multiples '''
+    assert time_reduction.parse_memory_size(size) == expected
+
+
+def test_budget_slab_bytes():
+    ''' the slab and its float64 buffers fit in what the base process and resident state leave '''
+    max_memory = time_reduction.BASE_PROCESS_BYTES + 1000 + 52 * 100
+    slab_bytes = time_reduction.budget_slab_bytes(max_memory, 1000, 4)
+    assert slab_bytes == 400
+    assert time_reduction.budget_slab_bytes(10 * 1024**4, 0, 4) == time_reduction.DEFAULT_SLAB_BYTES
+    with pytest.raises(ValueError):
+        time_reduction.budget_slab_bytes(time_reduction.BASE_PROCESS_BYTES, 1, 4)
+    with pytest.raises(ValueError):
+        time_reduction.parse_memory_size('lots')
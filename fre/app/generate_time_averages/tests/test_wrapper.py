@@ -6,8 +6,10 @@ import shutil
 import tempfile
 
 import pytest
+from netCDF4 import Dataset
 
 from fre.app.generate_time_averages import wrapper
+from .test_frepytoolsTimeAverager import write_history_file
 
 # create_monthly_timeseries:
 # ts/regrid-xy/180_288.conserve_order2/atmos_month/P1M/P1Y/atmos_month.198001-198012.alb_sfc.nc
@@ -348,6 +350,107 @@ def test_cdo_fre_nctools_equivalence(create_monthly_timeseries):
 
             assert result.returncode == 0, stdoutput+'\n'+stderror
 
+# fre-python-tools tests
+def test_frepytools_fused_annual_and_monthly_av(create_monthly_timeseries):
+    """
+    Generate annual and monthly climatologies from monthly timeseries in one pass
+    """
+    cycle_point = '1980-01-01'
+    output_interval = 'P2Y'
+    input_interval = 'P1Y'
+    grid = '180_288.conserve_order2'
+    sources = ['atmos_month']
+    frequency = 'yr,mon'
+    pkg = 'fre-python-tools'
+
+    wrapper.generate_wrapper(cycle_point, create_monthly_timeseries, sources,
+                             output_interval, input_interval, grid, frequency, pkg)
+
+    av_dir = Path(create_monthly_timeseries, 'av', grid, 'atmos_month')
+    for var in ['alb_sfc', 'aliq']:
+        assert (av_dir / 'P1Y' / output_interval / f'atmos_month.1980-1981.{var}.nc').exists()
+        for i in range(1,13):
+            assert (av_dir / 'P1M' / output_interval / f'atmos_month.1980-1981.{var}.{i:02d}.nc').exists()
+
+def test_frepytools_sliding_annual_av(create_monthly_timeseries):
+    """
+    Generate overlapping one-year climatologies, one per input timeseries file
+    """
+    cycle_point = '1980-01-01'
+    output_interval = 'P1Y'
+    input_interval = 'P1Y'
+    grid = '180_288.conserve_order2'
+    sources = ['atmos_month']
+    frequency = 'yr'
+    pkg = 'fre-python-tools'
+
+    wrapper.generate_wrapper(cycle_point, create_monthly_timeseries, sources,
+                             output_interval, input_interval, grid, frequency, pkg, num_windows = 2)
+
+    av_dir = Path(create_monthly_timeseries, 'av', grid, 'atmos_month', 'P1Y', output_interval)
+    for var in ['alb_sfc', 'aliq']:
+        for year in ['1980', '1981']:
+            assert (av_dir / f'atmos_month.{year}-{year}.{var}.nc').exists()
+
+def test_frepytools_combined_annual_and_monthly_av(create_monthly_timeseries, tmp_path):
+    """
+    Write every variable of a source straight into the combined Bronx-layout files
+    """
+    cycle_point = '1980-01-01'
+    output_interval = 'P2Y'
+    input_interval = 'P1Y'
+    grid = '180_288.conserve_order2'
+    sources = ['atmos_month']
+    frequency = 'yr,mon'
+    pkg = 'fre-python-tools'
+
+    wrapper.generate_wrapper(cycle_point, create_monthly_timeseries, sources,
+                             output_interval, input_interval, grid, frequency, pkg,
+                             combined_dir = str(tmp_path / 'pp'))
+
+    av_dir = tmp_path / 'pp' / 'atmos_month' / 'av'
+    output_files = [ av_dir / 'annual_2yr' / 'atmos_month.1980-1981.nc' ] + \
+                   [ av_dir / 'monthly_2yr' / f'atmos_month.1980-1981.{i:02d}.nc' for i in range(1,13) ]
+    for output_file in output_files:
+        with Dataset(output_file) as nc_out:
+            assert 'alb_sfc' in nc_out.variables and 'aliq' in nc_out.variables
+
+def test_combined_dir_requires_fre_python_tools(tmp_path):
+    """
+    Only fre-python-tools can write the combined files directly
+    """
+    with pytest.raises(ValueError, match = 'combined_dir'):
+        wrapper.generate_wrapper('1980-01-01', str(tmp_path), ['atmos_month'], 'P2Y', 'P1Y', 'native', 'yr',
+                                 'cdo', combined_dir = str(tmp_path / 'pp'))
+
+def test_run_jobs_isolates_failures(tmp_path):
+    """
+    Concurrent averaging jobs run to completion even if one of them fails, which is then reported
+    """
+    write_history_file(tmp_path / 'atmos.000101-000112.tas.nc')
+    good_job = { 'label': 'atmos/tas', 'input_files': [str(tmp_path / 'atmos.000101-000112.tas.nc')],
+                 'calls': [ ('generate_time_average', { 'infile': str(tmp_path / 'atmos.000101-000112.tas.nc'),
+                                                        'outfile': str(tmp_path / 'tas.nc'),
+                                                        'pkg': 'fre-python-tools', 'avg_type': 'all' }) ] }
+    bad_job = { 'label': 'atmos/DNE', 'input_files': [],
+                'calls': [ ('generate_time_average', { 'infile': 'DNE.nc', 'outfile': str(tmp_path / 'DNE.nc'),
+                                                       'pkg': 'FOO' }) ] }
+
+    with pytest.raises(RuntimeError, match = 'atmos/DNE'):
+        wrapper.run_jobs([bad_job, good_job], workers = 2, pkg = 'fre-python-tools')
+    assert (tmp_path / 'tas.nc').exists()
+
+
+def test_max_concurrent_jobs_open_files(monkeypatch):
+    """
+    No more jobs run at once than their input files allow under the open file limit
+    """
+    jobs = [ { 'label': f'atmos/var{i}', 'input_files': [ f'file{j}.nc' for j in range(40) ], 'calls': [] }
+             for i in range(8) ]
+    monkeypatch.setattr(wrapper.resource, 'getrlimit', lambda _: (64 + 3 * 56, 4096))
+    assert wrapper.max_concurrent_jobs(jobs, 8, 'fre-python-tools') == 3
+    assert wrapper.max_concurrent_jobs(jobs, 2, 'fre-python-tools') == 2
+
 def test_freq_not_valid_valueerror():
     with pytest.raises(ValueError):
         wrapper.generate_wrapper(dir_ = 'some_in_dir',
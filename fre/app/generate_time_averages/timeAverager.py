@@ -57,15 +57,26 @@ class timeAverager:
             fre_logger.warning('PROBABLY not time.')
             return False
 
-        # TODO
-        #def var_has_time_dims(self, an_nc_var=None):
-        #try:
-        #    var_dims=an_nc_var.dimensions
-        #for dim in an_nc_var.dimensions:
-        #    if dim ==
-
-
-
+    def var_time_dim(self, an_nc_var = None):
+        '''
+        returns the name of the variable's time dimension, or None if it has none.
+        a dimension is time if its coordinate variable has axis = "T" or units of time,
+        otherwise the variable's unlimited dimension is assumed to be time.
+        '''
+        nc_ds = an_nc_var.group()
+        for dim in an_nc_var.dimensions:
+            if dim not in nc_ds.variables:
+                continue
+            coord_var = nc_ds.variables[dim]
+            if getattr(coord_var, 'axis', None) == 'T':
+                return dim
+            if hasattr(coord_var, 'units') and self.var_has_time_units(coord_var):
+                return dim
+        for dim in an_nc_var.dimensions:
+            if nc_ds.dimensions[dim].isunlimited():
+                fre_logger.debug('assuming unlimited dimension %s is time', dim)
+                return dim
+        return None
 
     def generate_timavg(self, infile=None, outfile=None):
         '''# this is a hint: this is to be defined by classes inheriting from the abstract one
@@ -0,0 +1,810 @@
+''' chunked, vectorized reduction routines backing the python-native time averager '''
+
+import itertools
+import logging
+import math
+import re
+import resource
+from typing import Iterator, Union
+
+import numpy
+
+fre_logger = logging.getLogger(__name__)
+
+# target size, in bytes, of a single slab of input data held in memory at once
+DEFAULT_SLAB_BYTES = 256 * 1024 * 1024
+
+# number of output time records for each avg_type, seasons are DJF, MAM, JJA, SON in that order.
+# 'hour' is the hour of the day (a diurnal cycle), 'doy' the day of the year, laid out as in a leap year
+NUM_TIME_GROUPS = { 'all': 1,
+                    'seas': 4,
+                    'month': 12,
+                    'hour': 24,
+                    'doy': 366 }
+
+# days before the first of each month in a leap year, to place month-days on a common day-of-year axis
+LEAP_YEAR_DAYS_BEFORE_MONTH = numpy.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+# optional statistics beyond the mean, with the CF cell_methods method name for each
+STATS = { 'var': 'variance',
+          'std': 'standard_deviation',
+          'min': 'minimum',
+          'max': 'maximum' }
+
+# default number of values each level of a per-cell quantile sketch holds
+DEFAULT_SKETCH_SIZE = 256
+
+# memory of an averaging process before it reads any data: interpreter, numpy, netCDF4, cdo bindings
+BASE_PROCESS_BYTES = 256 * 1024 * 1024
+
+# float64 copies of a slab alive at once while it is folded into the running sums: the filled values,
+# the cell weights, their product, the deviations for var/std and the candidates for min/max.
+# a quantile sketch concatenates, sorts and compacts its lowest level, a few copies more
+SLAB_BUFFERS = 6
+SKETCH_SLAB_BUFFERS = 4
+
+# binary multiples accepted by parse_memory_size, with or without a trailing 'iB' or 'B'
+MEMORY_UNITS = { '': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+
+
+def compute_time_weights(time_bnds) -> numpy.ndarray:
+    """
+    compute per-time-step weights as the width of each time interval
+
+    :param time_bnds: time bounds, shape (time, 2), possibly masked
+    :type time_bnds: numpy.ndarray
+    :return: weights of shape (time,), float64. masked bounds yield zero weight.
+    :rtype: numpy.ndarray
+    """
+    # Cast to float64 for consistent results across numpy versions (NEP 50 type promotion changes)
+    time_bnds = numpy.ma.asarray(time_bnds, dtype = numpy.float64)
+    wgts = time_bnds[:, 1] - time_bnds[:, 0]
+    return numpy.ma.filled(wgts, 0.)
+
+
+def group_time_steps(dates, avg_type: str = 'all') -> numpy.ndarray:
+    """
+    map each time step to the index of the output time record it is averaged into
+
+    :param dates: date of each time step, e.g. from cftime.num2date, only needed if avg_type is not 'all'.
+                  for 'hour' these should be the middle of each time step's interval
+    :type dates: sequence of cftime.datetime
+    :param avg_type: one of the keys of NUM_TIME_GROUPS
+    :type avg_type: str
+    :raises ValueError: unknown avg_type
+    :return: integer group index for each time step, in [0, NUM_TIME_GROUPS[avg_type])
+    :rtype: numpy.ndarray
+
+    'doy' groups by calendar month and day rather than by the ordinal day of the year, so that e.g. Mar 1 is
+    the same group in leap and non-leap years of the julian, standard and proleptic_gregorian calendars.
+    days are laid out as in a leap year, so Feb 29 is a group of its own, empty for noleap/365_day.
+    360_day calendars have 30-day months and use the first 360 groups.
+    """
+    if avg_type == 'all':
+        return numpy.zeros(len(dates), dtype = numpy.intp)
+    if avg_type not in NUM_TIME_GROUPS:
+        raise ValueError(f'avg_type = {avg_type} not known, must be one of {list(NUM_TIME_GROUPS)}')
+    if avg_type == 'hour':
+        return numpy.fromiter( (date.hour for date in dates), dtype = numpy.intp, count = len(dates) )
+    months = numpy.fromiter( (date.month for date in dates), dtype = numpy.intp, count = len(dates) )
+    if avg_type == 'month':
+        return months - 1
+    if avg_type == 'doy':
+        days = numpy.fromiter( (date.day for date in dates), dtype = numpy.intp, count = len(dates) )
+        if len(dates) > 0 and getattr(dates[0], 'calendar', '') == '360_day':
+            return (months - 1) * 30 + days - 1
+        return LEAP_YEAR_DAYS_BEFORE_MONTH[months - 1] + days - 1
+    # seas: Dec, Jan, Feb -> 0, Mar, Apr, May -> 1, ...
+    return (months % 12) // 3
+
+
+def parse_memory_size(size: Union[int, str]) -> int:
+    """
+    parse a memory size such as '4G', '512MiB' or '1048576' into bytes. units are binary multiples
+
+    :param size: size in bytes, or a number followed by K, M, G or T
+    :type size: int, str
+    :raises ValueError: size is not understood
+    :return: size in bytes
+    :rtype: int
+    """
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)(I?B)?\s*', str(size).upper())
+    if match is None:
+        raise ValueError(f'memory size {size} not understood, expected e.g. 4G, 512MiB or a number of bytes')
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def budget_slab_bytes(max_memory: int, resident_bytes: int, itemsize: int, buffers: int = SLAB_BUFFERS) -> int:
+    """
+    largest slab, in bytes of input data, such that the process fits within max_memory while folding it in:
+    the base process, the resident sums (or other state) and buffers float64 copies of the slab
+
+    :param max_memory: memory budget of the whole process, in bytes
+    :type max_memory: int
+    :param resident_bytes: memory held for the whole run besides the slabs, e.g. accumulators, in bytes
+    :type resident_bytes: int
+    :param itemsize: size in bytes of one element of the input variable
+    :type itemsize: int
+    :param buffers: float64 copies of a slab alive at once
+    :type buffers: int
+    :raises ValueError: the budget does not even cover the base process and the resident state
+    :return: slab size in bytes, at most DEFAULT_SLAB_BYTES
+    :rtype: int
+    """
+    free_bytes = max_memory - BASE_PROCESS_BYTES - resident_bytes
+    if free_bytes <= 0:
+        raise ValueError(f'max_memory = {max_memory} bytes is too small, the process needs '
+                         f'{BASE_PROCESS_BYTES + resident_bytes} bytes before reading any data')
+    slab_bytes = free_bytes // (itemsize + buffers * 8) * itemsize
+    return max(itemsize, min(DEFAULT_SLAB_BYTES, slab_bytes))
+
+
+def peak_rss_bytes() -> int:
+    """
+    peak resident set size of this process so far, as reported by getrusage
+
+    :return: peak RSS in bytes
+    :rtype: int
+    """
+    # linux reports ru_maxrss in KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def log_peak_rss(max_memory: int = None) -> int:
+    """
+    log the peak resident set size of this process, warning if it went over the memory budget
+
+    :param max_memory: optional memory budget in bytes
+    :type max_memory: int
+    :return: peak RSS in bytes
+    :rtype: int
+    """
+    peak = peak_rss_bytes()
+    if max_memory is not None and peak > max_memory:
+        fre_logger.warning('peak RSS %s MiB exceeded max_memory %s MiB', peak // 1024**2, max_memory // 1024**2)
+    else:
+        fre_logger.info('peak RSS %s MiB', peak // 1024**2)
+    return peak
+
+
+def slab_shape(shape: tuple,
+               time_axis: int,
+               itemsize: int,
+               max_bytes: int = DEFAULT_SLAB_BYTES) -> tuple:
+    """
+    shape of the slabs iter_slabs tiles a variable with. the non-time axes are blocked first,
+    fastest-varying axis first, so that one time step of a block fits in max_bytes.
+    the remaining budget sets how many time steps are read at once.
+
+    :param shape: shape of the variable
+    :type shape: tuple
+    :param time_axis: index of the time axis within shape, None if the variable has no time axis
+    :type time_axis: int
+    :param itemsize: size in bytes of one element of the variable
+    :type itemsize: int
+    :param max_bytes: upper bound on the size in bytes of one slab, at least one element is always read
+    :type max_bytes: int
+    :return: slab shape, at most shape along every axis
+    :rtype: tuple
+    """
+    budget = max(1, int(max_bytes) // max(1, int(itemsize)))
+    block = list(shape)
+    for axis in reversed(range(len(shape))):
+        if axis == time_axis:
+            continue
+        block[axis] = max(1, min(shape[axis], budget))
+        budget = max(1, budget // block[axis])
+    if time_axis is not None:
+        block[time_axis] = max(1, min(shape[time_axis], budget))
+    return tuple(block)
+
+
+def iter_slabs(shape: tuple,
+               time_axis: int,
+               itemsize: int,
+               max_bytes: int = DEFAULT_SLAB_BYTES) -> Iterator[tuple]:
+    """
+    yield index tuples that tile a variable in slabs of at most max_bytes, shaped as by slab_shape.
+    slabs are yielded block by block, and in time order within each block.
+
+    :param shape: shape of the variable
+    :type shape: tuple
+    :param time_axis: index of the time axis within shape
+    :type time_axis: int
+    :param itemsize: size in bytes of one element of the variable
+    :type itemsize: int
+    :param max_bytes: upper bound on the size in bytes of one slab, at least one element is always read
+    :type max_bytes: int
+    :return: generator of tuples of slice objects, one per axis of the variable
+    :rtype: Iterator[tuple]
+    """
+    block = slab_shape(shape, time_axis, itemsize, max_bytes)
+    fre_logger.debug('slab shape for variable of shape %s is %s', shape, block)
+
+    block_starts = [ range(0, shape[axis], block[axis]) for axis in range(len(shape)) ]
+    time_starts = block_starts[time_axis]
+    block_starts[time_axis] = [0]
+    for starts in itertools.product(*block_starts):
+        index = [ slice(start, min(start + block[axis], shape[axis])) for axis, start in enumerate(starts) ]
+        for time_start in time_starts:
+            index[time_axis] = slice(time_start, min(time_start + block[time_axis], shape[time_axis]))
+            yield tuple(index)
+
+
+def group_sum(values: numpy.ndarray, groups: numpy.ndarray = None, num_groups: int = 1) -> numpy.ndarray:
+    """
+    sum values over their leading (time) axis into num_groups groups
+
+    :param values: array with time as its leading axis
+    :type values: numpy.ndarray
+    :param groups: group index of each time step, shape (time,), default is group 0
+    :type groups: numpy.ndarray
+    :param num_groups: number of groups
+    :type num_groups: int
+    :return: per-group sums, shape (num_groups,) + values.shape[1:]
+    :rtype: numpy.ndarray
+    """
+    if groups is None or num_groups == 1:
+        return numpy.sum(values, axis = 0, dtype = numpy.float64)[numpy.newaxis]
+    sums = numpy.zeros((num_groups,) + values.shape[1:], dtype = numpy.float64)
+    numpy.add.at(sums, groups, values)
+    return sums
+
+
+class TimeAccumulator:
+    '''
+    running, per-cell weighted sums used to reduce a variable along its time axis,
+    optionally into several groups of time steps (e.g. one per calendar month).
+    masked values contribute neither to the sum of values nor to the sum of weights,
+    so each cell is normalized by the weights of the time steps it actually has.
+    the number of valid values of each cell is counted too.
+
+    optional higher-order statistics, from the same pass:
+    'var' and 'std' keep the weighted sum of squared deviations from the mean (M2),
+    merging each slab's M2 into the running one with Chan et al.'s parallel update,
+    'min' and 'max' keep running extremes.
+    '''
+    wsum_data: numpy.ndarray
+    wsum: numpy.ndarray
+    count: numpy.ndarray
+    stats: tuple
+    m2: numpy.ndarray
+    minimum: numpy.ndarray
+    maximum: numpy.ndarray
+
+    def __init__(self, shape: tuple, num_groups: int = 1, stats: tuple = ()):
+        '''
+        :param shape: shape of the reduced field, i.e. the variable's shape without the time axis
+        :type shape: tuple
+        :param num_groups: number of groups of time steps to keep separate sums for
+        :type num_groups: int
+        :param stats: optional statistics to accumulate besides the mean, any of STATS
+        :type stats: tuple
+        '''
+        unknown_stats = [ stat for stat in stats if stat not in STATS ]
+        if len(unknown_stats) > 0:
+            raise ValueError(f'statistic(s) {unknown_stats} not known, must be one of {list(STATS)}')
+        full_shape = (num_groups,) + tuple(shape)
+        self.stats = tuple(stats)
+        self.wsum_data = numpy.zeros(full_shape, dtype = numpy.float64)
+        self.wsum = numpy.zeros(full_shape, dtype = numpy.float64)
+        self.count = numpy.zeros(full_shape, dtype = numpy.int64)
+        self.m2 = numpy.zeros(full_shape, dtype = numpy.float64) if self.needs_m2() else None
+        self.minimum = numpy.full(full_shape, numpy.inf) if 'min' in self.stats else None
+        self.maximum = numpy.full(full_shape, -numpy.inf) if 'max' in self.stats else None
+
+    @property
+    def nbytes(self) -> int:
+        ''' memory held by the running sums, in bytes '''
+        return sum( values.nbytes for values in [ self.wsum_data, self.wsum, self.count,
+                                                  self.m2, self.minimum, self.maximum ] if values is not None )
+
+    def needs_m2(self) -> bool:
+        ''' whether any requested statistic is built on the sum of squared deviations '''
+        return any( stat in self.stats for stat in ['var', 'std'] )
+
+    def update(self, data, wgts: numpy.ndarray, region: tuple = (), groups: numpy.ndarray = None) -> None:
+        """
+        fold one slab of data into the running sums. a single group is a single reduction over axis 0,
+        several groups are one index-based scatter-add over axis 0.
+
+        :param data: slab of data with time as its leading axis, possibly masked
+        :type data: numpy.ndarray
+        :param wgts: weight of each time step in the slab, shape (time,)
+        :type wgts: numpy.ndarray
+        :param region: index into the reduced field covered by the slab, default is all of it
+        :type region: tuple
+        :param groups: group index of each time step in the slab, shape (time,), default is group 0
+        :type groups: numpy.ndarray
+        """
+        wgts = numpy.asarray(wgts, dtype = numpy.float64).reshape( (-1,) + (1,) * (data.ndim - 1) )
+        num_groups = self.wsum.shape[0]
+        if num_groups == 1:
+            groups = None
+        target = (slice(None),) + tuple(region)
+
+        if numpy.ma.is_masked(data):
+            valid = ~numpy.ma.getmaskarray(data)
+            cell_wgts = wgts * valid
+            values = numpy.ma.filled(data, 0.)
+            self.count[target] += group_sum(valid, groups, num_groups).astype(numpy.int64)
+        else:
+            cell_wgts = numpy.broadcast_to(wgts, data.shape)
+            values = numpy.ma.getdata(data)
+            group_counts = numpy.bincount(groups, minlength = num_groups) if groups is not None else [data.shape[0]]
+            self.count[target] += numpy.reshape(group_counts, (-1,) + (1,) * (data.ndim - 1))
+        batch_wsum_data = group_sum(values * cell_wgts, groups, num_groups)
+        batch_wsum = group_sum(cell_wgts, groups, num_groups)
+
+        if self.m2 is not None:
+            # Chan et al. parallel update: M2 = M2_a + M2_b + delta**2 * W_a * W_b / (W_a + W_b)
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                batch_mean = numpy.where(batch_wsum > 0., batch_wsum_data / batch_wsum, 0.)
+            deviations = values - (batch_mean[0] if groups is None else batch_mean[groups])
+            batch_m2 = group_sum(cell_wgts * deviations**2, groups, num_groups)
+            self.m2[target] += batch_m2 + self.m2_correction(self.wsum_data[target], self.wsum[target],
+                                                             batch_wsum_data, batch_wsum)
+
+        self.wsum_data[target] += batch_wsum_data
+        self.wsum[target] += batch_wsum
+
+        if self.minimum is not None or self.maximum is not None:
+            valid = cell_wgts > 0.
+            for extremes, fill, ufunc in [ (self.minimum, numpy.inf, numpy.minimum),
+                                           (self.maximum, -numpy.inf, numpy.maximum) ]:
+                if extremes is None:
+                    continue
+                candidates = numpy.where(valid, values, fill)
+                if groups is None:
+                    extremes[0][region] = ufunc(extremes[0][region], ufunc.reduce(candidates, axis = 0))
+                else:
+                    ufunc.at(extremes[target], groups, candidates)
+
+    def merge(self, other: 'TimeAccumulator') -> None:
+        """
+        fold everything accumulated by another accumulator of the same shape, groups and statistics
+        into this one, e.g. the partial sums of another chunk of time steps
+
+        :param other: accumulator to merge, left unchanged
+        :type other: TimeAccumulator
+        """
+        self.check_compatible(other)
+        if self.m2 is not None:
+            self.m2 += other.m2 + self.m2_correction(self.wsum_data, self.wsum, other.wsum_data, other.wsum)
+        self.wsum_data += other.wsum_data
+        self.wsum += other.wsum
+        self.count += other.count
+        if self.minimum is not None:
+            numpy.minimum(self.minimum, other.minimum, out = self.minimum)
+        if self.maximum is not None:
+            numpy.maximum(self.maximum, other.maximum, out = self.maximum)
+
+    def remove(self, other: 'TimeAccumulator') -> None:
+        """
+        take out the contribution of an accumulator previously merged into this one, e.g. the oldest
+        chunk of a sliding window. M2 is recovered by inverting the parallel update. running extremes
+        cannot be taken out, so accumulators keeping 'min' or 'max' cannot do this.
+
+        :param other: accumulator to remove, left unchanged
+        :type other: TimeAccumulator
+        :raises ValueError: this accumulator keeps minima or maxima
+        """
+        self.check_compatible(other)
+        if self.minimum is not None or self.maximum is not None:
+            raise ValueError('cannot remove a contribution from running minima or maxima')
+        self.wsum_data -= other.wsum_data
+        self.wsum -= other.wsum
+        self.count -= other.count
+        # no valid data left, zero out round-off
+        empty = self.wsum <= 0.
+        self.wsum[empty] = 0.
+        self.wsum_data[empty] = 0.
+        if self.m2 is not None:
+            self.m2 -= other.m2 + self.m2_correction(self.wsum_data, self.wsum, other.wsum_data, other.wsum)
+            self.m2[empty] = 0.
+            numpy.maximum(self.m2, 0., out = self.m2)
+
+    def check_compatible(self, other: 'TimeAccumulator') -> None:
+        ''' raise ValueError unless other has the same shape, groups and statistics '''
+        if other.wsum.shape != self.wsum.shape or set(other.stats) != set(self.stats):
+            raise ValueError(f'cannot combine an accumulator of shape {other.wsum.shape} and stats {other.stats} '
+                             f'with one of shape {self.wsum.shape} and stats {self.stats}')
+
+    @staticmethod
+    def m2_correction(wsum_data_a, wsum_a, wsum_data_b, wsum_b) -> numpy.ndarray:
+        """
+        the delta**2 * W_a * W_b / (W_a + W_b) term of Chan et al.'s update, combining two sets of sums
+
+        :return: correction to add to M2_a + M2_b, zero where either set is empty
+        :rtype: numpy.ndarray
+        """
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean_a = numpy.where(wsum_a > 0., wsum_data_a / wsum_a, 0.)
+            mean_b = numpy.where(wsum_b > 0., wsum_data_b / wsum_b, 0.)
+            wsum = wsum_a + wsum_b
+            return numpy.where( (wsum_a > 0.) & (wsum_b > 0.),
+                                (mean_b - mean_a)**2 * wsum_a * wsum_b / wsum, 0. )
+
+    def finalize(self, values: numpy.ndarray):
+        """
+        mask cells that received no valid data
+
+        :param values: per-group, per-cell values
+        :type values: numpy.ndarray
+        :return: values, masked where a cell received no valid data
+        :rtype: numpy.ndarray or numpy.ma.MaskedArray
+        """
+        empty = self.wsum == 0.
+        if empty.any():
+            return numpy.ma.masked_array(numpy.where(empty, 0., values), mask = empty)
+        return values
+
+    def mean(self):
+        """
+        weighted mean of everything accumulated so far
+
+        :return: per-group, per-cell mean with the group axis leading,
+                 masked where a cell received no valid data
+        :rtype: numpy.ndarray or numpy.ma.MaskedArray
+        """
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            return self.finalize(self.wsum_data / self.wsum)
+
+    def statistic(self, stat: str):
+        """
+        one of the optional statistics accumulated so far. variance is the weighted population
+        variance, M2 / sum of weights, so unweighted it matches e.g. cdo timvar.
+
+        :param stat: 'var', 'std', 'min' or 'max', must have been requested at construction
+        :type stat: str
+        :raises ValueError: statistic not accumulated
+        :return: per-group, per-cell statistic with the group axis leading,
+                 masked where a cell received no valid data
+        :rtype: numpy.ndarray or numpy.ma.MaskedArray
+        """
+        if stat not in self.stats:
+            raise ValueError(f'statistic {stat} was not accumulated, only {list(self.stats)}')
+        if stat == 'min':
+            return self.finalize(self.minimum)
+        if stat == 'max':
+            return self.finalize(self.maximum)
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            variance = numpy.maximum(self.m2 / self.wsum, 0.)
+        return self.finalize(variance if stat == 'var' else numpy.sqrt(variance))
+
+
+class TimeExtent:
+    '''
+    per-group envelope of the time steps accumulated: the earliest start and latest end of their
+    time bounds, and their total length, all in the same time units. empty groups start at +inf.
+    like first records, and unlike the sums, an envelope cannot have time steps removed from it.
+    '''
+    start: numpy.ndarray
+    end: numpy.ndarray
+    length: numpy.ndarray
+
+    def __init__(self, num_groups: int = 1):
+        '''
+        :param num_groups: number of groups of time steps
+        :type num_groups: int
+        '''
+        self.start = numpy.full(num_groups, numpy.inf)
+        self.end = numpy.full(num_groups, -numpy.inf)
+        self.length = numpy.zeros(num_groups)
+
+    def update(self, time_bnds, groups: numpy.ndarray = None) -> None:
+        """
+        widen the envelopes by some time steps
+
+        :param time_bnds: time bounds, shape (time, 2), possibly masked
+        :type time_bnds: numpy.ndarray
+        :param groups: group index of each time step, shape (time,), default is group 0
+        :type groups: numpy.ndarray
+        """
+        time_bnds = numpy.ma.asarray(time_bnds, dtype = numpy.float64)
+        groups = numpy.zeros(time_bnds.shape[0], dtype = int) if groups is None else numpy.asarray(groups)
+        valid = ~numpy.ma.getmaskarray(time_bnds).any(axis = 1)
+        time_bnds = numpy.ma.getdata(time_bnds)[valid]
+        groups = groups[valid]
+        numpy.minimum.at(self.start, groups, time_bnds[:, 0])
+        numpy.maximum.at(self.end, groups, time_bnds[:, 1])
+        numpy.add.at(self.length, groups, time_bnds[:, 1] - time_bnds[:, 0])
+
+    def merge(self, other: 'TimeExtent') -> None:
+        """
+        widen the envelopes to include another's, e.g. that of other input files
+
+        :param other: envelope to merge, left unchanged
+        :type other: TimeExtent
+        """
+        if other.start.shape != self.start.shape:
+            raise ValueError(f'cannot merge {other.start.shape[0]} groups into {self.start.shape[0]}')
+        self.start = numpy.minimum(self.start, other.start)
+        self.end = numpy.maximum(self.end, other.end)
+        self.length = self.length + other.length
+
+    def has_time_steps(self) -> numpy.ndarray:
+        ''' per group, whether any time step was accumulated '''
+        return numpy.isfinite(self.start)
+
+
+def percentile_stat_name(percentile: float) -> str:
+    """
+    name of the statistic, and output variable suffix, for a percentile, e.g. 95 -> 'p95', 99.9 -> 'p99_9'
+
+    :param percentile: percentile in [0, 100]
+    :type percentile: float
+    :return: statistic name
+    :rtype: str
+    """
+    return f'p{percentile:g}'.replace('.', '_')
+
+
+def quantile_rank_error_bound(count: int, sketch_size: int = DEFAULT_SKETCH_SIZE) -> float:
+    """
+    worst-case error, as a fraction of count, in the rank of a quantile estimated by a QuantileSketch.
+    every compaction at level h shifts any rank by at most 2**h, and level h is compacted at most
+    count / (sketch_size * 2**(h-1)) times, so each level contributes at most 2 * count / sketch_size.
+    the random compaction offsets make the typical error much smaller than this bound.
+
+    :param count: number of values sketched per cell
+    :type count: int
+    :param sketch_size: capacity of each level of the sketch
+    :type sketch_size: int
+    :return: bound on the normalized rank error, 0 if the sketch never compacted
+    :rtype: float
+    """
+    if count <= sketch_size:
+        return 0.
+    num_levels = math.ceil(math.log2(count / sketch_size)) + 1
+    return min(1., 2. * num_levels / sketch_size)
+
+
+class QuantileSketch:
+    '''
+    per-cell mergeable quantile sketch, KLL-style, for a block of cells at once.
+    level h holds values of weight 2**h, shape (items, *cells), in lockstep across cells with NaN where
+    a cell has fewer values. when a level exceeds sketch_size items it is compacted: each cell's values
+    are sorted, every other one (from a random offset) moves up a level, and the largest of an odd count
+    stays behind so no weight is lost. memory per cell is at most sketch_size values per level,
+    with about log2(count / sketch_size) levels, however long the time series.
+    '''
+    sketch_size: int
+    levels: list
+
+    def __init__(self, shape: tuple, sketch_size: int = DEFAULT_SKETCH_SIZE, dtype = numpy.float64, rng = None):
+        '''
+        :param shape: shape of the block of cells
+        :type shape: tuple
+        :param sketch_size: capacity of each level
+        :type sketch_size: int
+        :param dtype: floating point type the values are kept in
+        :type dtype: numpy.dtype
+        :param rng: source of the compaction offsets, default is a fixed seed so output is reproducible
+        :type rng: numpy.random.Generator
+        '''
+        if sketch_size < 2:
+            raise ValueError(f'sketch_size = {sketch_size} too small, must be at least 2')
+        self.shape = tuple(shape)
+        self.sketch_size = int(sketch_size)
+        self.dtype = numpy.dtype(dtype) if numpy.issubdtype(dtype, numpy.floating) else numpy.dtype(numpy.float64)
+        self.rng = rng if rng is not None else numpy.random.default_rng(0)
+        self.levels = []
+
+    def update(self, data) -> None:
+        """
+        add a slab of values, masked values are ignored
+
+        :param data: values with time as their leading axis, shape (time, *shape)
+        :type data: numpy.ndarray
+        """
+        values = numpy.ma.filled(numpy.ma.asarray(data, dtype = self.dtype), numpy.nan)
+        self.add_to_level(0, values)
+        self.compress()
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        """
+        fold another sketch of the same cells into this one, e.g. one built from other input files
+
+        :param other: sketch to merge, left unchanged
+        :type other: QuantileSketch
+        """
+        if other.shape != self.shape:
+            raise ValueError(f'cannot merge a sketch of shape {other.shape} into one of shape {self.shape}')
+        for level, items in enumerate(other.levels):
+            self.add_to_level(level, items)
+        self.compress()
+
+    def add_to_level(self, level: int, items: numpy.ndarray) -> None:
+        ''' append items to a level, creating it if need be '''
+        while len(self.levels) <= level:
+            self.levels.append(numpy.empty((0,) + self.shape, dtype = self.dtype))
+        self.levels[level] = numpy.concatenate([self.levels[level], items.astype(self.dtype, copy = False)])
+
+    def compress(self) -> None:
+        ''' compact every level holding more than sketch_size items, bottom up '''
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].shape[0] > self.sketch_size:
+                kept, promoted = self.compact(self.levels[level])
+                self.levels[level] = kept
+                self.add_to_level(level + 1, promoted)
+            level += 1
+
+    def compact(self, items: numpy.ndarray) -> tuple:
+        """
+        halve a level: sort each cell, promote every other value, keep the largest of an odd count behind
+
+        :param items: one level, shape (items, *cells), NaN where empty
+        :type items: numpy.ndarray
+        :return: items staying at this level, items promoted to the next
+        :rtype: tuple
+        """
+        items = numpy.sort(items, axis = 0)
+        counts = numpy.sum(~numpy.isnan(items), axis = 0)
+        even_counts = counts - counts % 2
+        positions = numpy.arange(items.shape[0]).reshape( (-1,) + (1,) * len(self.shape) )
+        offset = int(self.rng.integers(2))
+
+        promoted = numpy.where(positions < even_counts, items, numpy.nan)[offset::2]
+        kept = numpy.take_along_axis(items, numpy.minimum(even_counts, items.shape[0] - 1)[numpy.newaxis], axis = 0)
+        kept = numpy.where(counts % 2 == 1, kept, numpy.nan)
+        return self.trim(kept), self.trim(promoted)
+
+    def trim(self, items: numpy.ndarray) -> numpy.ndarray:
+        ''' drop trailing rows that are empty in every cell '''
+        filled_rows = numpy.flatnonzero(~numpy.isnan(items).reshape(items.shape[0], -1).all(axis = 1))
+        return items[: filled_rows[-1] + 1] if len(filled_rows) > 0 else items[:0]
+
+    def count(self) -> numpy.ndarray:
+        """
+        number of values sketched in each cell
+
+        :return: counts, shape of the block of cells
+        :rtype: numpy.ndarray
+        """
+        total = numpy.zeros(self.shape, dtype = numpy.int64)
+        for level, items in enumerate(self.levels):
+            total += numpy.sum(~numpy.isnan(items), axis = 0) * 2**level
+        return total
+
+    def quantile(self, quantiles) -> numpy.ndarray:
+        """
+        estimate quantiles of each cell from the weighted values of all levels, as the smallest
+        value whose weighted empirical CDF reaches the quantile (numpy's 'inverted_cdf' method)
+
+        :param quantiles: quantiles in [0, 1]
+        :type quantiles: sequence of float
+        :return: shape (len(quantiles), *cells), NaN where a cell has no values
+        :rtype: numpy.ndarray
+        """
+        quantiles = numpy.asarray(quantiles, dtype = numpy.float64)
+        if len(self.levels) == 0:
+            return numpy.full(quantiles.shape + self.shape, numpy.nan)
+        values = numpy.concatenate(self.levels)
+        wgts = numpy.concatenate([ numpy.full(items.shape[0], 2.**level) for level, items in enumerate(self.levels) ])
+        order = numpy.argsort(values, axis = 0)
+        values = numpy.take_along_axis(values, order, axis = 0)
+        cum_wgts = numpy.cumsum( numpy.where(numpy.isnan(values), 0., wgts[order]), axis = 0 )
+
+        result = numpy.full(quantiles.shape + self.shape, numpy.nan)
+        for i, quantile in enumerate(quantiles):
+            index = numpy.sum(cum_wgts < quantile * cum_wgts[-1], axis = 0)
+            result[i] = numpy.take_along_axis(values, numpy.minimum(index, values.shape[0] - 1)[numpy.newaxis],
+                                              axis = 0)[0]
+        return result
+
+
+class QuantileAccumulator:
+    '''
+    quantile sketches over a whole reduced field, optionally per group of time steps like TimeAccumulator.
+    one QuantileSketch is kept per group and per block of cells given to update, so the field can be
+    streamed in the same blocked slabs as the sums. percentiles are unweighted: each time step counts once.
+    '''
+    sketches: dict
+
+    def __init__(self, shape: tuple, num_groups: int = 1, percentiles: tuple = (),
+                 sketch_size: int = DEFAULT_SKETCH_SIZE, dtype = numpy.float64):
+        '''
+        :param shape: shape of the reduced field, i.e. the variable's shape without the time axis
+        :type shape: tuple
+        :param num_groups: number of groups of time steps to keep separate sketches for
+        :type num_groups: int
+        :param percentiles: percentiles to estimate, in [0, 100]
+        :type percentiles: tuple
+        :param sketch_size: capacity of each level of each sketch, trading memory for accuracy
+        :type sketch_size: int
+        :param dtype: floating point type the sketched values are kept in
+        :type dtype: numpy.dtype
+        '''
+        bad_percentiles = [ pct for pct in percentiles if not 0. <= pct <= 100. ]
+        if len(bad_percentiles) > 0:
+            raise ValueError(f'percentile(s) {bad_percentiles} not within [0, 100]')
+        self.shape = tuple(shape)
+        self.num_groups = num_groups
+        self.percentiles = tuple(percentiles)
+        self.sketch_size = sketch_size
+        self.dtype = dtype
+        self.rng = numpy.random.default_rng(0)
+        self.sketches = {}
+
+    def estimate_nbytes(self, count: int) -> int:
+        """
+        upper bound on the memory the sketches will hold once count time steps have been folded in:
+        at most sketch_size values per level per cell, about log2(count / sketch_size) + 1 levels
+
+        :param count: number of time steps per cell, over all groups
+        :type count: int
+        :return: estimated memory in bytes
+        :rtype: int
+        """
+        num_levels = max(1, math.ceil(math.log2(max(1., count / self.sketch_size))) + 1)
+        num_items = min(count, num_levels * self.sketch_size * self.num_groups)
+        itemsize = numpy.dtype(self.dtype).itemsize if numpy.issubdtype(self.dtype, numpy.floating) else 8
+        return num_items * math.prod(self.shape) * itemsize
+
+    def sketch(self, group: int, region: tuple) -> QuantileSketch:
+        ''' the sketch of one group and block of cells, created on first use '''
+        key = (group,) + tuple( (index.start, index.stop) for index in region )
+        if key not in self.sketches:
+            block_shape = numpy.empty(self.shape, dtype = bool)[region].shape
+            self.sketches[key] = QuantileSketch(block_shape, self.sketch_size, self.dtype, self.rng)
+        return self.sketches[key]
+
+    def update(self, data, region: tuple = (), groups: numpy.ndarray = None) -> None:
+        """
+        fold one slab of data into the sketches of its groups
+
+        :param data: slab of data with time as its leading axis, possibly masked
+        :type data: numpy.ndarray
+        :param region: index, made of slices, into the reduced field covered by the slab, default is all of it
+        :type region: tuple
+        :param groups: group index of each time step in the slab, shape (time,), default is group 0
+        :type groups: numpy.ndarray
+        """
+        region = tuple(region)
+        if groups is None or self.num_groups == 1:
+            self.sketch(0, region).update(data)
+            return
+        for group in numpy.unique(groups):
+            self.sketch(int(group), region).update(data[groups == group])
+
+    def merge(self, other: 'QuantileAccumulator') -> None:
+        """
+        fold the sketches of another accumulator over the same field and blocks into this one
+
+        :param other: accumulator to merge, left unchanged
+        :type other: QuantileAccumulator
+        """
+        for key, other_sketch in other.sketches.items():
+            if key not in self.sketches:
+                self.sketches[key] = QuantileSketch(other_sketch.shape, self.sketch_size, self.dtype, self.rng)
+            self.sketches[key].merge(other_sketch)
+
+    def percentile(self) -> dict:
+        """
+        estimated percentiles of everything sketched so far
+
+        :return: percentile -> per-group, per-cell estimate with the group axis leading,
+                 masked where a cell received no valid data
+        :rtype: dict
+        """
+        result = numpy.full( (len(self.percentiles), self.num_groups) + self.shape, numpy.nan )
+        quantiles = [ pct / 100. for pct in self.percentiles ]
+        for (group, *bounds), sketch in self.sketches.items():
+            region = tuple( slice(start, stop) for start, stop in bounds )
+            result[(slice(None), group) + region] = sketch.quantile(quantiles)
+        result = numpy.ma.masked_invalid(result)
+        return { pct: result[i] for i, pct in enumerate(self.percentiles) }
+
+    def rank_error_bound(self) -> float:
+        """
+        worst-case normalized rank error of the estimates, over all sketches
+
+        :return: see quantile_rank_error_bound
+        :rtype: float
+        """
+        max_count = max( (int(sketch.count().max(initial = 0)) for sketch in self.sketches.values()), default = 0 )
+        return quantile_rank_error_bound(max_count, self.sketch_size)
@@ -1,17 +1,31 @@
 """ climatology computation routines for fre/app/generate_time_averages """
 
 import logging
+import multiprocessing
+import os
 from pathlib import Path
 import glob
+import resource
+import time
 
 from metomi.isodatetime.parsers import TimePointParser, DurationParser, TimeRecurrenceParser
 from metomi.isodatetime.dumpers import TimePointDumper
 
 from . import generate_time_averages
+from .combine import form_bronx_directory_name
+from .time_reduction import BASE_PROCESS_BYTES, DEFAULT_SLAB_BYTES
 
 fre_logger = logging.getLogger(__name__)
 one_year = DurationParser().parse('P1Y')
 
+# files a job may hold open besides its inputs (outputs, templates, python's own),
+# and open files kept in reserve for the scheduling process
+JOB_EXTRA_OPEN_FILES = 16
+RESERVED_OPEN_FILES = 64
+
+# memory of an averaging process before it reads any data
+JOB_BASE_MEMORY = BASE_PROCESS_BYTES
+
 def extract_variables_from_files(files: list[str]) -> list[str]:
     """
     Utility to extract "variable" part of a list of input files,
@@ -31,6 +45,82 @@ def extract_variables_from_files(files: list[str]) -> list[str]:
     return variables
 
 
+def find_source_timeseries(dir_: Path,
+                           grid: str,
+                           source: str,
+                           frequency: str,
+                           cycle_point,
+                           input_interval) -> tuple[list[str], str]:
+    """
+    Find the timeseries a climatology of one source and frequency is computed from,
+    looking at the first input segment.
+
+    :param dir_: Root shards directory
+    :type dir_: Path
+    :param grid: Grid label of the shards directory
+    :type grid: str
+    :param source: History file to average
+    :type source: str
+    :param frequency: Period to average: 'yr' or 'mon'
+    :type frequency: str
+    :param cycle_point: Beginning of the climatology
+    :type cycle_point: ISO8601 time-point
+    :param input_interval: Input timeseries length
+    :type input_interval: ISO8601 duration
+    :raises FileNotFoundError: Missing input timeseries files
+    :return: variables found, and the frequency of the timeseries ('P1Y' or 'P1M', '' if none)
+    :rtype: tuple[list[str], str]
+    """
+    recurrence = TimeRecurrenceParser().parse('R1' + '/' + f"{cycle_point.year:04d}" + '/' + str(input_interval))
+    variables = []
+    source_frequency = ""
+    for dd in recurrence:
+        yyyy = TimePointDumper().strftime(dd, "%Y")
+        zzzz = TimePointDumper().strftime(dd + input_interval - one_year, "%Y")
+        # mon or yr timeseries => yr climo
+        # mon timeseries => mon climo
+        if frequency == "yr":
+            # prefer the annual timeseries if it's there
+            subdir_yr =  Path(dir_ / 'ts' / grid / source / 'P1Y' / str(input_interval))
+            subdir_mon = Path(dir_ / 'ts' / grid / source / 'P1M' / str(input_interval))
+            if subdir_yr.exists():
+                results = glob.glob(str(subdir_yr / f"{source}.{yyyy}-{zzzz}.*.nc"))
+                if results:
+                    variables = extract_variables_from_files(results)
+                    source_frequency = "P1Y"
+                    fre_logger.debug("Annual ts to annual climo from source %s:%s variables",
+                                     source, len(variables))
+                else:
+                    raise FileNotFoundError(f"Expected files not found in {subdir_yr}")
+            elif subdir_mon.exists():
+                results = glob.glob(str(subdir_mon / f"{source}.{yyyy}01-{zzzz}12.*.nc"))
+                if results:
+                    variables = extract_variables_from_files(results)
+                    source_frequency = "P1M"
+                    fre_logger.debug("monthly ts to annual climo from source %s:%s variables",
+                                     source, len(variables))
+                else:
+                    raise FileNotFoundError(f"Expected files not found in {subdir_mon}")
+            else:
+                fre_logger.debug('Skipping %s as it does not appear to be monthly or annual frequency', source)
+                fre_logger.debug('neither %s nor %s  exists', subdir_mon, subdir_yr)
+        elif frequency == "mon":
+            subdir = Path(dir_ / 'ts' / grid / source / 'P1M' / str(input_interval))
+            if subdir.exists():
+                results = glob.glob(str(subdir / (source + '.' + yyyy + '01-' + zzzz + '12.*.nc')))
+                if results:
+                    variables = extract_variables_from_files(results)
+                    source_frequency = "P1M"
+                    fre_logger.debug("monthly ts to monthly climo from source %s:%s variables",
+                                     source, len(variables))
+                else:
+                    raise FileNotFoundError(f"Expected files not found in {subdir}")
+            else:
+                fre_logger.debug("Skipping %s as it does not appear to be monthly frequency", source)
+                fre_logger.debug(" %s does not exist", subdir)
+    return variables, source_frequency
+
+
 def generate_wrapper(cycle_point: str,
                      dir_: str,
                      sources: list[str],
@@ -38,7 +128,10 @@ def generate_wrapper(cycle_point: str,
                      input_interval: str,
                      grid: str,
                      frequency: str,
-                     pkg: str = 'fre-nctools') -> None:
+                     pkg: str = 'fre-nctools',
+                     num_windows: int = 1,
+                     workers: int = 1,
+                     combined_dir: str = None) -> None:
     """
     Run climatology tool on a subset of timeseries
 
@@ -52,12 +145,28 @@ def generate_wrapper(cycle_point: str,
     :type output_interval: ISO8601 duration
     :param input_interval: Input timeseries length
     :type input_interval: ISO8601 duration
-    :param frequency: Period to average: 'yr' or 'mon'
-    :type frequency: ISO8601 duration
+    :param frequency: Period to average: 'yr' or 'mon', or several comma-separated e.g. 'yr,mon'.
+                      Climatologies computed from the same timeseries are fused into one pass
+                      over the input when pkg is 'fre-python-tools'
+    :type frequency: str
     :param pkg: Package to use for time averaging ('fre-nctools', 'cdo', 'fre-python-tools')
     :type pkg: str
+    :param num_windows: Number of overlapping climatologies of length output_interval to compute,
+                        the first starting at cycle_point and each next one input_interval later,
+                        e.g. 1980-1984, 1981-1985, ... from yearly timeseries. With 'fre-python-tools'
+                        each timeseries file is read once for all of them
+    :type num_windows: int
+    :param workers: Number of (source, variable) averaging jobs to run concurrently in separate processes,
+                    fewer if open-file or memory limits do not allow that many, see max_concurrent_jobs
+    :type workers: int
+    :param combined_dir: Root output postprocess directory, up to the "pp". If given, every variable of a source
+                         is written straight into the per-component files combine() would otherwise make,
+                         <combined_dir>/<source>/av/<annual|monthly>_<N>yr/<source>.<years>[.<month>].nc,
+                         one job per source averaging its variables one after the other. fre-python-tools only
+    :type combined_dir: str
     :raises ValueError: Only monthly and annual frequencies allowed
     :raises FileNotFoundError: Missing input timeseries files
+    :raises RuntimeError: Some averaging jobs failed, after all jobs have run
     :rtype: None
     """
 
@@ -70,113 +179,253 @@ def generate_wrapper(cycle_point: str,
     fre_logger.debug('grid: %s', grid)
     fre_logger.debug('frequency: %s', frequency)
     fre_logger.debug('pkg: %s', pkg)
+    fre_logger.debug('num_windows: %s', num_windows)
+    fre_logger.debug('workers: %s', workers)
+    fre_logger.debug('combined_dir: %s', combined_dir)
 
     dir_ = Path(dir_)
     cycle_point = TimePointParser().parse(cycle_point)
     output_interval = DurationParser().parse(output_interval)
     input_interval = DurationParser().parse(input_interval)
 
-    if frequency not in ["yr", "mon"]:
-        raise ValueError(f"Frequency '{frequency}' not recognized or supported")
+    if num_windows < 1:
+        raise ValueError(f"num_windows = {num_windows} must be at least 1")
 
-    # convert frequency 'yr' or 'mon' to ISO8601
-    if frequency == 'mon':
-        frequency_iso = "P1M"
-    elif frequency == 'yr':
-        frequency_iso = "P1Y"
+    frequencies = frequency.split(',')
+    for freq in frequencies:
+        if freq not in ["yr", "mon"]:
+            raise ValueError(f"Frequency '{freq}' not recognized or supported")
+    if combined_dir is not None and pkg != 'fre-python-tools':
+        raise ValueError(f"combined_dir is only supported by pkg = fre-python-tools, not pkg = {pkg}")
 
-    # loop over the history files
+    # convert frequency 'yr' or 'mon' to ISO8601, and to the averager's avg_type
+    frequency_iso = { 'mon': "P1M", 'yr': "P1Y" }
+    frequency_avg_type = { 'mon': 'month', 'yr': 'all' }
+
+    # loop over the history files, collecting one averaging job per source and variable
+    jobs = []
     for source in sources:
         fre_logger.debug("Main loop: averaging history file %s", source)
-        # first, retrieve the variable names from the first segment
-        recurrence = TimeRecurrenceParser().parse('R1' + '/' + f"{cycle_point.year:04d}" + '/' + str(input_interval))
-        variables = []
-        source_frequency = ""
-        for dd in recurrence:
-            yyyy = TimePointDumper().strftime(dd, "%Y")
-            zzzz = TimePointDumper().strftime(dd + input_interval - one_year, "%Y")
-            # mon or yr timeseries => yr climo
-            # mon timeseries => mon climo
-            if frequency == "yr":
-                # prefer the annual timeseries if it's there
-                subdir_yr =  Path(dir_ / 'ts' / grid / source / 'P1Y' / str(input_interval))
-                subdir_mon = Path(dir_ / 'ts' / grid / source / 'P1M' / str(input_interval))
-                if subdir_yr.exists():
-                    results = glob.glob(str(subdir_yr / f"{source}.{yyyy}-{zzzz}.*.nc"))
-                    if results:
-                        variables = extract_variables_from_files(results)
-                        source_frequency = "P1Y"
-                        fre_logger.debug("Annual ts to annual climo from source %s:%s variables",
-                                         source, len(variables))
-                    else:
-                        raise FileNotFoundError(f"Expected files not found in {subdir_yr}")
-                elif subdir_mon.exists():
-                    results = glob.glob(str(subdir_mon / f"{source}.{yyyy}01-{zzzz}12.*.nc"))
-                    if results:
-                        variables = extract_variables_from_files(results)
-                        source_frequency = "P1M"
-                        fre_logger.debug("monthly ts to annual climo from source %s:%s variables",
-                                         source, len(variables))
+        # first, retrieve the variable names from the first segment.
+        # frequencies computed from the same timeseries share one set of input files
+        plans = {}
+        for freq in frequencies:
+            variables, source_frequency = find_source_timeseries(dir_, grid, source, freq,
+                                                                 cycle_point, input_interval)
+            fre_logger.debug("frequency %s: source_frequency: %s", freq, source_frequency)
+            fre_logger.debug("frequency %s: variables: %s", freq, len(variables))
+            if variables:
+                plans.setdefault(source_frequency, (variables, []))[1].append(freq)
+
+        # then run the climo tool for each variable.
+        # sliding windows share their timeseries, so the input list spans all of them
+        number_of_files = int(output_interval.get_seconds() / input_interval.get_seconds())
+        recurrence = TimeRecurrenceParser().parse( 'R' + str(number_of_files + num_windows - 1) + '/' + \
+                                                   f"{cycle_point.year:04d}" + '/' + str(input_interval) )
+
+        for source_frequency, (variables, source_frequencies) in plans.items():
+            for var in variables:
+                fre_logger.debug("Variable loop: averaging variable %s for %s", var, source_frequencies)
+                # form the input file list
+                subdir = Path(dir_ / 'ts' / grid / source / source_frequency / str(input_interval))
+
+                input_files = []
+
+                for dd in recurrence:
+                    yyyy = TimePointDumper().strftime(dd, "%Y")
+                    zzzz = TimePointDumper().strftime(dd + input_interval - one_year, "%Y")
+
+                    if source_frequency == "P1Y":
+                        input_files.append(str(subdir / f"{source}.{yyyy}-{zzzz}.{var}.nc"))
                     else:
-                        raise FileNotFoundError(f"Expected files not found in {subdir_mon}")
+                        input_files.append(str(subdir / f"{source}.{yyyy}01-{zzzz}12.{var}.nc"))
+
+                fre_logger.debug(input_files)
+
+                # form output filenames, one per frequency and window
+                window_output_files = []
+                first = cycle_point
+                for _ in range(num_windows):
+                    last = first + output_interval - one_year
+                    first_yyyy = TimePointDumper().strftime(first, "%Y")
+                    last_yyyy = TimePointDumper().strftime(last, "%Y")
+                    output_files = {}
+                    for freq in source_frequencies:
+                        if combined_dir is None:
+                            subdir = Path(dir_ / 'av' / grid / source / frequency_iso[freq] / str(output_interval))
+                            output_files[frequency_avg_type[freq]] = str( subdir / \
+                                (source + '.' + first_yyyy + '-' + last_yyyy + '.' + var + '.nc') )
+                        else:
+                            # the Bronx layout and file names of combine()
+                            subdir = Path(combined_dir) / source / 'av' / \
+                                     form_bronx_directory_name(freq, str(output_interval))
+                            date_string = first_yyyy if first_yyyy == last_yyyy else first_yyyy + '-' + last_yyyy
+                            output_files[frequency_avg_type[freq]] = str( subdir / \
+                                (source + '.' + date_string + '.nc') )
+
+                        # create output directory
+                        subdir.mkdir(parents=True, exist_ok=True)
+                    window_output_files.append(output_files)
+                    first = first + input_interval
+
+                # with combined_dir, the first variable creates the shared output files and the others append
+                append = combined_dir is not None and var != variables[0]
+                if append:
+                    # one job per source writes its variables one after the other, so no two processes
+                    # write the same file. it holds one variable's inputs open at a time
+                    job = jobs[-1]
                 else:
-                    fre_logger.debug('Skipping %s as it does not appear to be monthly or annual frequency', source)
-                    fre_logger.debug('neither %s nor %s  exists', subdir_mon, subdir_yr)
-            elif frequency == "mon":
-                subdir = Path(dir_ / 'ts' / grid / source / 'P1M' / str(input_interval))
-                if subdir.exists():
-                    results = glob.glob(str(subdir / (source + '.' + yyyy + '01-' + zzzz + '12.*.nc')))
-                    if results:
-                        variables = extract_variables_from_files(results)
-                        source_frequency = "P1M"
-                        fre_logger.debug("monthly ts to monthly climo from source %s:%s variables",
-                                         source, len(variables))
-                    else:
-                        raise FileNotFoundError(f"Expected files not found in {subdir}")
+                    job = { 'label': f'{source}/{var}' if combined_dir is None else f'{source}/{source_frequency}',
+                            'input_files': input_files, 'calls': [] }
+                    jobs.append(job)
+                if num_windows > 1:
+                    # overlapping windows from per-file partial sums, each file read once with fre-python-tools
+                    job['calls'].append( ('generate_sliding_time_averages',
+                                          { 'infile': input_files, 'outfile': window_output_files,
+                                            'window': number_of_files, 'pkg': pkg, 'var': var, 'unwgt': True,
+                                            'avg_type': list(output_files), 'append': append }) )
+                elif pkg == 'fre-python-tools':
+                    # every product from one streamed read of the timeseries
+                    job['calls'].append( ('generate_time_average',
+                                          { 'infile': input_files, 'outfile': output_files, 'pkg': pkg,
+                                            'var': var, 'unwgt': True, 'avg_type': list(output_files),
+                                            'stream': True, 'append': append }) )
                 else:
-                    fre_logger.debug("Skipping %s as it does not appear to be monthly frequency", source)
-                    fre_logger.debug(" %s does not exist", subdir)
+                    for avg_type, output_file in output_files.items():
+                        job['calls'].append( ('generate_time_average',
+                                              { 'infile': input_files, 'outfile': output_file, 'pkg': pkg,
+                                                'var': var, 'unwgt': True, 'avg_type': avg_type }) )
 
-        fre_logger.debug("source_frequency: %s", source_frequency)
-        fre_logger.debug("variables: %s", len(variables))
+    run_jobs(jobs, workers, pkg)
 
-        # then run the climo tool for each variable
-        number_of_files = output_interval.get_seconds() / input_interval.get_seconds()
-        recurrence = TimeRecurrenceParser().parse( 'R' + str(int(number_of_files)) + '/' + \
-                                                   f"{cycle_point.year:04d}" + '/' + str(input_interval) )
 
-        for var in variables:
-            fre_logger.debug("Variable loop: averaging variable %s", var)
-            # form the input file list
-            subdir = Path(dir_ / 'ts' / grid / source / source_frequency / str(input_interval))
+def estimate_job_memory(job: dict, pkg: str) -> int:
+    """
+    Rough upper bound on the memory of one averaging job. fre-python-tools streams its inputs in slabs
+    of at most DEFAULT_SLAB_BYTES, the other packages may hold all of their (merged) input at once.
+
+    :param job: Averaging job, as built by generate_wrapper
+    :type job: dict
+    :param pkg: Package doing the averaging
+    :type pkg: str
+    :return: Estimated peak memory in bytes
+    :rtype: int
+    """
+    input_sizes = [ os.path.getsize(path) for path in job['input_files'] if os.path.exists(path) ]
+    if pkg == 'fre-python-tools':
+        return JOB_BASE_MEMORY + 2 * min(max(input_sizes, default = 0), DEFAULT_SLAB_BYTES)
+    return JOB_BASE_MEMORY + 2 * sum(input_sizes)
+
 
-            input_files = []
+def max_concurrent_jobs(jobs: list[dict], workers: int, pkg: str) -> int:
+    """
+    Number of jobs that can run at once: at most workers, and few enough that every running job's
+    input files fit within the soft limit on open files, and every running job's estimated memory
+    fits within the memory currently available.
 
-            for dd in recurrence:
-                yyyy = TimePointDumper().strftime(dd, "%Y")
-                zzzz = TimePointDumper().strftime(dd + input_interval - one_year, "%Y")
+    :param jobs: Averaging jobs, as built by generate_wrapper
+    :type jobs: list[dict]
+    :param workers: Requested number of concurrent jobs
+    :type workers: int
+    :param pkg: Package doing the averaging
+    :type pkg: str
+    :return: Number of concurrent jobs, at least 1
+    :rtype: int
+    """
+    bound = max(1, min(workers, len(jobs)))
 
-                if source_frequency == "P1Y":
-                    input_files.append(str(subdir / f"{source}.{yyyy}-{zzzz}.{var}.nc"))
-                else:
-                    input_files.append(str(subdir / f"{source}.{yyyy}01-{zzzz}12.{var}.nc"))
-
-            fre_logger.debug(input_files)
-
-            # form output filename
-            first = cycle_point
-            last = cycle_point + output_interval - one_year
-            first_yyyy = TimePointDumper().strftime(first, "%Y")
-            last_yyyy = TimePointDumper().strftime(last, "%Y")
-            subdir = Path(dir_ / 'av' / grid / source / frequency_iso / str(output_interval))
-            output_file = subdir / (source + '.' + first_yyyy + '-' + last_yyyy + '.' + var + '.nc')
-
-            # create output directory
-            subdir.mkdir(parents=True, exist_ok=True)
-
-            if frequency == "yr":
-                generate_time_averages.generate_time_average(infile = input_files, outfile = str(output_file),
-                                                             pkg = pkg, var = var, unwgt = True, avg_type = 'all')
-            elif frequency == "mon":
-                generate_time_averages.generate_time_average(infile = input_files, outfile = str(output_file),
-                                                             pkg = pkg, var = var, unwgt = True, avg_type = 'month')
+    open_files_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if open_files_limit != resource.RLIM_INFINITY:
+        files_per_job = max( len(job['input_files']) for job in jobs ) + JOB_EXTRA_OPEN_FILES
+        bound = min(bound, max(1, (open_files_limit - RESERVED_OPEN_FILES) // files_per_job))
+        fre_logger.debug('open file limit %s allows %s jobs of %s files', open_files_limit,
+                         (open_files_limit - RESERVED_OPEN_FILES) // files_per_job, files_per_job)
+
+    try:
+        available_memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        available_memory = None
+    if available_memory is not None:
+        memory_per_job = max( estimate_job_memory(job, pkg) for job in jobs )
+        bound = min(bound, max(1, available_memory // memory_per_job))
+        fre_logger.debug('available memory %s bytes allows %s jobs of %s bytes', available_memory,
+                         available_memory // memory_per_job, memory_per_job)
+
+    if bound < min(workers, len(jobs)):
+        fre_logger.warning('running %s jobs at once instead of %s, to stay within open file and memory limits',
+                           bound, workers)
+    return bound
+
+
+def run_job(job: dict) -> dict:
+    """
+    Run one averaging job, catching any error so that it cannot take other jobs down with it
+
+    :param job: Averaging job, as built by generate_wrapper
+    :type job: dict
+    :return: Job label, exit status (1 if it raised), error message if any, and run time in seconds
+    :rtype: dict
+    """
+    start_time = time.perf_counter()
+    result = { 'label': job['label'], 'exitstatus': 0, 'error': None }
+    try:
+        for function_name, kwargs in job['calls']:
+            exitstatus = getattr(generate_time_averages, function_name)(**kwargs)
+            result['exitstatus'] = max(result['exitstatus'], exitstatus or 0)
+    except Exception as exc: # pylint: disable=broad-exception-caught
+        result['exitstatus'] = 1
+        result['error'] = f'{type(exc).__name__}: {exc}'
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+
+def run_jobs(jobs: list[dict], workers: int = 1, pkg: str = None) -> None:
+    """
+    Run averaging jobs, one after the other or concurrently in a pool of processes, then log a summary.
+    Run one after the other, an error raised by a job propagates at once. Run concurrently, each job runs
+    in a fresh process and its errors are caught, so every job runs before the failures are reported.
+
+    :param jobs: Averaging jobs, as built by generate_wrapper
+    :type jobs: list[dict]
+    :param workers: Requested number of concurrent jobs
+    :type workers: int
+    :param pkg: Package doing the averaging
+    :type pkg: str
+    :raises RuntimeError: Some jobs raised or exited non-zero
+    :rtype: None
+    """
+    if len(jobs) == 0:
+        fre_logger.info('no averaging jobs to run')
+        return
+    start_time = time.perf_counter()
+    num_processes = max_concurrent_jobs(jobs, workers, pkg) if workers > 1 else 1
+    results = []
+    if num_processes == 1:
+        for job in jobs:
+            job_start_time = time.perf_counter()
+            exitstatus = 0
+            for function_name, kwargs in job['calls']:
+                exitstatus = max(exitstatus, getattr(generate_time_averages, function_name)(**kwargs) or 0)
+            results.append( { 'label': job['label'], 'exitstatus': exitstatus, 'error': None,
+                              'seconds': time.perf_counter() - job_start_time } )
+    else:
+        fre_logger.info('running %s averaging jobs, %s at a time', len(jobs), num_processes)
+        # a fresh process per job returns each job's memory to the system as soon as it finishes
+        with multiprocessing.Pool(processes = num_processes, maxtasksperchild = 1) as pool:
+            for result in pool.imap_unordered(run_job, jobs):
+                fre_logger.info('finished %s in %.1f s, exit status %s',
+                                result['label'], result['seconds'], result['exitstatus'])
+                results.append(result)
+
+    failures = [ result for result in results if result['exitstatus'] != 0 ]
+    fre_logger.info('averaging summary: %s jobs, %s succeeded, %s failed, in %.1f s with %s process(es)',
+                    len(results), len(results) - len(failures), len(failures),
+                    time.perf_counter() - start_time, num_processes)
+    slowest = max(results, key = lambda result: result['seconds'])
+    fre_logger.info('slowest job: %s, %.1f s', slowest['label'], slowest['seconds'])
+    for failure in failures:
+        fre_logger.error('job %s failed with exit status %s: %s', failure['label'], failure['exitstatus'],
+                         failure['error'] if failure['error'] is not None else 'see log above')
+    if len(failures) > 0:
+        raise RuntimeError(f"{len(failures)} of {len(results)} averaging jobs failed: "
+                           f"{[ failure['label'] for failure in failures ]}")
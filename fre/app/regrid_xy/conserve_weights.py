@@ -0,0 +1,331 @@
+"""
+Native generation of first order conservative remap files, from the tiles of an input mosaic to a
+regular global lat-lon grid, as fregrid does for --interp_method conserve_order1.  As in fregrid,
+cell edges are taken as straight lines in longitude and latitude: each input cell is clipped against
+the lat-lon cells its bounding box overlaps, and the exchange-grid areas are those of fregrid's
+poly_area.  Input cells are clipped in blocks of rows, in vectorized form, over separate processes.
+"""
+
+import logging
+import multiprocessing
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from fre.app.regrid_xy import remap_cache
+
+fre_logger = logging.getLogger(__name__)
+
+# earth radius of fregrid, in m
+RADIUS = 6371000.
+
+# exchange-grid cells smaller than this fraction of their input or output cell are dropped, as in fregrid
+AREA_RATIO_THRESH = 1.e-6
+
+# latitude difference, in radians, below which an edge is taken to follow a parallel
+SMALL_VALUE = 1.e-10
+
+# distance to the pole, in radians, below which a vertex is taken to be the pole
+POLE_TOLERANCE = 1.e-10
+
+# number of input cells clipped in one block
+BLOCK_CELLS = 4096
+
+
+def read_tile_corners(tile_file: str) -> tuple[np.ndarray, np.ndarray]:
+
+    """
+    Reads the cell corners of a grid tile, every other point of its supergrid x and y
+
+    :param tile_file: grid tile file
+    :type tile_file: str
+
+    :return: corner longitudes and latitudes in radians, of shape (ny+1, nx+1)
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+
+    with xr.open_dataset(tile_file) as dataset:
+        lon = np.deg2rad(dataset["x"].values[::2, ::2].astype(np.float64))
+        lat = np.deg2rad(dataset["y"].values[::2, ::2].astype(np.float64))
+    return lon, lat
+
+
+def compact_polygons(x: np.ndarray, y: np.ndarray, keep: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    """
+    Keeps the vertices flagged in keep, shifting them to the front of each row
+
+    :param x: vertex longitudes, of shape (polygons, vertices)
+    :type x: np.ndarray
+    :param y: vertex latitudes, of shape (polygons, vertices)
+    :type y: np.ndarray
+    :param keep: vertices to keep
+    :type keep: np.ndarray
+
+    :return: vertex longitudes and latitudes, padded with zeros, and vertex count of each polygon
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+
+    counts = keep.sum(axis=1)
+    width = max(int(counts.max(initial=0)), 1)
+    rows = np.nonzero(keep)[0]
+    cols = (np.cumsum(keep, axis=1) - 1)[keep]
+    out_x = np.zeros((x.shape[0], width))
+    out_y = np.zeros((x.shape[0], width))
+    out_x[rows, cols] = x[keep]
+    out_y[rows, cols] = y[keep]
+    return out_x, out_y, counts
+
+
+def form_cell_polygons(lon: np.ndarray, lat: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    """
+    Forms the polygon of each cell from its corners, longitudes unwrapped about one vertex.
+    As fregrid's fix_lon does, a pole vertex is replaced by two, at the longitudes of its neighbours
+
+    :param lon: corner longitudes in radians, of shape (ny+1, nx+1)
+    :type lon: np.ndarray
+    :param lat: corner latitudes in radians, of shape (ny+1, nx+1)
+    :type lat: np.ndarray
+
+    :return: vertex longitudes and latitudes, of shape (ny*nx, vertices), and vertex count of each cell
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+
+    x = np.stack([lon[:-1, :-1], lon[:-1, 1:], lon[1:, 1:], lon[1:, :-1]], axis=-1).reshape(-1, 4)
+    y = np.stack([lat[:-1, :-1], lat[:-1, 1:], lat[1:, 1:], lat[1:, :-1]], axis=-1).reshape(-1, 4)
+
+    pole = np.abs(y) > 0.5*np.pi - POLE_TOLERANCE
+    ref = x[np.arange(x.shape[0]), np.argmax(~pole, axis=1)][:, None]
+    x = ref + np.mod(x - ref + np.pi, 2.*np.pi) - np.pi
+
+    pole_lat = np.copysign(0.5*np.pi, y)
+    split_x = np.stack([np.where(pole, np.roll(x, 1, axis=1), x), np.roll(x, -1, axis=1)], axis=-1)
+    split_y = np.stack([np.where(pole, pole_lat, y), pole_lat], axis=-1)
+    keep = np.stack([np.ones_like(pole), pole], axis=-1)
+    return compact_polygons(split_x.reshape(-1, 8), split_y.reshape(-1, 8), keep.reshape(-1, 8))
+
+
+def clip_polygons(x: np.ndarray, y: np.ndarray, counts: np.ndarray, bound: np.ndarray,
+                  along_lon: bool, keep_above: bool) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    """
+    Clips polygons against one boundary each, a meridian or a parallel, by Sutherland-Hodgman
+
+    :param x: vertex longitudes, of shape (polygons, vertices)
+    :type x: np.ndarray
+    :param y: vertex latitudes, of shape (polygons, vertices)
+    :type y: np.ndarray
+    :param counts: vertex count of each polygon
+    :type counts: np.ndarray
+    :param bound: boundary of each polygon
+    :type bound: np.ndarray
+    :param along_lon: whether the boundaries are meridians rather than parallels
+    :type along_lon: bool
+    :param keep_above: keep the part of each polygon above its boundary rather than below it
+    :type keep_above: bool
+
+    :return: vertex longitudes and latitudes, and vertex count of each clipped polygon
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+
+    index = np.arange(x.shape[1])[None, :]
+    valid = index < counts[:, None]
+    prev = (index - 1) % np.maximum(counts, 1)[:, None]
+    prev_x = np.take_along_axis(x, prev, axis=1)
+    prev_y = np.take_along_axis(y, prev, axis=1)
+
+    bound = bound[:, None]
+    value, prev_value = (x, prev_x) if along_lon else (y, prev_y)
+    inside = value >= bound if keep_above else value <= bound
+    prev_inside = prev_value >= bound if keep_above else prev_value <= bound
+    crossing = valid & (inside != prev_inside)
+
+    step = np.divide(bound - prev_value, value - prev_value, out=np.zeros_like(value), where=crossing)
+    cross_x = np.where(crossing, prev_x + step*(x - prev_x), 0.)
+    cross_y = np.where(crossing, prev_y + step*(y - prev_y), 0.)
+    if along_lon:
+        cross_x = np.where(crossing, bound, cross_x)
+    else:
+        cross_y = np.where(crossing, bound, cross_y)
+
+    # the crossing into or out of the kept side comes before the vertex it leads to
+    new_x = np.stack([cross_x, x], axis=-1).reshape(x.shape[0], -1)
+    new_y = np.stack([cross_y, y], axis=-1).reshape(x.shape[0], -1)
+    keep = np.stack([crossing, valid & inside], axis=-1).reshape(x.shape[0], -1)
+    return compact_polygons(new_x, new_y, keep)
+
+
+def poly_area(x: np.ndarray, y: np.ndarray, counts: np.ndarray) -> np.ndarray:
+
+    """
+    Areas of polygons with edges straight in longitude and latitude, as fregrid's poly_area computes them
+
+    :param x: vertex longitudes in radians, of shape (polygons, vertices)
+    :type x: np.ndarray
+    :param y: vertex latitudes in radians, of shape (polygons, vertices)
+    :type y: np.ndarray
+    :param counts: vertex count of each polygon
+    :type counts: np.ndarray
+
+    :return: areas in m2
+    :rtype: np.ndarray
+    """
+
+    index = np.arange(x.shape[1])[None, :]
+    valid = index < counts[:, None]
+    following = (index + 1) % np.maximum(counts, 1)[:, None]
+    dx = np.take_along_axis(x, following, axis=1) - x
+    dx = np.where(dx > np.pi, dx - 2.*np.pi, np.where(dx < -np.pi, dx + 2.*np.pi, dx))
+    lat1 = np.take_along_axis(y, following, axis=1)
+    half_dy = 0.5*(lat1 - y)
+    ratio = np.divide(np.sin(half_dy), half_dy, out=np.ones_like(half_dy), where=np.abs(2.*half_dy) >= SMALL_VALUE)
+    terms = np.where(valid, -dx*np.sin(0.5*(lat1 + y))*ratio, 0.)
+    return np.abs(terms.sum(axis=1))*RADIUS**2
+
+
+def clip_cells(lon: np.ndarray, lat: np.ndarray, nlon: int, nlat: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    """
+    Computes the exchange grid between a block of input cells and a global lat-lon grid
+
+    :param lon: corner longitudes in radians, of shape (rows+1, nx+1)
+    :type lon: np.ndarray
+    :param lat: corner latitudes in radians, of shape (rows+1, nx+1)
+    :type lat: np.ndarray
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+
+    :return: input cell of the block, in C order, output cell, lat by lon in C order, and area
+             of each exchange-grid cell
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+
+    x, y, counts = form_cell_polygons(lon, lat)
+    cell_area = poly_area(x, y, counts)
+    valid = np.arange(x.shape[1])[None, :] < counts[:, None]
+
+    # shift each cell to start within [0, 2pi), the output cells it overlaps may then wrap past 2pi
+    lon_min = np.where(valid, x, np.inf).min(axis=1)
+    shift = np.floor(lon_min/(2.*np.pi))*2.*np.pi
+    x = x - shift[:, None]
+    lon_max = np.where(valid, x, -np.inf).max(axis=1)
+    lat_min = np.where(valid, y, np.inf).min(axis=1)
+    lat_max = np.where(valid, y, -np.inf).max(axis=1)
+
+    dlon = 2.*np.pi/nlon
+    dlat = np.pi/nlat
+    i_start = np.floor((lon_min - shift)/dlon).astype(np.int64)
+    i_stop = np.maximum(np.ceil(lon_max/dlon).astype(np.int64), i_start + 1)
+    j_start = np.clip(np.floor((lat_min + 0.5*np.pi)/dlat).astype(np.int64), 0, nlat - 1)
+    j_stop = np.clip(np.ceil((lat_max + 0.5*np.pi)/dlat).astype(np.int64), j_start + 1, nlat)
+
+    # one candidate pair per input cell and output cell of its bounding box
+    ni = i_stop - i_start
+    npairs = ni*(j_stop - j_start)
+    cell = np.repeat(np.arange(x.shape[0]), npairs)
+    offset = np.arange(cell.size) - np.repeat(np.cumsum(npairs) - npairs, npairs)
+    i_out = i_start[cell] + offset % ni[cell]
+    j_out = j_start[cell] + offset // ni[cell]
+
+    pair_x, pair_y, pair_counts = x[cell], y[cell], counts[cell]
+    for bound, along_lon, keep_above in [(i_out*dlon, True, True), ((i_out + 1)*dlon, True, False),
+                                         (j_out*dlat - 0.5*np.pi, False, True),
+                                         ((j_out + 1)*dlat - 0.5*np.pi, False, False)]:
+        pair_x, pair_y, pair_counts = clip_polygons(pair_x, pair_y, pair_counts, bound, along_lon, keep_above)
+    areas = poly_area(pair_x, pair_y, pair_counts)
+
+    out_area = RADIUS**2*dlon*(np.sin((j_out + 1)*dlat - 0.5*np.pi) - np.sin(j_out*dlat - 0.5*np.pi))
+    kept = areas > AREA_RATIO_THRESH*np.minimum(cell_area[cell], out_area)
+    return cell[kept], (j_out*nlon + i_out % nlon)[kept], areas[kept]
+
+
+def write_remap_file(remap_file: str, tile1: np.ndarray, tile1_cell: np.ndarray, tile2_cell: np.ndarray,
+                     xgrid_area: np.ndarray):
+
+    """
+    Writes an exchange grid in the layout of fregrid remap files
+
+    :param remap_file: remap file
+    :type remap_file: str
+    :param tile1: 1-based input tile of each exchange-grid cell
+    :type tile1: np.ndarray
+    :param tile1_cell: 1-based (i, j) input cell of each exchange-grid cell
+    :type tile1_cell: np.ndarray
+    :param tile2_cell: 1-based (i, j) output cell of each exchange-grid cell
+    :type tile2_cell: np.ndarray
+    :param xgrid_area: area of each exchange-grid cell, in m2
+    :type xgrid_area: np.ndarray
+    """
+
+    with netCDF4.Dataset(remap_file, "w") as dataset:
+        dataset.createDimension("ncells", tile1.size)
+        dataset.createDimension("two", 2)
+        for name, dtype, dims, values, standard_name in [
+                ("tile1", "i4", ("ncells",), tile1, "tile_number_in_mosaic1"),
+                ("tile1_cell", "i4", ("ncells", "two"), tile1_cell, "parent_cell_indices_in_mosaic1"),
+                ("tile2_cell", "i4", ("ncells", "two"), tile2_cell, "parent_cell_indices_in_mosaic2"),
+                ("xgrid_area", "f8", ("ncells",), xgrid_area, "exchange_grid_area")]:
+            var = dataset.createVariable(name, dtype, dims)
+            var.standard_name = standard_name
+            var[:] = values
+        dataset["xgrid_area"].units = "m2"
+
+
+def generate_remap_file(input_mosaic: str, remap_file: str, nlon: int, nlat: int, workers: int = 1) -> int:
+
+    """
+    Generates the conserve_order1 remap file from the tiles of an input mosaic to a global lat-lon grid
+
+    :param input_mosaic: input mosaic file
+    :type input_mosaic: str
+    :param remap_file: remap file to write
+    :type remap_file: str
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+    :param workers: number of blocks of input cells clipped concurrently in separate processes
+    :type workers: int
+
+    :raises ValueError: the mosaic does not overlap the output grid
+
+    :return: number of exchange-grid cells
+    :rtype: int
+    """
+
+    blocks = []
+    for tile, tile_file in enumerate(remap_cache.get_mosaic_tile_files(input_mosaic), start=1):
+        lon, lat = read_tile_corners(tile_file)
+        nx = lon.shape[1] - 1
+        rows = max(1, BLOCK_CELLS // nx)
+        for j_start in range(0, lon.shape[0] - 1, rows):
+            j_stop = min(j_start + rows, lon.shape[0] - 1)
+            blocks.append((tile, j_start, nx, (lon[j_start:j_stop+1], lat[j_start:j_stop+1], nlon, nlat)))
+
+    num_processes = max(1, min(workers, len(blocks)))
+    fre_logger.info("Clipping %s blocks of %s to %sX%s, %s at a time",
+                    len(blocks), input_mosaic, nlon, nlat, num_processes)
+    if num_processes == 1:
+        exchanges = [clip_cells(*args) for _, _, _, args in blocks]
+    else:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            exchanges = pool.starmap(clip_cells, [args for _, _, _, args in blocks])
+
+    tile1, tile1_cell, tile2_cell, xgrid_area = [], [], [], []
+    for (tile, j_start, nx, _), (cells, out_cells, areas) in zip(blocks, exchanges):
+        tile1.append(np.full(cells.size, tile))
+        tile1_cell.append(np.stack([cells % nx + 1, j_start + cells // nx + 1], axis=1))
+        tile2_cell.append(np.stack([out_cells % nlon + 1, out_cells // nlon + 1], axis=1))
+        xgrid_area.append(areas)
+    tile1 = np.concatenate(tile1)
+    if tile1.size == 0:
+        raise ValueError(f"Mosaic {input_mosaic} does not overlap the {nlon}X{nlat} lat-lon grid")
+
+    write_remap_file(remap_file, tile1, np.concatenate(tile1_cell), np.concatenate(tile2_cell),
+                     np.concatenate(xgrid_area))
+    fre_logger.info("Wrote %s exchange-grid cells to %s", tile1.size, remap_file)
+    return tile1.size
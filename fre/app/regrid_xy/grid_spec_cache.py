@@ -0,0 +1,148 @@
+"""
+Cache of extracted grid-spec tarballs, so that pp_grid_spec is untarred once per node, or once per
+shared cache directory, rather than into the work directory of every regridding task.  Each tarball
+is extracted under an exclusive lock into a temporary directory that is renamed into place when
+complete, and is never modified afterwards; tasks then symlink the members they need into their
+work directory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+
+from fre.app.regrid_xy import remap_cache
+
+fre_logger = logging.getLogger(__name__)
+
+# default cache directory, local to the node and private to the user
+GRID_SPEC_CACHE_DIR = Path(tempfile.gettempdir())/f"fre_grid_spec_cache.{os.getuid()}"
+
+# file written last into an extracted tarball, marking the extraction complete
+MANIFEST_NAME = ".manifest.json"
+
+
+def form_grid_spec_entry(cache_dir: str, pp_grid_spec_tar: str) -> Path:
+
+    """
+    Names the cache directory a grid-spec tarball is extracted to, keyed by the absolute path,
+    size and modification time of the tarball, e.g. grid_spec.0123456789abcdef
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param pp_grid_spec_tar: grid-spec tarball
+    :type pp_grid_spec_tar: str
+
+    :return: extracted tarball directory
+    :rtype: Path
+    """
+
+    tar_path = Path(pp_grid_spec_tar).resolve()
+    stat = tar_path.stat()
+    digest = hashlib.sha256(f"{tar_path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return Path(cache_dir)/f"{tar_path.name.split('.')[0]}.{digest[:remap_cache.HASH_DIGITS]}"
+
+
+def extract_grid_spec(pp_grid_spec_tar: str, cache_dir: str = None) -> Path:
+
+    """
+    Returns the cache directory holding the extracted members of a grid-spec tarball, extracting it
+    first if no task has yet.  The tarball's size, modification time and member list are recorded
+    in the manifest of the extracted directory
+
+    :param pp_grid_spec_tar: grid-spec tarball
+    :type pp_grid_spec_tar: str
+    :param cache_dir: cache directory, GRID_SPEC_CACHE_DIR if None
+    :type cache_dir: str
+
+    :raises PermissionError: the default cache directory belongs to another user
+
+    :return: extracted tarball directory
+    :rtype: Path
+    """
+
+    if cache_dir is None:
+        cache_dir = GRID_SPEC_CACHE_DIR
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        #never trust files extracted by another user
+        if cache_dir.stat().st_uid != os.getuid():
+            raise PermissionError(f"Grid spec cache directory {cache_dir} belongs to another user")
+    else:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    entry = form_grid_spec_entry(cache_dir, pp_grid_spec_tar)
+    if (entry/MANIFEST_NAME).exists():
+        fre_logger.info("Using grid spec files of %s cached in %s", pp_grid_spec_tar, entry)
+        return entry
+
+    with remap_cache.lock_cache_entry(entry, exclusive=True):
+        # another task may have extracted it while this one waited for the lock
+        if (entry/MANIFEST_NAME).exists():
+            fre_logger.info("Using grid spec files of %s extracted by another task in %s", pp_grid_spec_tar, entry)
+            return entry
+
+        # left behind by tasks that died extracting
+        for stale_dir in [entry] + list(cache_dir.glob(f".{entry.name}.*.tmp")):
+            if stale_dir.exists():
+                fre_logger.warning("Removing incomplete grid spec directory %s", stale_dir)
+                shutil.rmtree(stale_dir)
+
+        fre_logger.info("Extracting grid spec tarfile %s to %s", pp_grid_spec_tar, entry)
+        temp_dir = cache_dir/f".{entry.name}.{os.getpid()}.tmp"
+        try:
+            with tarfile.open(pp_grid_spec_tar, "r") as tar:
+                members = tar.getnames()
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(temp_dir, filter="data")
+                else:
+                    tar.extractall(temp_dir)
+            stat = Path(pp_grid_spec_tar).stat()
+            manifest = {"tarball": str(Path(pp_grid_spec_tar).resolve()),
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "members": members}
+            with open(temp_dir/MANIFEST_NAME, "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+            os.rename(temp_dir, entry)
+        finally:
+            if temp_dir.exists():
+                shutil.rmtree(temp_dir)
+
+    return entry
+
+
+def link_grid_files(grid_files: list[Path], link_dir: str = ".") -> list[Path]:
+
+    """
+    Symlinks grid files into a directory under their own names, replacing any file already there
+
+    :param grid_files: files to link to
+    :type grid_files: list[Path]
+    :param link_dir: directory the links are made in
+    :type link_dir: str
+
+    :raises IOError: a grid file does not exist
+
+    :return: links
+    :rtype: list[Path]
+    """
+
+    links = []
+    for grid_file in grid_files:
+        grid_file = Path(grid_file).resolve()
+        if not grid_file.exists():
+            raise IOError(f"Cannot find grid file {grid_file}")
+        link = Path(link_dir)/grid_file.name
+        if not (link.is_symlink() and link.resolve() == grid_file):
+            temp_link = link.with_name(f".{link.name}.{os.getpid()}.tmp")
+            if temp_link.is_symlink():
+                temp_link.unlink()
+            os.symlink(grid_file, temp_link)
+            os.replace(temp_link, link)
+            fre_logger.debug("Linked %s to %s", link, grid_file)
+        links.append(link)
+    return links
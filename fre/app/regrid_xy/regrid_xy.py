@@ -1,12 +1,17 @@
 import logging
+import multiprocessing
 import os
 from pathlib import Path
+import shutil
 import subprocess
 import tarfile
+import time
+import netCDF4
 import xarray as xr
 import yaml
 
 from fre.app import helpers
+from fre.app.regrid_xy import conserve_weights, grid_spec_cache, remap_cache, sparse_remap
 
 fre_logger = logging.getLogger(__name__)
 
@@ -52,13 +57,14 @@ def get_grid_spec(datadict: dict) -> str:
 
     """
     Gets the mosaic.nc or grid_spec.nc file from the tar file specified in
-    yaml["postprocess"]["settings"]["pp_grid_spec"]
+    yaml["postprocess"]["settings"]["pp_grid_spec"].  The tar file is extracted once into the
+    grid spec cache, and the grid spec file is symlinked from there into the current directory
 
     :param datadict: dictionary containing relevant regrid parameters
     :type datadict: dict
 
     :raises IOError:  Error if neither mosaic.nc nor grid_spec.nc file can be found in the
-                      current directory
+                      tar file, or in the current directory if pp_grid_spec is not a tar file
 
     :return: grid_spec filename
     :rtype: str
@@ -70,21 +76,25 @@ def get_grid_spec(datadict: dict) -> str:
 
     #get tar file containing the grid_spec file
     pp_grid_spec_tar = datadict["yaml"]["postprocess"]["settings"]["pp_grid_spec"]
-    fre_logger.debug(f"Going to untar this grid spec tarfile: {pp_grid_spec_tar}")
+    fre_logger.debug(f"Going to use this grid spec tarfile: {pp_grid_spec_tar}")
 
-    #untar grid_spec tar file into the current work directory
+    #extract grid_spec tar file into the cache, unless another task already has
     if tarfile.is_tarfile(pp_grid_spec_tar):
-        with tarfile.open(pp_grid_spec_tar, "r") as tar:
-            tar.extractall()
+        grid_dir = grid_spec_cache.extract_grid_spec(pp_grid_spec_tar, datadict.get("grid_spec_cache_dir"))
+    else:
+        grid_dir = Path.cwd()
 
     #check for mosaic.nc first
-    if Path("mosaic.nc").exists():
+    if (grid_dir/"mosaic.nc").exists():
         grid_spec = "mosaic.nc"
-    elif Path("grid_spec.nc").exists():
+    elif (grid_dir/"grid_spec.nc").exists():
         grid_spec = "grid_spec.nc"
     else:
         raise IOError(f"Cannot find mosaic.nc or grid_spec.nc in tar file {pp_grid_spec_tar}")
 
+    if grid_dir != Path.cwd():
+        grid_spec_cache.link_grid_files([grid_dir/grid_spec])
+
     fre_logger.debug(f"Current directory: {Path.cwd()}")
 
     fre_logger.debug(f"Found grid spec file: {grid_spec}")
@@ -94,7 +104,9 @@ def get_grid_spec(datadict: dict) -> str:
 def get_input_mosaic(datadict: dict) -> str:
 
     """
-    Gets the input mosaic filename from the grid_spec file.
+    Gets the input mosaic filename from the grid_spec file.  If the grid_spec file links to
+    the grid spec cache, the input mosaic and its grid tiles are symlinked from there into
+    the current directory
 
     :param datadict: dictionary containing relevant regrid parameters
     :type datadict: dict
@@ -120,9 +132,15 @@ def get_input_mosaic(datadict: dict) -> str:
     with xr.open_dataset(grid_spec) as dataset:
         mosaic_file = str(dataset[mosaic_key].data.astype(str))
 
+    #link only the mosaic and its tiles out of the grid spec cache
+    grid_dir = Path(grid_spec).resolve().parent
+    if grid_dir != Path.cwd().resolve() and (grid_dir/mosaic_file).exists():
+        grid_spec_cache.link_grid_files([grid_dir/mosaic_file] +
+                                        remap_cache.get_mosaic_tile_files(str(grid_dir/mosaic_file)))
+
     #check if the mosaic file exists in the current directory
     if not Path(mosaic_file).exists():
-        raise IOError(f"Cannot find mosaic file {mosaic_file} in current work directory {work_dir}")
+        raise IOError(f"Cannot find mosaic file {mosaic_file} in current work directory {Path.cwd()}")
 
     return mosaic_file
 
@@ -162,11 +180,14 @@ def get_remap_file(datadict: dict) -> str:
 
     """
     Determines the remap filename based on the input mosaic filename, output grid size, and
-    conservative order.  For example, this function will return the name
-    C96_mosaicX180x288_conserve_order1.nc where the input mosaic filename is C96_mosaic.nc and
-    the output grid size has 180 longitude cells and 288 latitude cells.
+    conservative order, followed by a hash of the contents of the input mosaic and grid tiles.
+    For example, this function will return the name C96_mosaicX180by288_conserve_order1.0123456789abcdef.nc
+    where the input mosaic filename is C96_mosaic.nc and the output grid size has 180 longitude cells
+    and 288 latitude cells.
 
-    The remap_file will be read from, or outputted to the remap_dir.
+    The remap_file will be read from, or outputted to the remap_dir, which can be shared between tasks
+    as a cache, see remap_cache.fetch_remap_file.  A remap file pre-staged in remap_dir under the name
+    without the hash, e.g. C96_mosaicX180by288_conserve_order1.nc, is reused under the hashed name.
 
     :param datadict: dictionary containing relevant regrid parameters
     :type datadict: dict
@@ -178,23 +199,24 @@ def get_remap_file(datadict: dict) -> str:
               fregrid will read in the remapping parameters (the exchange grid for conservative methods)
               from the remap_file for regridding the variables.  If the remap_file does not exist,
               fregrid will compute the remapping parameters and save them to the remap_file
-              for future use.
+              for future use.  Since the name depends on the grid contents, a changed grid
+              never reuses a stale remap_file.
     """
 
-    input_mosaic = Path(datadict["input_mosaic"])
-    remap_dir = Path(datadict["remap_dir"])
-    nlon = datadict["output_nlon"]
-    nlat = datadict["output_nlat"]
-    interp_method = datadict["interp_method"]
+    remap_file = remap_cache.form_remap_file(datadict["remap_dir"],
+                                             datadict["input_mosaic"],
+                                             datadict["output_nlon"],
+                                             datadict["output_nlat"],
+                                             datadict["interp_method"])
 
-    #define remap filename
-    remap_file = remap_dir/Path(f"{input_mosaic.stem}X{nlon}by{nlat}_{interp_method}.nc")
+    #reuse a remap file pre-staged under the name without the hash
+    remap_cache.adopt_legacy_remap_file(remap_file)
 
     #check if remap file exists in remap_dir
     if not remap_file.exists():
         fre_logger.warning(
             f"Cannot find remap_file {remap_file}\n" \
-            f"Remap file {remap_file} will be generated and saved to directory {remap_dir}"
+            f"Remap file {remap_file} will be generated and saved to directory {datadict['remap_dir']}"
         )
 
     return str(remap_file)
@@ -223,8 +245,11 @@ def get_scalar_fields(datadict: dict) -> tuple[str, bool]:
     input_file = datadict["input_file"]
 
     #add the proper suffix to the input filename
-    with xr.open_dataset(mosaic_file) as dataset:
-        input_file += ".tile1.nc" if dataset.sizes["ntiles"] > 1 else ".nc"
+    ntiles = datadict.get("input_ntiles")
+    if ntiles is None:
+        with xr.open_dataset(mosaic_file) as dataset:
+            ntiles = dataset.sizes["ntiles"]
+    input_file += ".tile1.nc" if ntiles > 1 else ".nc"
 
     # xarray gives an error if variables in non_regriddable_variables do not exist in the dataset
     # The errors="ignore" overrides the error
@@ -269,7 +294,13 @@ def regrid_xy(yamlfile: str,
               remap_dir: str,
               source: str,
               input_date: str = None,
-):
+              remap_cache_max_bytes: int = remap_cache.REMAP_CACHE_MAX_BYTES,
+              grid_spec_cache_dir: str = None,
+              engine: str = "fregrid",
+              weight_workers: int = 1,
+              workers: int = 1,
+              variables_per_job: int = None,
+) -> list[dict]:
 
     """
     Calls fregrid to regrid data in the specified source data file.
@@ -282,9 +313,10 @@ def regrid_xy(yamlfile: str,
     :type input_dir: str
     :param output_dir: Name of the output directory where fregrid outputs will be saved
     :type output_dir: str
-    :param work_dir: Directory that will contain the extracted files from the grid_spec tar
+    :param work_dir: Directory that will contain links to the extracted files from the grid_spec tar
     :type work_dir: str
-    :param remap_dir: Directory that will contain the generated remap file
+    :param remap_dir: Directory that will contain the generated remap file.  It may be shared between
+                      concurrent tasks as a remap file cache, each remap file being generated by one task only
     :type remap_dir: str
     :param source: The stem of the history file to regrid
     :type source: str
@@ -293,10 +325,70 @@ def regrid_xy(yamlfile: str,
                        e.g., input_date=20250730T0000Z where the history filename is 
                        20250730.atmos_month_aer.tile1.nc
     :type input_date: str
+    :param remap_cache_max_bytes: Size remap_dir is trimmed to after regridding, least recently
+                                  used remap files first
+    :type remap_cache_max_bytes: int
+    :param grid_spec_cache_dir: Directory the grid_spec tar is extracted to once, and shared between tasks.
+                                Defaults to a directory local to the node and private to the user,
+                                see grid_spec_cache.GRID_SPEC_CACHE_DIR
+    :type grid_spec_cache_dir: str
+    :param engine: "fregrid", or "sparse" to generate and apply conserve_order1 remap files in-process,
+                   falling back to fregrid for other methods
+    :type engine: str
+    :param weight_workers: Number of processes generating conserve_order1 remap files with the sparse engine
+    :type weight_workers: int
+    :param workers: Number of regridding jobs, fregrid runs or sparse engine ones, run concurrently
+    :type workers: int
+    :param variables_per_job: Largest number of variables regridded by one job.  The variables of an input file
+                              are split into batches regridded concurrently, then merged into one output file
+    :type variables_per_job: int
+
+    :return: report of each regridding job: component, input_file, variables, output_dir, remap_file,
+             remap_generated and wall time in seconds
+    :rtype: list[dict]
 
     .. note:: All directories should be in absolute paths
     """
 
+    return regrid_xy_batch(yamlfile, input_dir, output_dir, work_dir, remap_dir, [source], [input_date],
+                           remap_cache_max_bytes=remap_cache_max_bytes,
+                           grid_spec_cache_dir=grid_spec_cache_dir,
+                           engine=engine,
+                           weight_workers=weight_workers,
+                           workers=workers,
+                           variables_per_job=variables_per_job)
+
+
+def regrid_xy_batch(yamlfile: str,
+                    input_dir: str,
+                    output_dir: str,
+                    work_dir: str,
+                    remap_dir: str,
+                    sources: list[str],
+                    input_dates: list[str],
+                    remap_cache_max_bytes: int = remap_cache.REMAP_CACHE_MAX_BYTES,
+                    grid_spec_cache_dir: str = None,
+                    engine: str = "fregrid",
+                    weight_workers: int = 1,
+                    workers: int = 1,
+                    variables_per_job: int = None,
+) -> list[dict]:
+
+    """
+    Regrids the source data files of every source and input date in one go.  The yaml file, grid spec,
+    input mosaics and remap files are resolved once, then the regridding jobs of all sources and dates
+    are run together, see regrid_xy for the parameters
+
+    :param sources: The stems of the history files to regrid
+    :type sources: list[str]
+    :param input_dates: Datestrings where the first 8 characters correspond to YYYYMMDD,
+                        each source being regridded for every date
+    :type input_dates: list[str]
+
+    :return: report of each regridding job, see regrid_xy
+    :rtype: list[dict]
+    """
+
     #check if input_dir exists
     if not Path(input_dir).exists():
         raise RuntimeError(f"Input directory {input_dir} containing the input data files does not exist")
@@ -310,6 +402,9 @@ def regrid_xy(yamlfile: str,
     if not Path(work_dir).exists():
         raise RuntimeError(f"Specified working directory {work_dir} does not exist")
 
+    if engine not in ["fregrid", "sparse"]:
+        raise ValueError(f"Unknown regridding engine {engine}, expected fregrid or sparse")
+
     #work in working directory
     with helpers.change_directory(work_dir):
 
@@ -322,83 +417,377 @@ def regrid_xy(yamlfile: str,
 
         # save arguments to datadict
         datadict["yaml"] = yamldict
+        datadict["grid_spec_cache_dir"] = grid_spec_cache_dir
+        datadict["weight_workers"] = weight_workers
         datadict["grid_spec"] = get_grid_spec(datadict)
         datadict["input_dir"] = input_dir
         datadict["output_dir"] = output_dir
         datadict["work_dir"] = work_dir
         datadict["remap_dir"] = remap_dir
-        datadict["input_date"] = input_date[:8]
-
-        # add temporal and static history files
-        components = []
-        for component in yamldict["postprocess"]["components"]:
-            for temporal_history in component["sources"]:
-                if temporal_history["history_file"] == source:
-                    components.append(component)
-            if "static" in component:
-                for static_history in component["static"]:
-                    if static_history["source"] == source:
-                        components.append(component)
 
-        # submit fregrid job for each component
-        for component in components:
-            # If postprocess_on is not defined, it should have the default value of True
-            # If postprocess_on is defined, check for a True or False value
-            if "postprocess_on" in component:
-                # skip component if postprocess_on = False
-                if not component["postprocess_on"]:
-                    fre_logger.warning(f"postprocess_on=False for {source} in component {component['type']}." \
-                                        "Skipping {source}")
+        # settings of the components to regrid, resolved once for all sources and dates
+        mosaics = {}
+        remap_files = {}
+        component_dicts = {}
+
+        # gather the regridding jobs of every source, date and component, then run them
+        jobs = []
+        batch_outputs = {}
+        for source in sources:
+
+            # add temporal and static history files
+            components = []
+            for component in yamldict["postprocess"]["components"]:
+                for temporal_history in component["sources"]:
+                    if temporal_history["history_file"] == source:
+                        components.append(component)
+                if "static" in component:
+                    for static_history in component["static"]:
+                        if static_history["source"] == source:
+                            components.append(component)
+
+            for component in components:
+                # If postprocess_on is not defined, it should have the default value of True
+                # If postprocess_on is defined, check for a True or False value
+                if "postprocess_on" in component:
+                    # skip component if postprocess_on = False
+                    if not component["postprocess_on"]:
+                        fre_logger.warning(f"postprocess_on=False for {source} in component {component['type']}." \
+                                            f"Skipping {source}")
+                        continue
+
+                # skip component if xyInterp is not set
+                if 'xyInterp' not in component:
+                    fre_logger.info(f"Skipping native component '{component}'")
                     continue
 
-            # skip component if xyInterp is not set
-            if 'xyInterp' not in component:
-                fre_logger.info(f"Skipping native component '{component}'")
-                continue
-            datadict["inputRealm"] = component["inputRealm"]
-            datadict["input_mosaic"] = get_input_mosaic(datadict)
-            datadict["output_nlat"], datadict["output_nlon"] = component["xyInterp"].split(",")
-            datadict["interp_method"] = component["interpMethod"]
-            datadict["remap_file"] = get_remap_file(datadict)
-            datadict["input_file"] = get_input_file(datadict, source)
-            datadict["scalar_field"], regrid = get_scalar_fields(datadict)
-
-            # skip if there are no variables to regrid
-            if regrid:
-                write_summary(datadict)
-            else:
-                continue
-
-            # create the output dir
-            output_subdir = (
-                Path(output_dir)
-                / f"{datadict['output_nlat']}_{datadict['output_nlon']}.{datadict['interp_method']}"
-            )
-            output_subdir.mkdir(parents=True, exist_ok=True)
-
-            #construct fregrid command
-            fregrid_command = [
-                "fregrid",
-                "--debug",
-                "--standard_dimension",
-                "--input_dir", input_dir,
-                "--input_mosaic", datadict["input_mosaic"],
-                "--input_file", datadict["input_file"],
-                "--interp_method", datadict["interp_method"],
-                "--remap_file", datadict["remap_file"],
-                "--nlon", datadict["output_nlon"],
-                "--nlat", datadict["output_nlat"],
-                "--scalar_field", datadict["scalar_field"],
-                "--output_dir", output_subdir,
-                "--associated_file_dir", input_dir
-            ]
-            fre_logger.debug(f"fregrid command: {fregrid_command}")
-
-            #execute fregrid command
-            fregrid_job = subprocess.run(fregrid_command, capture_output=True, text=True)
-
-            #print job useful information
-            if fregrid_job.returncode == 0:
-                fre_logger.info(fregrid_job.stdout.split("\n")[-3:])
-            else:
-                raise RuntimeError(fregrid_job.stderr)
+                if id(component) not in component_dicts:
+                    component_dicts[id(component)] = resolve_component(datadict, component, mosaics, remap_files)
+
+                for input_date in input_dates:
+                    datadict_date = dict(component_dicts[id(component)],
+                                         input_date=input_date[:8] if input_date else None)
+                    jobs += form_regrid_jobs(datadict_date, source, variables_per_job, batch_outputs)
+
+        try:
+            reports = run_regrid_jobs(jobs, engine, workers, remap_cache_max_bytes)
+            for output_file, batch_files in batch_outputs.items():
+                if batch_files:
+                    merge_batch_outputs(batch_files, output_file)
+        finally:
+            for batch_files in batch_outputs.values():
+                for batch_file in batch_files:
+                    shutil.rmtree(batch_file.parent, ignore_errors=True)
+
+    return reports
+
+
+def resolve_component(datadict: dict, component: dict, mosaics: dict, remap_files: dict) -> dict:
+
+    """
+    Resolves the regridding settings of a component that do not depend on the source or date:
+    its input mosaic and number of tiles, output grid, interpolation method and remap file.
+    Input mosaics and remap files are looked up once, in mosaics and remap_files
+
+    :param datadict: dictionary containing relevant regrid parameters
+    :type datadict: dict
+    :param component: component of the yaml configuration
+    :type component: dict
+    :param mosaics: input mosaic and number of tiles of each input realm resolved so far
+    :type mosaics: dict
+    :param remap_files: remap file of each input mosaic, output grid and interpolation method resolved so far
+    :type remap_files: dict
+
+    :return: datadict of the component
+    :rtype: dict
+    """
+
+    component_dict = dict(datadict, component=component["type"], inputRealm=component["inputRealm"])
+    if component["inputRealm"] not in mosaics:
+        input_mosaic = get_input_mosaic(component_dict)
+        with xr.open_dataset(input_mosaic) as dataset:
+            mosaics[component["inputRealm"]] = (input_mosaic, dataset.sizes["ntiles"])
+    component_dict["input_mosaic"], component_dict["input_ntiles"] = mosaics[component["inputRealm"]]
+    component_dict["output_nlat"], component_dict["output_nlon"] = component["xyInterp"].split(",")
+    component_dict["interp_method"] = component["interpMethod"]
+
+    remap_key = (component_dict["input_mosaic"], component_dict["output_nlat"],
+                 component_dict["output_nlon"], component_dict["interp_method"])
+    if remap_key not in remap_files:
+        remap_files[remap_key] = get_remap_file(component_dict)
+    component_dict["remap_file"] = remap_files[remap_key]
+    return component_dict
+
+
+def form_regrid_jobs(datadict: dict, source: str, variables_per_job: int, batch_outputs: dict) -> list[dict]:
+
+    """
+    Forms the regridding jobs of a source file for a component, one per batch of variables.
+    Output files already in batch_outputs, from components sharing the interpolation, are skipped
+
+    :param datadict: datadict of the component, see resolve_component, with the input date
+    :type datadict: dict
+    :param source: history file type
+    :type source: str
+    :param variables_per_job: largest batch of variables, see split_variables
+    :type variables_per_job: int
+    :param batch_outputs: regridded file of each batch, by output file, updated with the output file of the jobs
+    :type batch_outputs: dict
+
+    :return: jobs, datadicts with the batch of variables as scalar_field and the directory to write to
+             as output_subdir
+    :rtype: list[dict]
+    """
+
+    datadict = dict(datadict)
+    datadict["input_file"] = get_input_file(datadict, source)
+    datadict["scalar_field"], regrid = get_scalar_fields(datadict)
+
+    # skip if there are no variables to regrid
+    if regrid:
+        write_summary(datadict)
+    else:
+        return []
+
+    # create the output dir
+    output_subdir = (
+        Path(datadict["output_dir"])
+        / f"{datadict['output_nlat']}_{datadict['output_nlon']}.{datadict['interp_method']}"
+    )
+    output_subdir.mkdir(parents=True, exist_ok=True)
+
+    # components sharing the interpolation write the same output file, regrid it once
+    output_file = output_subdir/f"{datadict['input_file']}.nc"
+    if output_file in batch_outputs:
+        fre_logger.info(f"{output_file} is already regridded for another component, skipping")
+        return []
+
+    jobs = []
+    batches = split_variables(datadict["scalar_field"].split(","), variables_per_job)
+    batch_outputs[output_file] = []
+    for index, batch in enumerate(batches):
+        job = dict(datadict, scalar_field=",".join(batch))
+        # batches are written to their own directory, then merged
+        if len(batches) > 1:
+            job["output_subdir"] = output_subdir/f".{datadict['input_file']}.{os.getpid()}.batch{index}"
+            job["output_subdir"].mkdir(exist_ok=True)
+            batch_outputs[output_file].append(job["output_subdir"]/output_file.name)
+        else:
+            job["output_subdir"] = output_subdir
+        jobs.append(job)
+    return jobs
+
+
+def split_variables(variables: list[str], variables_per_job: int = None) -> list[list[str]]:
+
+    """
+    Splits the variables to regrid into batches of at most variables_per_job variables
+
+    :param variables: variables to regrid
+    :type variables: list[str]
+    :param variables_per_job: largest batch, None for a single batch
+    :type variables_per_job: int
+
+    :raises ValueError: variables_per_job is less than 1
+
+    :return: batches of variables
+    :rtype: list[list[str]]
+    """
+
+    if variables_per_job is None:
+        return [variables]
+    if variables_per_job < 1:
+        raise ValueError(f"variables_per_job must be at least 1, not {variables_per_job}")
+    return [variables[start:start+variables_per_job] for start in range(0, len(variables), variables_per_job)]
+
+
+def run_regrid_job(job: dict, engine: str, remap_cache_max_bytes: int) -> dict:
+
+    """
+    Regrids a batch of variables with the cached remap file, fregrid generating it if it is missing,
+    and times it
+
+    :param job: datadict of the component, with the batch of variables as scalar_field
+                and the directory to write to as output_subdir
+    :type job: dict
+    :param engine: "fregrid" or "sparse", see regrid_xy
+    :type engine: str
+    :param remap_cache_max_bytes: size the remap cache is trimmed to
+    :type remap_cache_max_bytes: int
+
+    :return: report of the job, with its wall time in seconds
+    :rtype: dict
+    """
+
+    def regrid(remap_file):
+        if engine == "sparse" and run_sparse_regrid(job, remap_file, job["output_subdir"]):
+            return
+        run_fregrid(job, remap_file, job["output_subdir"])
+
+    start = time.perf_counter()
+    generated = remap_cache.fetch_remap_file(job["remap_file"], regrid, remap_cache_max_bytes)
+    seconds = time.perf_counter() - start
+
+    variables = job["scalar_field"].split(",")
+    fre_logger.info(f"Regridded {len(variables)} variables of {job['input_file']} for component "
+                    f"{job['component']} in {seconds:.2f} s")
+    return {"component": job["component"],
+            "input_file": job["input_file"],
+            "variables": variables,
+            "output_dir": str(job["output_subdir"]),
+            "remap_file": str(job["remap_file"]),
+            "remap_generated": generated,
+            "seconds": seconds}
+
+
+def run_regrid_jobs(jobs: list[dict], engine: str, workers: int, remap_cache_max_bytes: int) -> list[dict]:
+
+    """
+    Runs regridding jobs, workers at a time.  Jobs needing the same missing remap file wait for
+    the one generating it, see remap_cache.fetch_remap_file
+
+    :param jobs: jobs, see run_regrid_job
+    :type jobs: list[dict]
+    :param engine: "fregrid" or "sparse", see regrid_xy
+    :type engine: str
+    :param workers: number of jobs run concurrently
+    :type workers: int
+    :param remap_cache_max_bytes: size the remap cache is trimmed to
+    :type remap_cache_max_bytes: int
+
+    :return: report of each job, in the order of jobs
+    :rtype: list[dict]
+    """
+
+    num_processes = max(1, min(workers, len(jobs)))
+    fre_logger.info(f"Running {len(jobs)} regridding jobs, {num_processes} at a time")
+    start = time.perf_counter()
+    if num_processes == 1:
+        reports = [run_regrid_job(job, engine, remap_cache_max_bytes) for job in jobs]
+    else:
+        # separate processes rather than threads, the netCDF library is not thread-safe
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            reports = pool.starmap(run_regrid_job, [(job, engine, remap_cache_max_bytes) for job in jobs])
+    if jobs:
+        fre_logger.info(f"Ran {len(jobs)} regridding jobs in {time.perf_counter() - start:.2f} s, "
+                        f"{sum(report['seconds'] for report in reports):.2f} s of job time")
+    return reports
+
+
+def merge_batch_outputs(batch_files: list[Path], output_file: Path):
+
+    """
+    Merges the regridded files of the variable batches of one input file into its output file,
+    written to a temporary file first, then moved into place
+
+    :param batch_files: regridded file of each batch
+    :type batch_files: list[Path]
+    :param output_file: merged output file
+    :type output_file: Path
+    """
+
+    temp_file = output_file.with_name(f".{output_file.name}.{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(batch_files[0], temp_file)
+        with netCDF4.Dataset(temp_file, "a") as nc_out:
+            for batch_file in batch_files[1:]:
+                with netCDF4.Dataset(batch_file, "r") as nc_in:
+                    for name in nc_in.variables:
+                        if name not in nc_out.variables:
+                            sparse_remap.copy_variable(nc_in, nc_out, name)
+        os.replace(temp_file, output_file)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+    fre_logger.info(f"Merged {len(batch_files)} variable batches into {output_file}")
+
+
+def run_sparse_regrid(datadict: dict, remap_file: str, output_subdir: Path) -> bool:
+
+    """
+    Regrids the input file of datadict in-process with a remap file, see sparse_remap, writing the same
+    output file fregrid would.  A missing remap file is generated first, see conserve_weights
+
+    :param datadict: dictionary containing relevant regrid parameters
+    :type datadict: dict
+    :param remap_file: remap file, generated if it does not exist
+    :type remap_file: str
+    :param output_subdir: directory the regridded file is written to
+    :type output_subdir: Path
+
+    :return: whether the input file was regridded, if not fregrid has to be run instead
+    :rtype: bool
+    """
+
+    if datadict["interp_method"] not in sparse_remap.SPARSE_INTERP_METHODS:
+        fre_logger.info(f"Interp method {datadict['interp_method']} is not supported in-process, using fregrid")
+        return False
+
+    input_dir = Path(datadict["input_dir"])
+    ntiles = datadict.get("input_ntiles")
+    if ntiles is None:
+        with xr.open_dataset(datadict["input_mosaic"]) as dataset:
+            ntiles = dataset.sizes["ntiles"]
+    if ntiles > 1:
+        input_files = [input_dir/f"{datadict['input_file']}.tile{tile}.nc" for tile in range(1, ntiles+1)]
+    else:
+        input_files = [input_dir/f"{datadict['input_file']}.nc"]
+
+    try:
+        if not Path(remap_file).exists():
+            conserve_weights.generate_remap_file(datadict["input_mosaic"], remap_file, int(datadict["output_nlon"]),
+                                                 int(datadict["output_nlat"]), datadict.get("weight_workers", 1))
+        sparse_remap.regrid_file(remap_file, input_files, output_subdir/f"{datadict['input_file']}.nc",
+                                 datadict["scalar_field"].split(","),
+                                 int(datadict["output_nlon"]), int(datadict["output_nlat"]))
+    except ValueError as error:
+        fre_logger.warning(f"Cannot regrid {datadict['input_file']} in-process, using fregrid: {error}")
+        return False
+
+    fre_logger.info(f"Regridded {datadict['input_file']} in-process with {remap_file}")
+    return True
+
+
+def run_fregrid(datadict: dict, remap_file: str, output_subdir: Path):
+
+    """
+    Runs fregrid on the input file of datadict
+
+    :param datadict: dictionary containing relevant regrid parameters
+    :type datadict: dict
+    :param remap_file: remap file fregrid reads, or generates if it does not exist
+    :type remap_file: str
+    :param output_subdir: directory the regridded file is written to
+    :type output_subdir: Path
+
+    :raises RuntimeError: fregrid failed
+    """
+
+    #construct fregrid command
+    fregrid_command = [
+        "fregrid",
+        "--standard_dimension",
+        "--input_dir", datadict["input_dir"],
+        "--input_mosaic", datadict["input_mosaic"],
+        "--input_file", datadict["input_file"],
+        "--interp_method", datadict["interp_method"],
+        "--remap_file", remap_file,
+        "--nlon", datadict["output_nlon"],
+        "--nlat", datadict["output_nlat"],
+        "--scalar_field", datadict["scalar_field"],
+        "--output_dir", output_subdir,
+        "--associated_file_dir", datadict["input_dir"]
+    ]
+    #fregrid's debug output is only worth its cost when it is logged
+    if fre_logger.isEnabledFor(logging.DEBUG):
+        fregrid_command.append("--debug")
+    fre_logger.debug(f"fregrid command: {fregrid_command}")
+
+    #execute fregrid command
+    fregrid_job = subprocess.run(fregrid_command, capture_output=True, text=True)
+
+    #print job useful information
+    if fregrid_job.returncode == 0:
+        fre_logger.info(fregrid_job.stdout.split("\n")[-3:])
+    else:
+        raise RuntimeError(fregrid_job.stderr)
@@ -0,0 +1,335 @@
+"""
+Shared cache of fregrid remap files, keyed by the contents of the input mosaic and its grid tiles,
+the output grid and the interpolation method.  Concurrent tasks sharing the cache directory
+generate each remap file once: the first takes an exclusive lock and runs fregrid, the others
+wait on the lock and then read the finished file.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import netCDF4
+import xarray as xr
+
+fre_logger = logging.getLogger(__name__)
+
+# size the cache directory is trimmed to, least recently used remap files first
+REMAP_CACHE_MAX_BYTES = 50 * 1024**3
+
+# bytes read at a time when hashing grid files
+HASH_BLOCK_BYTES = 1024**2
+
+# number of hex digits of the content hash kept in remap filenames
+HASH_DIGITS = 16
+
+# remap filenames made by form_remap_file, {mosaic stem}X{nlon}by{nlat}_{method}.{hash}.nc
+REMAP_FILE_PATTERN = re.compile(rf".+X\d+by\d+_.+\.[0-9a-f]{{{HASH_DIGITS}}}\.nc$")
+
+
+def get_mosaic_tile_files(input_mosaic: str) -> list[Path]:
+
+    """
+    Lists the grid tile files of a mosaic, found next to the mosaic file
+    or in its gridlocation directory if it has one, relative to the mosaic file's directory
+    unless absolute
+
+    :param input_mosaic: mosaic file
+    :type input_mosaic: str
+
+    :return: grid tile files, in mosaic order
+    :rtype: list[Path]
+    """
+
+    with xr.open_dataset(input_mosaic) as dataset:
+        gridfiles = [gridfile.decode().strip() if isinstance(gridfile, bytes) else str(gridfile).strip()
+                     for gridfile in dataset["gridfiles"].values.ravel()]
+        gridlocation = ""
+        if "gridlocation" in dataset:
+            gridlocation = dataset["gridlocation"].values.ravel()[0]
+            gridlocation = gridlocation.decode().strip() if isinstance(gridlocation, bytes) else str(gridlocation)
+
+    #an absolute gridlocation replaces the mosaic's directory, a relative one, e.g. "./", is joined to it
+    grid_dir = Path(input_mosaic).parent/gridlocation.strip()
+    return [grid_dir/gridfile for gridfile in gridfiles]
+
+
+def hash_remap_inputs(input_mosaic: str, nlon: int, nlat: int, interp_method: str) -> str:
+
+    """
+    Hashes everything a remap file depends on: the bytes of the input mosaic and of its grid tiles,
+    the output grid size and the interpolation method
+
+    :param input_mosaic: input mosaic file
+    :type input_mosaic: str
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+    :param interp_method: fregrid interpolation method
+    :type interp_method: str
+
+    :raises IOError: a grid tile file listed in the mosaic does not exist
+
+    :return: hex sha256 digest
+    :rtype: str
+    """
+
+    digest = hashlib.sha256(f"{nlon},{nlat},{interp_method}".encode())
+    for grid_file in [Path(input_mosaic)] + get_mosaic_tile_files(input_mosaic):
+        if not grid_file.exists():
+            raise IOError(f"Cannot find grid file {grid_file} of mosaic {input_mosaic}")
+        digest.update(grid_file.name.encode())
+        with open(grid_file, "rb") as openedfile:
+            while block := openedfile.read(HASH_BLOCK_BYTES):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def form_remap_file(remap_dir: str, input_mosaic: str, nlon: int, nlat: int, interp_method: str) -> Path:
+
+    """
+    Names the cached remap file of an input mosaic, output grid and interpolation method,
+    e.g. C96_mosaicX288by180_conserve_order1.0123456789abcdef.nc
+
+    :param remap_dir: cache directory
+    :type remap_dir: str
+    :param input_mosaic: input mosaic file
+    :type input_mosaic: str
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+    :param interp_method: fregrid interpolation method
+    :type interp_method: str
+
+    :return: remap file path
+    :rtype: Path
+    """
+
+    digest = hash_remap_inputs(input_mosaic, nlon, nlat, interp_method)[:HASH_DIGITS]
+    return Path(remap_dir)/f"{Path(input_mosaic).stem}X{nlon}by{nlat}_{interp_method}.{digest}.nc"
+
+
+def adopt_legacy_remap_file(remap_file: Path) -> bool:
+
+    """
+    Brings a remap file pre-staged under its name without the content hash, e.g.
+    C96_mosaicX288by180_conserve_order1.nc, into the cache under its hashed name, hard-linked
+    if possible and copied otherwise, so that workflows staging remap files keep reusing them.
+    The pre-staged file is trusted to match the grid, as it was before remap files were hashed
+
+    :param remap_file: cached remap file, see form_remap_file
+    :type remap_file: Path
+
+    :return: whether a pre-staged remap file was adopted
+    :rtype: bool
+    """
+
+    remap_file = Path(remap_file)
+    legacy_file = remap_file.with_name(f"{remap_file.name.rsplit('.', 2)[0]}.nc")
+    if remap_file.exists() or not validate_remap_file(legacy_file):
+        return False
+
+    temp_file = remap_file.with_name(f".{remap_file.stem}.{os.getpid()}.tmp.nc")
+    try:
+        try:
+            os.link(legacy_file, temp_file)
+        except OSError:
+            shutil.copy2(legacy_file, temp_file)
+        os.replace(temp_file, remap_file)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+    fre_logger.info("Using pre-staged remap file %s as %s", legacy_file, remap_file)
+    return True
+
+
+def validate_remap_file(remap_file: str) -> bool:
+
+    """
+    Checks that a remap file is a readable, non-empty netCDF file
+
+    :param remap_file: remap file
+    :type remap_file: str
+
+    :return: whether the remap file can be used
+    :rtype: bool
+    """
+
+    if not Path(remap_file).is_file() or Path(remap_file).stat().st_size == 0:
+        return False
+    try:
+        with netCDF4.Dataset(remap_file, "r") as dataset:
+            return len(dataset.variables) > 0
+    except OSError as error:
+        fre_logger.warning("Remap file %s cannot be read: %s", remap_file, error)
+        return False
+
+
+def form_lock_path(entry: Path) -> Path:
+
+    """
+    Names the lock file of a cache entry, hidden next to it, e.g. .C4_mosaic.0123456789abcdef.nc.lock
+
+    :param entry: cached file or directory
+    :type entry: Path
+
+    :return: lock file
+    :rtype: Path
+    """
+
+    return entry.with_name(f".{entry.name}.lock")
+
+
+@contextmanager
+def lock_cache_entry(entry: Path, exclusive: bool, blocking: bool = True):
+
+    """
+    Holds a lock on a cache entry, a remap file or an extracted directory, through a lock file
+    next to it.  The lock file may be removed, with the entry, by a task holding the exclusive lock,
+    so a lock taken on a lock file no longer in place is dropped and taken again on the new one
+
+    :param entry: cached file or directory
+    :type entry: Path
+    :param exclusive: take an exclusive lock, to write the entry, rather than a shared one, to read it
+    :type exclusive: bool
+    :param blocking: wait for the lock, otherwise yield False at once if it is held elsewhere
+    :type blocking: bool
+
+    :return: whether the lock was taken
+    :rtype: bool
+    """
+
+    lock_path = form_lock_path(entry)
+    operation = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB)
+    while True:
+        with open(lock_path, "ab") as lock_file:
+            try:
+                fcntl.flock(lock_file, operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                in_place = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                in_place = False
+            if not in_place:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                continue
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return
+
+
+def evict_remap_files(remap_dir: str, max_bytes: int, keep: Path = None) -> list[Path]:
+
+    """
+    Removes the least recently used remap files of the cache until it fits in max_bytes.
+    Remap files in use elsewhere, and keep, are never removed
+
+    :param remap_dir: cache directory
+    :type remap_dir: str
+    :param max_bytes: size to trim the cache to
+    :type max_bytes: int
+    :param keep: remap file to keep whatever its age
+    :type keep: Path
+
+    :return: removed remap files
+    :rtype: list[Path]
+    """
+
+    entries = {}
+    for entry in Path(remap_dir).iterdir():
+        if REMAP_FILE_PATTERN.match(entry.name):
+            try:
+                entries[entry] = entry.stat()
+            except FileNotFoundError:
+                #evicted by another task meanwhile
+                continue
+    total_bytes = sum(stat.st_size for stat in entries.values())
+    removed = []
+    for entry, stat in sorted(entries.items(), key=lambda item: item[1].st_mtime):
+        if total_bytes <= max_bytes:
+            break
+        if keep is not None and entry == keep:
+            continue
+        with lock_cache_entry(entry, exclusive=True, blocking=False) as locked:
+            if not locked or not entry.exists():
+                continue
+            size = stat.st_size
+            entry.unlink()
+            # removed while still locked, tasks waiting on it lock the next lock file instead
+            form_lock_path(entry).unlink()
+        total_bytes -= size
+        removed.append(entry)
+        fre_logger.info("Evicted remap file %s from the remap cache, %s bytes", entry, size)
+    if total_bytes > max_bytes:
+        fre_logger.warning("Remap cache %s holds %s bytes, over its %s byte limit", remap_dir, total_bytes, max_bytes)
+    return removed
+
+
+def fetch_remap_file(remap_file: Path, regrid: Callable[[str], None],
+                     max_bytes: int = REMAP_CACHE_MAX_BYTES) -> bool:
+
+    """
+    Runs regrid with a remap file of the cache.  If the remap file is missing or invalid, regrid is
+    run under an exclusive lock with a temporary remap file it is expected to generate, as fregrid
+    does, which then replaces the cached one.  Otherwise regrid reads the cached remap file under a
+    shared lock, alongside other readers.  Afterwards the cache is trimmed to max_bytes
+
+    :param remap_file: cached remap file, see form_remap_file
+    :type remap_file: Path
+    :param regrid: function regridding with the remap file path given to it
+    :type regrid: Callable[[str], None]
+    :param max_bytes: size to trim the cache to
+    :type max_bytes: int
+
+    :raises RuntimeError: regrid did not generate a valid remap file
+
+    :return: whether the remap file was generated
+    :rtype: bool
+    """
+
+    remap_file = Path(remap_file)
+    generated = False
+    with lock_cache_entry(remap_file, exclusive=False):
+        found = validate_remap_file(remap_file)
+        if found:
+            fre_logger.info("Using cached remap file %s", remap_file)
+            os.utime(remap_file)
+            regrid(str(remap_file))
+
+    if not found:
+        with lock_cache_entry(remap_file, exclusive=True):
+            # another task may have generated it while this one waited for the lock
+            if validate_remap_file(remap_file):
+                fre_logger.info("Using remap file %s generated by another task", remap_file)
+                os.utime(remap_file)
+                regrid(str(remap_file))
+            else:
+                if remap_file.exists():
+                    fre_logger.warning("Removing invalid remap file %s", remap_file)
+                    remap_file.unlink()
+                fre_logger.warning("Cannot find remap file %s, generating it", remap_file)
+                temp_file = remap_file.with_name(f".{remap_file.stem}.{os.getpid()}.tmp.nc")
+                try:
+                    regrid(str(temp_file))
+                    if not validate_remap_file(temp_file):
+                        raise RuntimeError(f"Regridding did not generate a valid remap file {temp_file}")
+                    os.replace(temp_file, remap_file)
+                finally:
+                    if temp_file.exists():
+                        temp_file.unlink()
+                generated = True
+
+    evict_remap_files(remap_file.parent, max_bytes, keep=remap_file)
+    return generated
@@ -0,0 +1,286 @@
+"""
+In-process application of fregrid remap files.  The exchange grid of a remap file is loaded once
+into a compressed sparse row matrix of exchange-grid areas, from the input cells to the output
+lat-lon cells, and applied to every regriddable variable of an input file, slab by slab.  Only
+first order conservative remapping is supported, other methods are left to fregrid.
+"""
+
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+fre_logger = logging.getLogger(__name__)
+
+# interpolation methods the remap matrix reproduces
+SPARSE_INTERP_METHODS = ["conserve_order1"]
+
+# bytes of exchange-grid values gathered at a time when applying a remap matrix
+SLAB_BLOCK_BYTES = 256 * 1024**2
+
+# attributes of the input variables that do not apply to the regridded ones
+DROPPED_ATTRIBUTES = ["_FillValue", "missing_value", "scale_factor", "add_offset",
+                      "coordinates", "cell_measures", "cell_methods_area"]
+
+
+class RemapMatrix:
+
+    """
+    Exchange-grid areas of a remap file, as a compressed sparse row matrix from the input cells,
+    numbered tile by tile in C order, to the output cells, numbered lat by lon in C order.
+    Only output cells overlapping input cells have rows
+    """
+
+    def __init__(self, in_cells: np.ndarray, out_cells: np.ndarray, areas: np.ndarray,
+                 n_in: int, n_out: int):
+
+        """
+        :param in_cells: input cell of each exchange-grid cell
+        :type in_cells: np.ndarray
+        :param out_cells: output cell of each exchange-grid cell
+        :type out_cells: np.ndarray
+        :param areas: area of each exchange-grid cell
+        :type areas: np.ndarray
+        :param n_in: number of input cells
+        :type n_in: int
+        :param n_out: number of output cells
+        :type n_out: int
+
+        :raises ValueError: cells out of the input or output grid
+        """
+
+        if in_cells.size and (in_cells.min() < 0 or in_cells.max() >= n_in):
+            raise ValueError(f"Remap file input cells do not fit an input grid of {n_in} cells")
+        if out_cells.size and (out_cells.min() < 0 or out_cells.max() >= n_out):
+            raise ValueError(f"Remap file output cells do not fit an output grid of {n_out} cells")
+
+        order = np.argsort(out_cells, kind="stable")
+        self.indices = in_cells[order]
+        self.areas = areas[order].astype(np.float64)
+        self.rows, self.starts = np.unique(out_cells[order], return_index=True)
+        self.n_in = n_in
+        self.n_out = n_out
+
+    def apply(self, data: np.ma.MaskedArray) -> np.ma.MaskedArray:
+
+        """
+        Remaps slabs of input data, each output cell being the exchange-grid area weighted mean
+        of the valid input cells it overlaps.  Output cells overlapping no valid input cell are masked
+
+        :param data: input data, of shape (slabs, input cells)
+        :type data: np.ma.MaskedArray
+
+        :return: output data, of shape (slabs, output cells)
+        :rtype: np.ma.MaskedArray
+        """
+
+        values = np.ma.getdata(data).astype(np.float64)
+        valid = ~np.ma.getmaskarray(data) & np.isfinite(values)
+        values = np.where(valid, values, 0.)
+
+        nslabs = values.shape[0]
+        weighted = np.zeros((nslabs, self.n_out))
+        covered = np.zeros((nslabs, self.n_out))
+        if self.indices.size:
+            block = max(1, SLAB_BLOCK_BYTES // (16 * self.indices.size))
+            for start in range(0, nslabs, block):
+                stop = min(start + block, nslabs)
+                weighted[start:stop, self.rows] = np.add.reduceat(values[start:stop, self.indices] * self.areas,
+                                                                  self.starts, axis=1)
+                covered[start:stop, self.rows] = np.add.reduceat(valid[start:stop, self.indices] * self.areas,
+                                                                 self.starts, axis=1)
+
+        mask = covered <= 0.
+        return np.ma.MaskedArray(np.divide(weighted, covered, out=np.zeros_like(weighted), where=~mask),
+                                 mask=mask)
+
+
+def read_remap_file(remap_file: str, ntiles: int, ny: int, nx: int, nlon: int, nlat: int) -> RemapMatrix:
+
+    """
+    Reads the exchange grid of a fregrid remap file: the input tile and 1-based (i, j) cell of each
+    exchange-grid cell, its 1-based output (i, j) cell and its area
+
+    :param remap_file: remap file
+    :type remap_file: str
+    :param ntiles: number of input tiles
+    :type ntiles: int
+    :param ny: number of input cells along y on each tile
+    :type ny: int
+    :param nx: number of input cells along x on each tile
+    :type nx: int
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+
+    :return: remap matrix
+    :rtype: RemapMatrix
+    """
+
+    with netCDF4.Dataset(remap_file, "r") as dataset:
+        tile1 = np.asarray(dataset["tile1"][:], dtype=np.int64).ravel()
+        tile1_cell = np.asarray(dataset["tile1_cell"][:], dtype=np.int64).reshape(-1, 2)
+        tile2_cell = np.asarray(dataset["tile2_cell"][:], dtype=np.int64).reshape(-1, 2)
+        areas = np.asarray(dataset["xgrid_area"][:], dtype=np.float64).ravel()
+
+    in_cells = (tile1 - 1) * ny * nx + (tile1_cell[:, 1] - 1) * nx + (tile1_cell[:, 0] - 1)
+    out_cells = (tile2_cell[:, 1] - 1) * nlon + (tile2_cell[:, 0] - 1)
+    return RemapMatrix(in_cells, out_cells, areas, ntiles * ny * nx, nlat * nlon)
+
+
+@lru_cache(maxsize=8)
+def _load_remap_matrix(file_key: tuple, ntiles: int, ny: int, nx: int, nlon: int, nlat: int) -> RemapMatrix:
+    """
+    reads a remap file, cached by file_key, (path, device, inode, size), which changes when the remap file
+    is replaced
+    """
+    remap_file = file_key[0]
+    fre_logger.info("Loading remap file %s", remap_file)
+    return read_remap_file(remap_file, ntiles, ny, nx, nlon, nlat)
+
+
+def load_remap_matrix(remap_file: str, ntiles: int, ny: int, nx: int, nlon: int, nlat: int) -> RemapMatrix:
+
+    """
+    Returns the remap matrix of a remap file, read once per process for as long as the file is not replaced.
+    See read_remap_file for the parameters
+    """
+
+    stat = Path(remap_file).stat()
+    return _load_remap_matrix((str(remap_file), stat.st_dev, stat.st_ino, stat.st_size), ntiles, ny, nx, nlon, nlat)
+
+
+def copy_variable(nc_in: netCDF4.Dataset, nc_out: netCDF4.Dataset, name: str):
+
+    """
+    Copies a variable, and the dimensions it needs, from one dataset to another
+
+    :param nc_in: dataset to copy from
+    :type nc_in: netCDF4.Dataset
+    :param nc_out: dataset to copy to
+    :type nc_out: netCDF4.Dataset
+    :param name: variable name
+    :type name: str
+    """
+
+    var_in = nc_in[name]
+    for dim in var_in.dimensions:
+        if dim not in nc_out.dimensions:
+            nc_out.createDimension(dim, None if nc_in.dimensions[dim].isunlimited() else nc_in.dimensions[dim].size)
+    var_out = nc_out.createVariable(name, var_in.datatype, var_in.dimensions,
+                                    fill_value=getattr(var_in, "_FillValue", None))
+    var_in.set_auto_maskandscale(False)
+    var_out.set_auto_maskandscale(False)
+    var_out.setncatts({key: value for key, value in var_in.__dict__.items() if key != "_FillValue"})
+    var_out[...] = var_in[...]
+
+
+def write_lat_lon(nc_out: netCDF4.Dataset, nlon: int, nlat: int):
+
+    """
+    Writes the axes and bounds of the global lat-lon grid fregrid regrids to, with --standard_dimension
+
+    :param nc_out: output dataset
+    :type nc_out: netCDF4.Dataset
+    :param nlon: number of longitude cells
+    :type nlon: int
+    :param nlat: number of latitude cells
+    :type nlat: int
+    """
+
+    nc_out.createDimension("lon", nlon)
+    nc_out.createDimension("lat", nlat)
+    if "bnds" not in nc_out.dimensions:
+        nc_out.createDimension("bnds", 2)
+
+    for axis, size, begin, end, units in [("lon", nlon, 0., 360., "degrees_east"),
+                                          ("lat", nlat, -90., 90., "degrees_north")]:
+        edges = np.linspace(begin, end, size + 1)
+        var = nc_out.createVariable(axis, "f8", (axis,))
+        var.setncatts({"long_name": "longitude" if axis == "lon" else "latitude", "units": units,
+                       "axis": "X" if axis == "lon" else "Y", "bounds": f"{axis}_bnds"})
+        var[:] = 0.5 * (edges[:-1] + edges[1:])
+        nc_out.createVariable(f"{axis}_bnds", "f8", (axis, "bnds"))[:] = np.stack([edges[:-1], edges[1:]], axis=1)
+
+
+def regrid_file(remap_file: str, input_files: list[str], output_file: str, scalar_fields: list[str],
+                nlon: int, nlat: int):
+
+    """
+    Regrids the scalar fields of an input file, split into one file per tile, to a global lat-lon grid.
+    Variables the scalar fields depend on, and those depending only on the same non-horizontal dimensions
+    and their bounds, such as time_bnds or average_T1, are copied from the first tile.  The output file
+    is written to a temporary file first, then moved into place
+
+    :param remap_file: fregrid remap file, see read_remap_file
+    :type remap_file: str
+    :param input_files: input file of each tile, in mosaic order
+    :type input_files: list[str]
+    :param output_file: regridded file
+    :type output_file: str
+    :param scalar_fields: variables to regrid
+    :type scalar_fields: list[str]
+    :param nlon: number of output longitude cells
+    :type nlon: int
+    :param nlat: number of output latitude cells
+    :type nlat: int
+
+    :raises ValueError: a scalar field is not on the input grid of the remap file
+    """
+
+    nc_tiles = [netCDF4.Dataset(input_file, "r") for input_file in input_files]
+    temp_file = Path(output_file).with_name(f".{Path(output_file).name}.{os.getpid()}.tmp")
+    try:
+        nc_first = nc_tiles[0]
+        shapes = {nc_first[field].shape[-2:] for field in scalar_fields if nc_first[field].ndim >= 2}
+        if len(shapes) != 1 or any(nc_first[field].ndim < 2 for field in scalar_fields):
+            raise ValueError(f"Scalar fields {scalar_fields} of {input_files[0]} are not all on one horizontal grid")
+        ny, nx = shapes.pop()
+        remap_matrix = load_remap_matrix(remap_file, len(nc_tiles), ny, nx, nlon, nlat)
+
+        #non-horizontal dimensions, their coordinates and bounds
+        leading_dims = {dim for field in scalar_fields for dim in nc_first[field].dimensions[:-2]}
+        bounds = {nc_first[dim].bounds for dim in leading_dims
+                  if dim in nc_first.variables and "bounds" in nc_first[dim].ncattrs()}
+        allowed_dims = leading_dims | {dim for name in bounds if name in nc_first.variables
+                                       for dim in nc_first[name].dimensions}
+
+        with netCDF4.Dataset(temp_file, "w") as nc_out:
+            nc_out.setncatts(nc_first.__dict__)
+            write_lat_lon(nc_out, nlon, nlat)
+            for name, var in nc_first.variables.items():
+                if name not in scalar_fields and set(var.dimensions) <= allowed_dims:
+                    copy_variable(nc_first, nc_out, name)
+
+            for field in scalar_fields:
+                var_in = nc_first[field]
+                for dim in var_in.dimensions[:-2]:
+                    if dim not in nc_out.dimensions:
+                        nc_out.createDimension(dim, None if nc_first.dimensions[dim].isunlimited()
+                                               else nc_first.dimensions[dim].size)
+                dtype = var_in.dtype if np.issubdtype(var_in.dtype, np.floating) else np.dtype("f8")
+                fill_value = getattr(var_in, "_FillValue", getattr(var_in, "missing_value",
+                                                                   netCDF4.default_fillvals[dtype.str[1:]]))
+                var_out = nc_out.createVariable(field, dtype, var_in.dimensions[:-2] + ("lat", "lon"),
+                                                fill_value=fill_value)
+                var_out.setncatts({key: value for key, value in var_in.__dict__.items()
+                                   if key not in DROPPED_ATTRIBUTES})
+                var_out.missing_value = np.asarray(fill_value, dtype=dtype)
+
+                #one slab along the leading dimension, usually time, at a time
+                slabs = [Ellipsis] if var_in.ndim == 2 else range(var_in.shape[0])
+                for slab in slabs:
+                    data = np.ma.stack([nc_tile[field][slab] for nc_tile in nc_tiles], axis=-3)
+                    shape = data.shape[:-3]
+                    regridded = remap_matrix.apply(data.reshape(-1, remap_matrix.n_in))
+                    var_out[slab] = regridded.reshape(shape + (nlat, nlon))
+        os.replace(temp_file, output_file)
+    finally:
+        for nc_tile in nc_tiles:
+            nc_tile.close()
+        if temp_file.exists():
+            temp_file.unlink()
@@ -0,0 +1,108 @@
+'''
+tests for the native conservative remap file generation of fre.app.regrid_xy
+'''
+
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from fre.app.regrid_xy import conserve_weights, sparse_remap
+import fre.app.regrid_xy.regrid_xy as regrid_xy
+
+NLON, NLAT = 40, 20
+
+
+def make_cubed_sphere(grid_dir: Path, n: int = 4) -> Path:
+    ''' writes the supergrid tiles of a gnomonic cubed sphere, poles at cell corners, and its mosaic '''
+    edges = np.tan(np.linspace(-np.pi/4, np.pi/4, 2*n+1))
+    a, b = np.meshgrid(edges, edges)
+    one = np.ones_like(a)
+    faces = [(one, a, b), (-a, one, b), (-one, -a, b), (a, -one, b), (-b, a, one), (b, a, -one)]
+    for tile, (x, y, z) in enumerate(faces, start=1):
+        lon = np.rad2deg(np.arctan2(y, x)) % 360.
+        lat = np.rad2deg(np.arcsin(z/np.sqrt(x*x + y*y + z*z)))
+        xr.Dataset(data_vars={"x": (["nyp", "nxp"], lon), "y": (["nyp", "nxp"], lat)}
+                   ).to_netcdf(grid_dir/f"C{n}.tile{tile}.nc")
+    gridfiles = [f"C{n}.tile{tile}.nc".encode() for tile in range(1, 7)]
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray(gridfiles, dims=["ntiles"]).astype("|S255")}
+               ).to_netcdf(grid_dir/f"C{n}_mosaic.nc")
+    return grid_dir/f"C{n}_mosaic.nc"
+
+
+def lat_lon_areas() -> np.ndarray:
+    ''' areas of the output lat-lon cells, in m2 '''
+    lat_edges = np.linspace(-0.5*np.pi, 0.5*np.pi, NLAT+1)
+    return np.repeat(conserve_weights.RADIUS**2 * 2.*np.pi/NLON * np.diff(np.sin(lat_edges))[:, None], NLON, axis=1)
+
+
+def test_clip_regular_grid():
+    '''
+    A lat-lon input grid shifted in longitude is split exactly between the output cells
+    '''
+    lon, lat = np.meshgrid(np.deg2rad(np.linspace(-180., 180., 37)), np.deg2rad(np.linspace(-90., 90., 19)))
+    cells, out_cells, areas = conserve_weights.clip_cells(lon, lat, NLON, NLAT)
+    assert np.allclose(np.bincount(out_cells, areas, minlength=NLON*NLAT), lat_lon_areas().ravel())
+    assert np.array_equal(np.unique(cells), np.arange(36*18))
+
+
+def test_generate_remap_file(tmp_path, monkeypatch):
+    '''
+    Exchange-grid areas of a cubed sphere add up to the areas of its cells and of the output cells,
+    whatever the number of workers, and regridding a constant field keeps it constant
+    '''
+    mosaic = make_cubed_sphere(tmp_path)
+    remap_file = tmp_path/"remap.nc"
+    ncells = conserve_weights.generate_remap_file(mosaic, remap_file, NLON, NLAT)
+
+    with netCDF4.Dataset(remap_file) as dataset:
+        assert dataset.dimensions["ncells"].size == ncells
+        assert dataset["tile1_cell"].dimensions == ("ncells", "two")
+        tile1 = dataset["tile1"][:]
+        tile2_cell = dataset["tile2_cell"][:]
+        areas = dataset["xgrid_area"][:]
+    assert set(tile1) == set(range(1, 7))
+    out_cells = (tile2_cell[:, 1] - 1)*NLON + tile2_cell[:, 0] - 1
+    assert np.allclose(np.bincount(out_cells, areas, minlength=NLON*NLAT), lat_lon_areas().ravel())
+    assert np.isclose(areas.sum(), 4.*np.pi*conserve_weights.RADIUS**2)
+
+    parallel_file = tmp_path/"remap_parallel.nc"
+    monkeypatch.setattr(conserve_weights, "BLOCK_CELLS", 8)
+    conserve_weights.generate_remap_file(mosaic, parallel_file, NLON, NLAT, workers=3)
+    with netCDF4.Dataset(parallel_file) as dataset:
+        assert np.isclose(dataset["xgrid_area"][:].sum(), areas.sum())
+        assert dataset.dimensions["ncells"].size == ncells
+
+    remap_matrix = sparse_remap.read_remap_file(remap_file, 6, 4, 4, NLON, NLAT)
+    assert np.allclose(remap_matrix.apply(np.ma.MaskedArray(np.full((1, 6*4*4), 3.))), 3.)
+
+
+def test_sparse_engine_generates_missing_remap_file(tmp_path):
+    '''
+    The sparse engine generates a missing conserve_order1 remap file instead of leaving it to fregrid
+    '''
+    mosaic = make_cubed_sphere(tmp_path)
+    for tile in range(1, 7):
+        xr.Dataset(data_vars={"temp": (["grid_yt", "grid_xt"], np.full((4, 4), float(tile)))}
+                   ).to_netcdf(tmp_path/f"20000101.atmos_static.tile{tile}.nc")
+
+    datadict = {"input_dir": str(tmp_path),
+                "input_mosaic": str(mosaic),
+                "input_file": "20000101.atmos_static",
+                "interp_method": "conserve_order1",
+                "scalar_field": "temp",
+                "output_nlon": str(NLON),
+                "output_nlat": str(NLAT)}
+    remap_file = tmp_path/"remap.nc"
+    assert regrid_xy.run_sparse_regrid(datadict, str(remap_file), tmp_path)
+    assert remap_file.exists()
+
+    with netCDF4.Dataset(tmp_path/"20000101.atmos_static.nc") as dataset:
+        temp = dataset["temp"][:]
+    assert temp.shape == (NLAT, NLON) and temp.count() == NLAT*NLON
+    #area weighted means of the tile numbers, conserved: polar tiles at the poles
+    assert np.allclose(temp[0], 6.) and np.allclose(temp[-1], 5.)
+    with netCDF4.Dataset(remap_file) as dataset:
+        tile_sum = (dataset["tile1"][:]*dataset["xgrid_area"][:]).sum()
+    assert np.isclose((temp*lat_lon_areas()).sum(), tile_sum)
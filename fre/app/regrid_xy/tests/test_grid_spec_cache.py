@@ -0,0 +1,132 @@
+'''
+tests for the grid spec cache of fre.app.regrid_xy
+'''
+
+import json
+import multiprocessing
+import os
+import tarfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from fre.app import helpers
+from fre.app.regrid_xy import grid_spec_cache
+import fre.app.regrid_xy.regrid_xy as regrid_xy
+
+
+def make_grid_spec_tar(tmp_path: Path) -> Path:
+    '''
+    writes a grid spec tarball with an atmos mosaic of two tiles, in gridlocation "./" as
+    make_solo_mosaic writes by default, and an unrelated ocean grid
+    '''
+    grid_dir = tmp_path/"grid_files"
+    grid_dir.mkdir()
+    xr.Dataset(data_vars={"atm_mosaic_file": xr.DataArray(b"C4_mosaic.nc").astype("|S255"),
+                          "ocn_mosaic_file": xr.DataArray(b"ocean_mosaic.nc").astype("|S255")}
+               ).to_netcdf(grid_dir/"grid_spec.nc")
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray([b"C4.tile1.nc", b"C4.tile2.nc"], dims=["ntiles"]).astype("|S255"),
+                          "gridlocation": xr.DataArray(b"./").astype("|S255")}
+               ).to_netcdf(grid_dir/"C4_mosaic.nc")
+    for name in ["C4.tile1.nc", "C4.tile2.nc", "ocean_mosaic.nc", "ocean_hgrid.nc"]:
+        xr.Dataset(data_vars={"x": xr.DataArray(np.zeros((5, 5)), dims=["nyp", "nxp"])}).to_netcdf(grid_dir/name)
+
+    tar_path = tmp_path/"grid_spec.tar"
+    with tarfile.open(tar_path, "w") as tar:
+        for grid_file in sorted(grid_dir.iterdir()):
+            tar.add(grid_file, arcname=grid_file.name)
+    return tar_path
+
+
+def extract_in_process(args):
+    ''' extracts a grid spec tarball, from a separate process '''
+    tar_path, cache_dir = args
+    return str(grid_spec_cache.extract_grid_spec(tar_path, cache_dir))
+
+
+def test_extract_once(tmp_path):
+    '''
+    Concurrent tasks share one extraction, which is redone only if the tarball changes
+    '''
+    tar_path = make_grid_spec_tar(tmp_path)
+    cache_dir = tmp_path/"cache"
+
+    with multiprocessing.Pool(processes=4) as pool:
+        entries = set(pool.map(extract_in_process, [(str(tar_path), str(cache_dir))]*4))
+    assert len(entries) == 1
+    entry = Path(entries.pop())
+    assert [path.name for path in cache_dir.iterdir() if not path.name.endswith(".lock")] == [entry.name]
+
+    with open(entry/grid_spec_cache.MANIFEST_NAME, encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["size"] == tar_path.stat().st_size
+    assert sorted(manifest["members"]) == sorted(path.name for path in entry.iterdir()
+                                                 if path.name != grid_spec_cache.MANIFEST_NAME)
+
+    #a cache hit does not touch the extracted files
+    mtime = (entry/"grid_spec.nc").stat().st_mtime_ns
+    assert grid_spec_cache.extract_grid_spec(tar_path, cache_dir) == entry
+    assert (entry/"grid_spec.nc").stat().st_mtime_ns == mtime
+
+    stat = tar_path.stat()
+    os.utime(tar_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    new_entry = grid_spec_cache.extract_grid_spec(tar_path, cache_dir)
+    assert new_entry != entry and (new_entry/"grid_spec.nc").exists()
+
+
+def test_incomplete_extraction_is_redone(tmp_path):
+    '''
+    A directory left without its manifest by a task that died extracting is replaced
+    '''
+    tar_path = make_grid_spec_tar(tmp_path)
+    cache_dir = tmp_path/"cache"
+    entry = grid_spec_cache.form_grid_spec_entry(cache_dir, tar_path)
+    entry.mkdir(parents=True)
+    (entry/"grid_spec.nc").write_bytes(b"")
+    (cache_dir/f".{entry.name}.12345.tmp").mkdir()
+
+    assert grid_spec_cache.extract_grid_spec(tar_path, cache_dir) == entry
+    assert (entry/grid_spec_cache.MANIFEST_NAME).exists()
+    assert (entry/"grid_spec.nc").stat().st_size > 0
+    assert not (cache_dir/f".{entry.name}.12345.tmp").exists()
+
+
+def test_work_dir_links_needed_members(tmp_path):
+    '''
+    get_grid_spec and get_input_mosaic link the grid spec, the input mosaic and its tiles only
+    '''
+    tar_path = make_grid_spec_tar(tmp_path)
+    work_dir = tmp_path/"work"
+    work_dir.mkdir()
+    datadict = {"yaml": {"postprocess": {"settings": {"pp_grid_spec": str(tar_path)}}},
+                "grid_spec_cache_dir": str(tmp_path/"cache"),
+                "inputRealm": "atmos"}
+
+    with helpers.change_directory(work_dir):
+        datadict["grid_spec"] = regrid_xy.get_grid_spec(datadict)
+        assert datadict["grid_spec"] == "grid_spec.nc"
+        assert regrid_xy.get_input_mosaic(datadict) == "C4_mosaic.nc"
+        #a second task in the same work directory relinks
+        assert regrid_xy.get_grid_spec(datadict) == "grid_spec.nc"
+
+    assert sorted(path.name for path in work_dir.iterdir()) == ["C4.tile1.nc", "C4.tile2.nc",
+                                                               "C4_mosaic.nc", "grid_spec.nc"]
+    assert all(path.is_symlink() for path in work_dir.iterdir())
+
+    with pytest.raises(IOError):
+        grid_spec_cache.link_grid_files([tmp_path/"cache"/"missing.nc"], work_dir)
+
+
+def test_default_cache_is_private(tmp_path, monkeypatch):
+    '''
+    The default cache directory is named for the user and created for the user alone
+    '''
+    assert grid_spec_cache.GRID_SPEC_CACHE_DIR.name.endswith(f".{os.getuid()}")
+    tar_path = make_grid_spec_tar(tmp_path)
+    monkeypatch.setattr(grid_spec_cache, "GRID_SPEC_CACHE_DIR", tmp_path/f"fre_grid_spec_cache.{os.getuid()}")
+
+    entry = grid_spec_cache.extract_grid_spec(tar_path)
+    assert entry.parent == grid_spec_cache.GRID_SPEC_CACHE_DIR
+    assert grid_spec_cache.GRID_SPEC_CACHE_DIR.stat().st_mode & 0o777 == 0o700
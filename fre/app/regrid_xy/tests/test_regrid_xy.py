@@ -2,17 +2,23 @@
 tests for fre.app.regrid_xy submodule
 '''
 
+import itertools
+import logging
 import os
 from pathlib import Path
 import shutil
 from shutil import which
+import subprocess
+import tarfile
 
 import pytest
 import numpy as np
 import xarray as xr
+import yaml
 
 import fre.app.regrid_xy.regrid_xy as regrid_xy
 import fre.app.regrid_xy.tests.generate_files as generate_files
+from fre.app.regrid_xy.tests.test_conserve_weights import make_cubed_sphere
 
 WHICH_FREGRID = which('fregrid')
 HAVE_FREGRID = WHICH_FREGRID is not None and WHICH_FREGRID.split('/')[-1] == 'fregrid'
@@ -125,8 +131,8 @@ def test_regrid_xy():
         assert not (output_dir/f"{date}.{ifile}.nc").exists()
 
         #check remap_file exists and is not empty
-        remap_file = remap_dir/f"C{nxy}_mosaicX{nxy}by{nxy}_conserve_order2.nc"
-        assert remap_file.exists()
+        remap_files = list(remap_dir.glob(f"C{nxy}_mosaicX{nxy}by{nxy}_conserve_order2.*.nc"))
+        assert len(remap_files) == 1
 
     cleanup_test()
 
@@ -168,8 +174,8 @@ def test_regrid_xy_static():
         assert np.all(test["wins"].values==np.float64(3.0))
 
     #check remap_file exists and is not empty
-    remap_file = remap_dir/f"C{nxy}_mosaicX{nxy}by{nxy}_conserve_order2.nc"
-    assert remap_file.exists()
+    remap_files = list(remap_dir.glob(f"C{nxy}_mosaicX{nxy}by{nxy}_conserve_order2.*.nc"))
+    assert len(remap_files) == 1
 
     cleanup_test()
 
@@ -213,30 +219,191 @@ def test_get_input_file():
 
 @pytest.mark.skipif(not HAVE_FREGRID,
                     reason='fregrid not in env. it was removed from package reqs. you must load it externally')
-def test_get_remap_file():
+def test_get_remap_file(tmp_path):
     """
     Tests get_remap_file
     """
 
-    remap_dir = Path("remap_dir")
+    remap_dir = tmp_path/"remap_dir"
     input_mosaic = "C20_mosaic"
     nlon = 40
     nlat = 10
     interp_method = "conserve_order1"
 
-    datadict = {"remap_dir": remap_dir.name,
-                "input_mosaic": input_mosaic+".nc",
+    #a one-tile mosaic and its grid file
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray([b"C20.nc"], dims=["ntiles"]).astype("|S255")}
+               ).to_netcdf(tmp_path/f"{input_mosaic}.nc")
+    xr.Dataset(data_vars={"x": xr.DataArray(np.zeros((3, 3)), dims=["nyp", "nxp"])}).to_netcdf(tmp_path/"C20.nc")
+
+    datadict = {"remap_dir": str(remap_dir),
+                "input_mosaic": str(tmp_path/f"{input_mosaic}.nc"),
                 "output_nlon": nlon,
                 "output_nlat": nlat,
                 "interp_method": interp_method}
 
-    #check remap file from current directory is copied to input directory
-    remap_file = Path(f"remap_dir/{input_mosaic}X{nlon}by{nlat}_{interp_method}.nc")
-    assert regrid_xy.get_remap_file(datadict) == str(remap_file)
+    #the remap filename ends with a hash of the grid contents
+    remap_file = Path(regrid_xy.get_remap_file(datadict))
+    assert remap_file.parent == remap_dir
+    assert remap_file.name.startswith(f"{input_mosaic}X{nlon}by{nlat}_{interp_method}.")
 
     remap_dir.mkdir(exist_ok=True)
     remap_file.touch()
     assert regrid_xy.get_remap_file(datadict) == str(remap_file)
 
-    Path(remap_file).unlink()
-    shutil.rmtree(remap_dir)
+
+def test_get_remap_file_prestaged(tmp_path):
+    """
+    A remap file pre-staged in remap_dir under the name without the hash is reused under the hashed name
+    """
+
+    remap_dir = tmp_path/"remap_dir"
+    remap_dir.mkdir()
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray([b"C20.nc"], dims=["ntiles"]).astype("|S255")}
+               ).to_netcdf(tmp_path/"C20_mosaic.nc")
+    xr.Dataset(data_vars={"x": xr.DataArray(np.zeros((3, 3)), dims=["nyp", "nxp"])}).to_netcdf(tmp_path/"C20.nc")
+    legacy_file = remap_dir/"C20_mosaicX40by10_conserve_order1.nc"
+    xr.Dataset(data_vars={"xgrid_area": xr.DataArray(np.ones(3), dims=["ncells"])}).to_netcdf(legacy_file)
+
+    datadict = {"remap_dir": str(remap_dir),
+                "input_mosaic": str(tmp_path/"C20_mosaic.nc"),
+                "output_nlon": 40,
+                "output_nlat": 10,
+                "interp_method": "conserve_order1"}
+
+    remap_file = Path(regrid_xy.get_remap_file(datadict))
+    assert remap_file != legacy_file and remap_file.exists()
+    assert remap_file.read_bytes() == legacy_file.read_bytes()
+    assert legacy_file.exists()
+
+
+CASE_VARIABLES = {"a": 1., "b": 2., "c": 3.}
+
+
+def make_cubed_sphere_case(tmp_path: Path, sources: list[str], dates: list[str]) -> dict:
+    """
+    Writes a cubed sphere grid spec tarball, a yaml regridding atmos sources to two grids
+    plus an ocean component, and history files of every source and date with variables a, b and c
+    """
+
+    grid_dir = tmp_path/"grid"
+    grid_dir.mkdir()
+    make_cubed_sphere(grid_dir)
+    xr.Dataset(data_vars={"atm_mosaic_file": xr.DataArray(b"C4_mosaic.nc").astype("|S255"),
+                          "ocn_mosaic_file": xr.DataArray(b"ocean_mosaic.nc").astype("|S255")}
+               ).to_netcdf(grid_dir/"grid_spec.nc")
+    tar_file = tmp_path/"grid_spec.tar"
+    with tarfile.open(tar_file, "w") as tar:
+        for grid_file in grid_dir.iterdir():
+            tar.add(grid_file, arcname=grid_file.name)
+
+    atmos_sources = [{"history_file": source} for source in sources]
+    #the ocean mosaic is not in the grid spec, the ocean component must not be looked at
+    interps = [("atmos", "20,40"), ("atmos_scalar", "20,40"), ("atmos_coarse", "10,20")]
+    components = [{"type": component, "xyInterp": xy_interp, "sources": atmos_sources,
+                   "interpMethod": "conserve_order1", "inputRealm": "atmos"}
+                  for component, xy_interp in interps]
+    components.append({"type": "ocean", "xyInterp": "20,40", "sources": [{"history_file": "ocean_month"}],
+                       "interpMethod": "conserve_order1", "inputRealm": "ocean"})
+    yamldict = {"postprocess": {"settings": {"pp_grid_spec": str(tar_file)}, "components": components}}
+    with open(tmp_path/"pp.yaml", "w") as openedfile:
+        yaml.dump(yamldict, openedfile)
+
+    dirs = {name: tmp_path/name for name in ["input", "output", "work", "remap"]}
+    for path in dirs.values():
+        path.mkdir()
+    for source, date_string in itertools.product(sources, dates):
+        for tile in range(1, 7):
+            xr.Dataset(data_vars={name: (["time", "grid_yt", "grid_xt"], np.full((2, 4, 4), value))
+                                  for name, value in CASE_VARIABLES.items()}
+                       ).to_netcdf(dirs["input"]/f"{date_string}.{source}.tile{tile}.nc")
+    return dirs
+
+
+def check_case_output(output_dir: Path, input_files: list[str]):
+    """ checks every input file was regridded to both grids, constant fields staying constant """
+    for output_subdir in ["20_40.conserve_order1", "10_20.conserve_order1"]:
+        assert sorted(path.name for path in (output_dir/output_subdir).iterdir()) == \
+            sorted(f"{input_file}.nc" for input_file in input_files)
+        for input_file in input_files:
+            regridded = xr.load_dataset(output_dir/output_subdir/f"{input_file}.nc")
+            for name, value in CASE_VARIABLES.items():
+                assert regridded[name].dims == ("time", "lat", "lon")
+                assert np.allclose(regridded[name].values, value)
+
+
+def test_regrid_xy_concurrent_batches(tmp_path):
+    """
+    Tests that regrid_xy runs the variable batches of every component concurrently and merges them,
+    components sharing an interpolation being regridded once
+    """
+
+    dirs = make_cubed_sphere_case(tmp_path, ["atmos_month"], ["20000101"])
+    reports = regrid_xy.regrid_xy(yamlfile=str(tmp_path/"pp.yaml"),
+                                  input_dir=str(dirs["input"]),
+                                  output_dir=str(dirs["output"]),
+                                  work_dir=str(dirs["work"]),
+                                  remap_dir=str(dirs["remap"]),
+                                  source="atmos_month",
+                                  input_date="20000101T0000Z",
+                                  grid_spec_cache_dir=str(tmp_path/"grid_spec_cache"),
+                                  engine="sparse",
+                                  workers=3,
+                                  variables_per_job=2)
+
+    assert sorted((report["component"], tuple(report["variables"])) for report in reports) == \
+        [("atmos", ("a", "b")), ("atmos", ("c",)), ("atmos_coarse", ("a", "b")), ("atmos_coarse", ("c",))]
+    assert sum(report["remap_generated"] for report in reports) == 2
+    assert all(report["seconds"] > 0 for report in reports)
+    check_case_output(dirs["output"], ["20000101.atmos_month"])
+
+
+def test_regrid_xy_batch(tmp_path, monkeypatch):
+    """
+    Tests that regrid_xy_batch regrids every source and date, resolving mosaics and remap files once
+    """
+
+    sources, dates = ["atmos_month", "atmos_daily"], ["20000101", "20010101"]
+    dirs = make_cubed_sphere_case(tmp_path, sources, dates)
+
+    calls = {"get_input_mosaic": 0, "get_remap_file": 0}
+    for name in calls:
+        def counted(datadict, function=getattr(regrid_xy, name), name=name):
+            calls[name] += 1
+            return function(datadict)
+        monkeypatch.setattr(regrid_xy, name, counted)
+
+    reports = regrid_xy.regrid_xy_batch(yamlfile=str(tmp_path/"pp.yaml"),
+                                        input_dir=str(dirs["input"]),
+                                        output_dir=str(dirs["output"]),
+                                        work_dir=str(dirs["work"]),
+                                        remap_dir=str(dirs["remap"]),
+                                        sources=sources,
+                                        input_dates=[f"{date_string}T0000Z" for date_string in dates],
+                                        grid_spec_cache_dir=str(tmp_path/"grid_spec_cache"),
+                                        engine="sparse",
+                                        workers=2)
+
+    assert calls == {"get_input_mosaic": 1, "get_remap_file": 2}
+    assert len(reports) == 8
+    check_case_output(dirs["output"], [f"{date_string}.{source}"
+                                       for source, date_string in itertools.product(sources, dates)])
+
+
+def test_fregrid_debug_follows_logging(monkeypatch, caplog):
+    """
+    Tests that fregrid only runs with --debug when debug messages are logged
+    """
+
+    commands = []
+    monkeypatch.setattr(regrid_xy.subprocess, "run",
+                        lambda command, **kwargs: commands.append(command) or
+                        subprocess.CompletedProcess(command, 0, stdout="", stderr=""))
+    datadict = {"input_dir": "in", "input_mosaic": "C4_mosaic.nc", "input_file": "20000101.atmos_month",
+                "interp_method": "conserve_order1", "output_nlon": "40", "output_nlat": "20",
+                "scalar_field": "a,b"}
+
+    with caplog.at_level(logging.INFO, logger=regrid_xy.fre_logger.name):
+        regrid_xy.run_fregrid(datadict, "remap.nc", Path("out"))
+    with caplog.at_level(logging.DEBUG, logger=regrid_xy.fre_logger.name):
+        regrid_xy.run_fregrid(datadict, "remap.nc", Path("out"))
+    assert "--debug" not in commands[0] and "--debug" in commands[1]
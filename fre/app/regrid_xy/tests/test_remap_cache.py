@@ -0,0 +1,171 @@
+'''
+tests for the remap file cache of fre.app.regrid_xy
+'''
+
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+from fre.app import helpers
+from fre.app.regrid_xy import remap_cache
+
+
+def make_mosaic(grid_dir: Path, ntiles: int = 2) -> Path:
+    ''' writes a small mosaic and its grid tiles, returning the mosaic file '''
+    grid_dir.mkdir(parents=True, exist_ok=True)
+    gridfiles = [f"C4.tile{i}.nc".encode() for i in range(1, ntiles+1)]
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray(gridfiles, dims=["ntiles"]).astype("|S255")}
+               ).to_netcdf(grid_dir/"C4_mosaic.nc")
+    for i in range(1, ntiles+1):
+        xr.Dataset(data_vars={"x": xr.DataArray(np.full((5, 5), float(i)), dims=["nyp", "nxp"])}
+                   ).to_netcdf(grid_dir/f"C4.tile{i}.nc")
+    return grid_dir/"C4_mosaic.nc"
+
+
+def fake_fregrid(remap_file: str, log_file: str = None, delay: float = 0.):
+    ''' stands in for fregrid, generating the remap file if it does not exist '''
+    if log_file is not None:
+        with open(log_file, "a", encoding="utf-8") as openedfile:
+            openedfile.write(f"{'read' if Path(remap_file).exists() else 'generate'} {remap_file}\n")
+    if not Path(remap_file).exists():
+        time.sleep(delay)
+        with netCDF4.Dataset(remap_file, "w") as dataset:
+            dataset.createDimension("ncells", 3)
+            dataset.createVariable("xgrid_area", "f8", ("ncells",))[:] = 1.
+
+
+def fetch_in_process(args):
+    ''' fetches a remap file, from a separate process '''
+    remap_file, log_file = args
+    return remap_cache.fetch_remap_file(Path(remap_file),
+                                        lambda path: fake_fregrid(path, log_file, delay=0.2))
+
+
+def test_form_remap_file_tracks_contents(tmp_path):
+    '''
+    The remap filename only changes with the grid contents, output grid and method
+    '''
+    mosaic = make_mosaic(tmp_path/"grid")
+    remap_file = remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1")
+    assert remap_file.parent == tmp_path
+    assert remap_file.name.startswith("C4_mosaicX40by20_conserve_order1.")
+    assert remap_cache.REMAP_FILE_PATTERN.match(remap_file.name)
+
+    assert remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1") == remap_file
+    assert remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order2") != remap_file
+    assert remap_cache.form_remap_file(tmp_path, mosaic, 40, 21, "conserve_order1") != remap_file
+
+    xr.Dataset(data_vars={"x": xr.DataArray(np.zeros((5, 5)), dims=["nyp", "nxp"])}
+               ).to_netcdf(tmp_path/"grid"/"C4.tile2.nc")
+    assert remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1") != remap_file
+
+    (tmp_path/"grid"/"C4.tile2.nc").unlink()
+    with pytest.raises(IOError):
+        remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1")
+
+
+def test_mosaic_tiles_in_gridlocation(tmp_path):
+    '''
+    Tile files are found relative to the mosaic file's directory, whatever the current directory,
+    unless gridlocation is absolute
+    '''
+    mosaic = make_mosaic(tmp_path/"grid")
+    expected = [tmp_path/"grid"/"C4.tile1.nc", tmp_path/"grid"/"C4.tile2.nc"]
+    for gridlocation in ["./", str(tmp_path/"grid") + "/"]:
+        with xr.open_dataset(mosaic) as dataset:
+            dataset = dataset.load()
+        dataset["gridlocation"] = xr.DataArray(gridlocation.encode()).astype("|S255")
+        dataset.to_netcdf(tmp_path/"grid"/"located_mosaic.nc")
+        work_dir = tmp_path/"work"
+        work_dir.mkdir(exist_ok=True)
+        with helpers.change_directory(work_dir):
+            tile_files = remap_cache.get_mosaic_tile_files("../grid/located_mosaic.nc")
+        assert [(work_dir/tile_file).resolve() for tile_file in tile_files] == expected
+
+
+def test_fetch_generates_once_then_reads(tmp_path):
+    '''
+    The first fetch generates the remap file, later ones read it, and an invalid one is replaced
+    '''
+    mosaic = make_mosaic(tmp_path/"grid")
+    remap_file = remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1")
+    used = []
+
+    assert remap_cache.fetch_remap_file(remap_file, lambda path: (used.append(path), fake_fregrid(path)))
+    assert remap_cache.validate_remap_file(remap_file)
+    assert Path(used[0]) != remap_file and not Path(used[0]).exists()
+
+    assert not remap_cache.fetch_remap_file(remap_file, lambda path: (used.append(path), fake_fregrid(path)))
+    assert used[1] == str(remap_file)
+
+    remap_file.write_bytes(b"")
+    assert remap_cache.fetch_remap_file(remap_file, fake_fregrid)
+    assert remap_cache.validate_remap_file(remap_file)
+
+    remap_file.unlink()
+    with pytest.raises(RuntimeError):
+        remap_cache.fetch_remap_file(remap_file, lambda path: None)
+    assert not remap_file.exists()
+
+
+def test_concurrent_fetches_generate_once(tmp_path):
+    '''
+    Of several tasks missing the cache at once, exactly one generates the remap file
+    '''
+    mosaic = make_mosaic(tmp_path/"grid")
+    remap_file = remap_cache.form_remap_file(tmp_path, mosaic, 40, 20, "conserve_order1")
+    log_file = tmp_path/"fregrid.log"
+
+    with multiprocessing.Pool(processes=4) as pool:
+        generated = pool.map(fetch_in_process, [(str(remap_file), str(log_file))]*4)
+
+    assert sorted(generated) == [False, False, False, True]
+    calls = log_file.read_text().splitlines()
+    assert len(calls) == 4
+    assert sum(call.startswith("generate") for call in calls) == 1
+    assert all(call == f"read {remap_file}" for call in calls if call.startswith("read"))
+
+
+def test_evict_least_recently_used(tmp_path):
+    '''
+    Eviction removes the oldest remap files first, with their lock files, never the one kept, and ignores other files
+    '''
+    entries = [tmp_path/f"C4_mosaicX40by20_conserve_order{i}.{i:016x}.nc" for i in range(1, 5)]
+    for age, entry in enumerate(reversed(entries)):
+        entry.write_bytes(b"x"*1000)
+        os.utime(entry, (time.time() - 100*age, time.time() - 100*age))
+    (tmp_path/"user_remap_file.nc").write_bytes(b"x"*5000)
+
+    removed = remap_cache.evict_remap_files(tmp_path, 2500, keep=entries[0])
+    assert removed == [entries[1], entries[2]]
+    assert not any(remap_cache.form_lock_path(entry).exists() for entry in removed)
+    assert entries[0].exists() and entries[3].exists()
+    assert (tmp_path/"user_remap_file.nc").exists()
+
+
+def test_lock_follows_removed_lock_file(tmp_path):
+    '''
+    A task waiting on a lock file that eviction removes locks the next lock file instead of the removed one
+    '''
+    entry = tmp_path/"C4_mosaicX40by20_conserve_order1.0000000000000001.nc"
+    in_place = []
+
+    def wait_for_lock():
+        with remap_cache.lock_cache_entry(entry, exclusive=True):
+            in_place.append(remap_cache.form_lock_path(entry).exists())
+
+    with remap_cache.lock_cache_entry(entry, exclusive=True):
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        time.sleep(0.2)
+        remap_cache.form_lock_path(entry).unlink()
+    waiter.join(timeout=10)
+
+    assert in_place == [True]
@@ -0,0 +1,121 @@
+'''
+tests for the in-process remap file application of fre.app.regrid_xy
+'''
+
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+from fre.app.regrid_xy import sparse_remap
+import fre.app.regrid_xy.regrid_xy as regrid_xy
+
+NTILES, NY, NX = 2, 3, 4
+NLON, NLAT = 5, 2
+
+
+def make_exchange_grid(seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ''' random exchange grid covering every input cell, and all output cells but the last '''
+    rng = np.random.default_rng(seed)
+    in_cells = np.repeat(np.arange(NTILES*NY*NX), 2)
+    out_cells = rng.integers(0, NLON*NLAT - 1, in_cells.size)
+    areas = rng.uniform(0.1, 1., in_cells.size)
+    return in_cells, out_cells, areas
+
+
+def write_remap_file(remap_file: Path, in_cells: np.ndarray, out_cells: np.ndarray, areas: np.ndarray):
+    ''' writes an exchange grid in the layout of fregrid remap files, with 1-based tiles and (i, j) cells '''
+    tile, cell = np.divmod(in_cells, NY*NX)
+    with netCDF4.Dataset(remap_file, "w") as dataset:
+        dataset.createDimension("ncells", in_cells.size)
+        dataset.createDimension("two", 2)
+        dataset.createVariable("tile1", "i4", ("ncells",))[:] = tile + 1
+        dataset.createVariable("tile1_cell", "i4", ("ncells", "two"))[:] = np.stack([cell % NX + 1,
+                                                                                     cell // NX + 1], axis=1)
+        dataset.createVariable("tile2_cell", "i4", ("ncells", "two"))[:] = np.stack([out_cells % NLON + 1,
+                                                                                     out_cells // NLON + 1], axis=1)
+        dataset.createVariable("xgrid_area", "f8", ("ncells",))[:] = areas
+
+
+def dense_remap(in_cells: np.ndarray, out_cells: np.ndarray, areas: np.ndarray, data: np.ndarray) -> np.ndarray:
+    ''' conservative first order remapping with a dense matrix, skipping NaN input '''
+    weights = np.zeros((NLON*NLAT, NTILES*NY*NX))
+    np.add.at(weights, (out_cells, in_cells), areas)
+    valid = np.isfinite(data)
+    with np.errstate(invalid="ignore"):
+        return (np.where(valid, data, 0.) @ weights.T) / (valid @ weights.T)
+
+
+def test_apply_matches_dense_remap():
+    '''
+    The sparse matrix gives the area weighted means of the valid input cells, masking uncovered output cells
+    '''
+    in_cells, out_cells, areas = make_exchange_grid()
+    remap_matrix = sparse_remap.RemapMatrix(in_cells, out_cells, areas, NTILES*NY*NX, NLON*NLAT)
+
+    data = np.random.default_rng(1).normal(size=(3, NTILES*NY*NX))
+    data[1, ::3] = np.nan
+    data[2, :] = np.nan
+    expected = dense_remap(in_cells, out_cells, areas, data)
+
+    regridded = remap_matrix.apply(np.ma.masked_invalid(data))
+    assert np.allclose(regridded.filled(np.nan), expected, equal_nan=True)
+    assert regridded.mask[:, -1].all() and regridded.mask[2].all()
+    assert not regridded.mask[0, :-1].any()
+
+    #constant fields are preserved, whatever cells are missing
+    assert np.allclose(remap_matrix.apply(np.ma.masked_invalid(np.where(np.isnan(data), np.nan, 7.)))[:2, :-1], 7.)
+
+    with pytest.raises(ValueError):
+        sparse_remap.RemapMatrix(in_cells, out_cells, areas, NTILES*NY*NX - 1, NLON*NLAT)
+
+
+def test_run_sparse_regrid(tmp_path):
+    '''
+    Regridding in-process writes fregrid's output file, regridding the scalar fields and copying time
+    '''
+    in_cells, out_cells, areas = make_exchange_grid()
+    remap_file = tmp_path/"remap.nc"
+    write_remap_file(remap_file, in_cells, out_cells, areas)
+    xr.Dataset(data_vars={"gridfiles": xr.DataArray([b"C4.tile1.nc", b"C4.tile2.nc"], dims=["ntiles"]).astype("|S255")}
+               ).to_netcdf(tmp_path/"C4_mosaic.nc")
+
+    data = np.random.default_rng(2).normal(size=(2, NTILES, NY, NX))
+    data[1, 0, 0, :] = np.nan
+    for tile in range(NTILES):
+        dataset = xr.Dataset(data_vars={"temp": (["time", "grid_yt", "grid_xt"], data[:, tile]),
+                                        "time_bnds": (["time", "nv"], [[0., 31.], [31., 59.]]),
+                                        "average_DT": (["time"], [31., 28.]),
+                                        "area": (["grid_yt", "grid_xt"], np.ones((NY, NX)))},
+                             coords={"time": ("time", [15.5, 45.], {"units": "days since 2000-01-01",
+                                                                   "bounds": "time_bnds"})})
+        dataset["temp"].attrs = {"units": "K", "cell_measures": "area: area"}
+        dataset.to_netcdf(tmp_path/f"20000101.atmos_month.tile{tile+1}.nc", unlimited_dims=["time"],
+                          encoding={"temp": {"_FillValue": 1.e20}})
+
+    output_subdir = tmp_path/"out"
+    output_subdir.mkdir()
+    datadict = {"input_dir": str(tmp_path),
+                "input_mosaic": str(tmp_path/"C4_mosaic.nc"),
+                "input_file": "20000101.atmos_month",
+                "interp_method": "conserve_order1",
+                "scalar_field": "temp",
+                "output_nlon": str(NLON),
+                "output_nlat": str(NLAT)}
+    assert regrid_xy.run_sparse_regrid(datadict, str(remap_file), output_subdir)
+
+    with netCDF4.Dataset(output_subdir/"20000101.atmos_month.nc") as dataset:
+        assert dataset["temp"].dimensions == ("time", "lat", "lon")
+        assert dataset.dimensions["time"].isunlimited()
+        assert "area" not in dataset.variables and "cell_measures" not in dataset["temp"].ncattrs()
+        assert np.allclose(dataset["time"][:], [15.5, 45.]) and np.allclose(dataset["average_DT"][:], [31., 28.])
+        assert np.allclose(dataset["lon_bnds"][:, 0], np.arange(NLON) * 360. / NLON)
+        regridded = dataset["temp"][:]
+    expected = dense_remap(in_cells, out_cells, areas, data.reshape(2, -1)).reshape(2, NLAT, NLON)
+    assert np.allclose(regridded.filled(np.nan), expected, equal_nan=True)
+
+    #fregrid is left to remap with other methods
+    datadict["interp_method"] = "conserve_order2"
+    assert not regrid_xy.run_sparse_regrid(datadict, str(remap_file), output_subdir)
@@ -170,6 +170,26 @@ def test_cli_fre_app_combine_time_averages_case(capfd):
     _out, _err = capfd.readouterr()
 
 
+# fre app benchmark-time-averages
+def test_cli_fre_app_benchmark_time_averages(capfd):
+    """ fre app benchmark-time-averages """
+    result = runner.invoke(fre.fre, args=["app", "benchmark-time-averages"])
+    assert result.exit_code == 2
+    _out, _err = capfd.readouterr()
+
+def test_cli_fre_app_benchmark_time_averages_help(capfd):
+    """ fre app benchmark-time-averages --help """
+    result = runner.invoke(fre.fre, args=["app", "benchmark-time-averages", "--help"])
+    assert result.exit_code == 0
+    _out, _err = capfd.readouterr()
+
+def test_cli_fre_app_compare_time_average_benchmarks_help(capfd):
+    """ fre app compare-time-average-benchmarks --help """
+    result = runner.invoke(fre.fre, args=["app", "compare-time-average-benchmarks", "--help"])
+    assert result.exit_code == 0
+    _out, _err = capfd.readouterr()
+
+
 # fre app regrid
 def test_cli_fre_app_regrid(capfd):
     """ fre app regrid """
@@ -189,6 +209,19 @@ def test_cli_fre_app_regrid_opt_dne(capfd):
     assert result.exit_code == 2
     _out, _err = capfd.readouterr()
 
+# fre app regrid-batch
+def test_cli_fre_app_regrid_batch(capfd):
+    """ fre app regrid-batch """
+    result = runner.invoke(fre.fre, args=["app", "regrid-batch"])
+    assert result.exit_code == 2
+    _out, _err = capfd.readouterr()
+
+def test_cli_fre_app_regrid_batch_help(capfd):
+    """ fre app regrid-batch --help """
+    result = runner.invoke(fre.fre, args=["app", "regrid-batch", "--help"])
+    assert result.exit_code == 0
+    _out, _err = capfd.readouterr()
+
 @pytest.mark.skipif(which('fregrid') is None,
                     reason='fregrid not in env. it was removed from package reqs. you must load it externally')
 def test_cli_fre_app_regrid_test_case_1(capfd):